@@ -1,9 +1,29 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 
 from .models import Agency, AgencyMember, Area, Post, Comment
 
 
-admin.site.register(Agency)
+class AgencyAdmin(admin.ModelAdmin):
+    list_display = ("name", "verification", "posts_count", "members_count", "last_posted_at", "created_at")
+    list_filter = (("verification", admin.EmptyFieldListFilter),)
+    actions = ["verify_agencies", "unverify_agencies"]
+
+    def report(self, request, changed, queryset, verb, unchanged):
+        skipped = queryset.count() - len(changed)
+        self.message_user(request, f"{verb} {len(changed)} agencies.", messages.SUCCESS)
+        if skipped:
+            self.message_user(request, f"{skipped} agencies were already {unchanged}.", messages.WARNING)
+
+    @admin.action(description="Verify selected agencies")
+    def verify_agencies(self, request, queryset):
+        self.report(request, queryset.verify(request.user), queryset, "Verified", "verified")
+
+    @admin.action(description="Unverify selected agencies")
+    def unverify_agencies(self, request, queryset):
+        self.report(request, queryset.unverify(), queryset, "Unverified", "unverified")
+
+
+admin.site.register(Agency, AgencyAdmin)
 admin.site.register(AgencyMember)
 admin.site.register(Area)
 admin.site.register(Post)
@@ -13,4 +33,4 @@ admin.site.register(Comment)
 # superuser: mrkhulaifi, password: open4khulaifi
 # user logout url: http://127.0.0.1:8000/accounts/logout
 # user2: UserNoAgencies, password: Open4agag
-# user2: UserOneAgency, password: Open4agag
\ No newline at end of file
+# user2: UserOneAgency, password: Open4agag
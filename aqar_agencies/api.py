@@ -0,0 +1,228 @@
+"""Read-only JSON API for areas, agencies, posts and comments.
+
+Rows are read with values() and serialized straight from the dicts, never
+as model instances. Every response carries a strong ETag computed from the
+ids and updated_at of the rows it holds, read with one narrow query, so a
+client that sends it back in If-None-Match gets 304 Not Modified before the
+page itself is read and serialized.
+"""
+import hashlib
+from collections import namedtuple
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import Http404, HttpResponseBadRequest, JsonResponse
+from django.views.decorators.http import condition, require_safe
+
+from .areas import area_registry
+from .instrumentation import query_budget
+from .models import Agency, Comment, Post
+from .pagination import MAX_ID, decode_cursor, encode_cursor, keyset_window
+from .storage import blob_storage
+
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+def _file_url(name):
+    return blob_storage.url(name) if name else None
+
+
+# API field -> (values() lookup, converter)
+AGENCY_FIELDS = {
+    "id": ("id", None),
+    "name": ("name", None),
+    "phone_number": ("phone_number", None),
+    "email": ("email", None),
+    "address": ("address", None),
+    "twitter": ("twitter", None),
+    "instagram": ("instagram", None),
+    "profile_picture": ("profile_picture", _file_url),
+    "verified": ("verification_id", lambda verification_id: verification_id is not None),
+    "posts_count": ("posts_count", None),
+    "members_count": ("members_count", None),
+    "last_posted_at": ("last_posted_at", None),
+    "created_at": ("created_at", None),
+    "updated_at": ("updated_at", None),
+}
+POST_FIELDS = {
+    "id": ("id", None),
+    "agency": ("agency_id", None),
+    "area": ("area_id", None),
+    "title": ("title", None),
+    "body": ("body", None),
+    "picture": ("picture", _file_url),
+    "comments_count": ("comments_count", None),
+    "listing_type": ("listing_type", None),
+    "property_type": ("property_type", None),
+    "price": ("price", None),
+    "size_sqm": ("size_sqm", None),
+    "created_at": ("created_at", None),
+    "updated_at": ("updated_at", None),
+}
+COMMENT_FIELDS = {
+    "id": ("id", None),
+    "post": ("post_id", None),
+    "parent": ("parent_id", None),
+    "depth": ("path", lambda path: path.count("/") - 1),
+    "user": ("user__username", None),
+    "message": ("message", None),
+    "created_at": ("created_at", None),
+    "updated_at": ("updated_at", None),
+}
+
+# Lists leave out the long text fields unless they are asked for.
+AGENCY_LIST_FIELDS = [field for field in AGENCY_FIELDS if field != "address"]
+POST_LIST_FIELDS = [field for field in POST_FIELDS if field != "body"]
+COMMENT_LIST_FIELDS = list(COMMENT_FIELDS)
+
+# Kept by signals with update(), which leaves updated_at alone.
+AGENCY_COUNTERS = ["posts_count", "members_count", "last_posted_at"]
+
+ApiQuery = namedtuple("ApiQuery", ["queryset", "fields", "cursor", "page_size"])
+
+
+def _positive_int(value, name):
+    # Larger numbers overflow the database's integers rather than match nothing.
+    if not value.isdigit() or not 1 <= int(value) <= MAX_ID:
+        raise ValueError(f"{name} must be a positive integer")
+    return int(value)
+
+
+def _fields(request, fields, default):
+    """The fields named in ?fields=, raises ValueError for unknown ones"""
+    if "fields" not in request.GET:
+        return default
+    names = [name for name in request.GET["fields"].split(",") if name]
+    unknown = [name for name in names if name not in fields]
+    if unknown or not names:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}. Choose from {', '.join(fields)}")
+    return names
+
+
+def _list_query(request, queryset, fields, default):
+    cursor = request.GET.get("cursor") or None
+    if cursor:
+        decode_cursor(cursor)
+    page_size = min(_positive_int(request.GET.get("limit", str(PAGE_SIZE)), "limit"), MAX_PAGE_SIZE)
+    return ApiQuery(queryset, _fields(request, fields, default), cursor, page_size)
+
+
+def _serialize(row, names, fields):
+    serialized = {}
+    for name in names:
+        lookup, convert = fields[name]
+        serialized[name] = convert(row[lookup]) if convert else row[lookup]
+    return serialized
+
+
+def _etag(request, rows):
+    # The path holds the filters, fields and cursor, the rows what is in the
+    # page now; a new, edited or deleted row changes the ids, a timestamp or
+    # the count.
+    digest = hashlib.sha256(request.get_full_path().encode())
+    digest.update(repr([(pk, updated_at.isoformat(), *counters) for pk, updated_at, *counters in rows]).encode())
+    return f"{len(rows)}-{digest.hexdigest()[:32]}"
+
+
+def _json(data):
+    return JsonResponse(data, encoder=DjangoJSONEncoder, json_dumps_params={"ensure_ascii": False})
+
+
+def api_list(build, fields, counters=()):
+    """Turns `build(request, **kwargs) -> ApiQuery` into a paginated list view.
+
+    `counters` are the fields that change without touching updated_at.
+    """
+
+    def etag(request, **kwargs):
+        try:
+            query = build(request, **kwargs)
+        except (ValueError, Http404):
+            return None
+        window = keyset_window(query.queryset, query.cursor, query.page_size)
+        return _etag(request, list(window.values_list("id", "updated_at", *counters)))
+
+    @require_safe
+    @condition(etag_func=etag)
+    def view(request, **kwargs):
+        try:
+            query = build(request, **kwargs)
+        except ValueError as error:
+            return HttpResponseBadRequest(str(error))
+        lookups = {fields[name][0] for name in query.fields} | {"id", "created_at"}
+        rows = list(keyset_window(query.queryset.values(*lookups), query.cursor, query.page_size))
+        next_cursor = None
+        if len(rows) > query.page_size:
+            rows = rows[:query.page_size]
+            next_query = request.GET.copy()
+            next_query["cursor"] = encode_cursor(rows[-1])
+            next_cursor = f"{request.path}?{next_query.urlencode()}"
+        return _json({"results": [_serialize(row, query.fields, fields) for row in rows], "next": next_cursor})
+
+    return view
+
+
+def api_detail(model, fields, key, counters=()):
+    """A view returning the row of `model` whose id is the URL argument `key`"""
+
+    def etag(request, **kwargs):
+        return _etag(request, list(model.objects.filter(pk=kwargs[key]).values_list("id", "updated_at", *counters)))
+
+    @require_safe
+    @condition(etag_func=etag)
+    def view(request, **kwargs):
+        try:
+            names = _fields(request, fields, list(fields))
+        except ValueError as error:
+            return HttpResponseBadRequest(str(error))
+        row = model.objects.filter(pk=kwargs[key]).values(*{fields[name][0] for name in names}).first()
+        if row is None:
+            raise Http404(f"{model._meta.verbose_name} does not exist")
+        return _json(_serialize(row, names, fields))
+
+    return view
+
+
+def agencies_query(request):
+    return _list_query(request, Agency.objects.all(), AGENCY_FIELDS, AGENCY_LIST_FIELDS)
+
+
+def posts_query(request):
+    queryset = Post.objects.all()
+    if "area" in request.GET:
+        queryset = queryset.filter(area_id=_positive_int(request.GET["area"], "area"))
+    if "agency" in request.GET:
+        queryset = queryset.filter(agency_id=_positive_int(request.GET["agency"], "agency"))
+    return _list_query(request, queryset, POST_FIELDS, POST_LIST_FIELDS)
+
+
+def comments_query(request, post_id):
+    if not Post.objects.filter(pk=post_id).exists():
+        raise Http404("Post does not exist")
+    return _list_query(request, Comment.objects.filter(post_id=post_id), COMMENT_FIELDS, COMMENT_LIST_FIELDS)
+
+
+# The ETag and the page are two queries, comments also check that the post exists.
+agencies = query_budget(2)(api_list(agencies_query, AGENCY_FIELDS, counters=AGENCY_COUNTERS))
+agency = query_budget(2)(api_detail(Agency, AGENCY_FIELDS, "agency_id", counters=AGENCY_COUNTERS))
+posts = query_budget(2)(api_list(posts_query, POST_FIELDS, counters=["comments_count"]))
+post = query_budget(2)(api_detail(Post, POST_FIELDS, "post_id", counters=["comments_count"]))
+comments = query_budget(4)(api_list(comments_query, COMMENT_FIELDS))
+
+
+def area_rows():
+    snapshot = area_registry.snapshot()
+    return [{"id": area_id, "name": name, "kind": snapshot.kinds[area_id], "parent": snapshot.parents[area_id]}
+            for area_id, name in snapshot.names.items()]
+
+
+def areas_etag(request):
+    # Served from the area registry, so neither a 304 nor a 200 queries.
+    return hashlib.sha256(repr(area_rows()).encode()).hexdigest()[:32]
+
+
+@query_budget(2)
+@require_safe
+@condition(etag_func=areas_etag)
+def areas(request):
+    return _json({"results": area_rows()})
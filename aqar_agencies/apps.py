@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class AqarAgenciesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'aqar_agencies'
+
+    def ready(self):
+        from . import signals
@@ -0,0 +1,151 @@
+import threading
+import time
+from collections import namedtuple
+
+from django.db import DEFAULT_DB_ALIAS, connection, transaction
+
+from . import cache
+from .normalization import normalize_arabic
+
+# How long a snapshot is served before its version is compared with the
+# shared one again, which is how areas changed by another worker get in.
+VERSION_CHECK_SECONDS = 1.0
+
+AreaSnapshot = namedtuple("AreaSnapshot", ["names", "ids", "paths", "kinds", "parents", "branches"])
+
+
+def path_ids(path):
+    """The ids in an area path, from the top-level area down"""
+    return [int(step) for step in path.split("/") if step]
+
+
+class AreaRegistry:
+    """Process-wide cache of the Area table.
+
+    Areas are read on nearly every page and change a few times a year, so the
+    whole table is kept in memory as dictionaries from id to name, path, kind
+    and parent, in tree order, and from normalized name to id. The snapshot
+    is dropped by the post_save/post_delete signals of Area and reloaded with
+    a single query on the next lookup.
+
+    The signals only reach the process that wrote, so the snapshot also
+    remembers the ("areas", "all") cache version it was loaded under, which
+    the signals bump for every process, and is reloaded when that moved.
+    The version is read at most once every VERSION_CHECK_SECONDS.
+
+    Inside a transaction the committed snapshot is served as well, unless the
+    transaction wrote an area itself: then it reads its own rows until it
+    commits, and the snapshot is dropped again once it does.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._version = None
+        self._checked_at = 0.0
+        self._local = threading.local()
+
+    def _load(self):
+        from .models import Area
+
+        # Read from the primary: a snapshot taken from a replica that lags
+        # behind the write that invalidated it would be kept until the next one.
+        rows = list(Area.objects.using(DEFAULT_DB_ALIAS).values_list(
+            "id", "name", "normalized_name", "path", "kind", "parent_id"))
+        names = {area_id: name for area_id, name, *_ in rows}
+        # Every area comes right after its parent, siblings by name.
+        rows.sort(key=lambda row: [names.get(area_id, "") for area_id in path_ids(row[3])])
+        snapshot = AreaSnapshot({}, {}, {}, {}, {}, set())
+        for area_id, name, _, path, kind, parent_id in rows:
+            snapshot.names[area_id] = name
+            snapshot.paths[area_id] = path
+            snapshot.kinds[area_id] = kind
+            snapshot.parents[area_id] = parent_id
+            if parent_id is not None:
+                snapshot.branches.add(parent_id)
+        # A name shared by areas at several levels, such as a governorate and
+        # its main town, finds the highest one.
+        for area_id, _, normalized_name, path, *_ in sorted(rows, key=lambda row: (row[3].count("/"), row[0])):
+            snapshot.ids.setdefault(normalized_name, area_id)
+        return snapshot
+
+    def _written_in_transaction(self):
+        # The on_commit callback of the write is pending until the transaction
+        # commits, and is discarded with it, or its savepoint, on rollback.
+        written = getattr(self._local, "written", None)
+        return written is not None and any(callback is written for _, callback in connection.run_on_commit)
+
+    def snapshot(self):
+        if connection.in_atomic_block and self._written_in_transaction():
+            # Rows this transaction wrote may still be rolled back, so they
+            # are served but never kept.
+            return self._load()
+        snapshot = self._current()
+        if snapshot is not None:
+            return snapshot
+        with self._lock:
+            if self._snapshot is None:
+                # Read first, so that a bump during the load is not missed.
+                version, = cache.versions(("areas", "all"))
+                self._snapshot = self._load()
+                self._version, self._checked_at = version, time.monotonic()
+            return self._snapshot
+
+    def _current(self):
+        snapshot = self._snapshot
+        if snapshot is None or time.monotonic() - self._checked_at < VERSION_CHECK_SECONDS:
+            return snapshot
+        version, = cache.versions(("areas", "all"))
+        if version != self._version:
+            self._snapshot = None
+            return None
+        self._checked_at = time.monotonic()
+        return snapshot
+
+    def cached_snapshot(self):
+        """The snapshot if it can be served without a query, None otherwise"""
+        return self._current()
+
+    @property
+    def loaded(self):
+        """Whether lookups are answered from memory without a query"""
+        return self._current() is not None
+
+    def invalidate(self, **kwargs):
+        self._snapshot = None
+        if connection.in_atomic_block:
+            # Other threads may reload the committed rows in the meantime.
+            def written():
+                self._snapshot = None
+
+            self._local.written = written
+            transaction.on_commit(written)
+
+    def name(self, area_id):
+        return self.snapshot().names.get(area_id)
+
+    def id_for(self, name):
+        return self.snapshot().ids.get(normalize_arabic(name))
+
+    def path(self, area_id):
+        return self.snapshot().paths.get(area_id)
+
+    def lineage(self, area_id):
+        """Ids from the top-level area down to `area_id`, empty for an unknown id"""
+        path = self.path(area_id)
+        return path_ids(path) if path is not None else []
+
+    def choices(self):
+        """(id, name) of every area in tree order, names indented by depth"""
+        snapshot = self.snapshot()
+        return [(area_id, "\u00a0\u00a0" * (snapshot.paths[area_id].count("/") - 1) + name)
+                for area_id, name in snapshot.names.items()]
+
+    def __contains__(self, area_id):
+        return area_id in self.snapshot().names
+
+    def __len__(self):
+        return len(self.snapshot().names)
+
+
+area_registry = AreaRegistry()
@@ -0,0 +1,102 @@
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.safestring import mark_safe
+
+FRAGMENTS = ("index_areas", "agency_profile", "area_feed")
+
+
+def _version_key(scope, key):
+    return f"aqar:version:{scope}:{key}"
+
+
+def _stats_key(fragment, outcome):
+    return f"aqar:stats:{fragment}:{outcome}"
+
+
+def versions(*scopes):
+    """Current version counters of (scope, key) pairs such as ("agency", 3)"""
+    keys = [_version_key(scope, key) for scope, key in scopes]
+    found = cache.get_many(keys)
+    for cache_key in keys:
+        if cache_key not in found:
+            # A counter that was evicted restarts from the clock rather than
+            # from 1, so it can never reach a number that was used before.
+            cache.add(cache_key, time.time_ns(), None)
+            found[cache_key] = cache.get(cache_key)
+    return [found[cache_key] for cache_key in keys]
+
+
+def _bump(cache_key):
+    try:
+        cache.incr(cache_key)
+    except ValueError:
+        cache.set(cache_key, time.time_ns(), None)
+
+
+def bump(scope, key):
+    """Invalidates every fragment rendered for (scope, key).
+
+    The counter moves now, for reads later in the same transaction, and again
+    on commit, so that a page rendered from the old rows by another request
+    while the transaction was open is not cached under the new version.
+    """
+    cache_key = _version_key(scope, key)
+    _bump(cache_key)
+    transaction.on_commit(lambda: _bump(cache_key))
+
+
+def _count(fragment, outcome):
+    if settings.AQAR_PAGE_CACHE_METRICS:
+        cache_key = _stats_key(fragment, outcome)
+        if not cache.add(cache_key, 1, None):
+            try:
+                cache.incr(cache_key)
+            except ValueError:
+                pass
+
+
+def _fragment_key(fragment, scopes, vary):
+    parts = [str(version) for version in versions(*scopes)] + [str(value) for value in vary]
+    return f"aqar:fragment:{fragment}:" + ":".join(parts)
+
+
+def cached_fragment(fragment, scopes, render, vary=()):
+    """Returns the HTML `render()` produced for the current versions of `scopes`"""
+    cache_key = _fragment_key(fragment, scopes, vary)
+    html = cache.get(cache_key)
+    if html is None:
+        _count(fragment, "misses")
+        html = str(render())
+        cache.set(cache_key, html, settings.AQAR_PAGE_CACHE_TIMEOUT)
+    else:
+        _count(fragment, "hits")
+    return mark_safe(html)
+
+
+async def acached_fragment(fragment, scopes, render, vary=()):
+    """cached_fragment() for async views, only a miss leaves the event loop to run `render()`"""
+    cache_key = _fragment_key(fragment, scopes, vary)
+    html = cache.get(cache_key)
+    if html is None:
+        _count(fragment, "misses")
+        html = str(await sync_to_async(render)())
+        cache.set(cache_key, html, settings.AQAR_PAGE_CACHE_TIMEOUT)
+    else:
+        _count(fragment, "hits")
+    return mark_safe(html)
+
+
+def stats():
+    """{fragment: (hits, misses)} since the counters were last reset"""
+    keys = [_stats_key(fragment, outcome) for fragment in FRAGMENTS for outcome in ("hits", "misses")]
+    found = cache.get_many(keys)
+    return {fragment: (found.get(_stats_key(fragment, "hits"), 0), found.get(_stats_key(fragment, "misses"), 0))
+            for fragment in FRAGMENTS}
+
+
+def reset_stats():
+    cache.delete_many([_stats_key(fragment, outcome) for fragment in FRAGMENTS for outcome in ("hits", "misses")])
@@ -0,0 +1,112 @@
+"""Compression of the pages and API responses.
+
+Arabic text takes two bytes per character in UTF-8 and compresses well.
+CompressionMiddleware picks brotli when the brotli package is installed
+and the client accepts it, gzip otherwise. Smaller bodies get a higher
+level, since compressing them costs little. Streaming responses are
+compressed chunk by chunk, flushing each one, so they are never buffered.
+Compressed bodies are not cached: pages carry a CSRF token or the user's
+name and are unique per response, so such a cache would rarely hit and
+would only push the page fragments out of the default cache.
+
+Compressing a page that shows a secret next to text the visitor controls
+can leak the secret through the compressed size (BREACH). Django masks
+the CSRF token differently on every response, which covers the secret
+these pages carry.
+"""
+import gzip
+import re
+import zlib
+
+from django.utils.cache import patch_vary_headers
+
+from .middleware import AsyncCapableMiddleware
+from .staticfiles import accepted_encodings, brotli
+
+COMPRESSIBLE_TYPES = re.compile(r"^(text/|application/(json|javascript|xml|xhtml\+xml)|image/svg\+xml)")
+MIN_SIZE = 200
+# (largest body, gzip level, brotli quality), bigger bodies get cheaper levels.
+LEVELS = [(16 * 1024, 9, 6), (128 * 1024, 6, 5), (None, 4, 4)]
+STREAMING_LEVELS = (5, 4)
+
+
+def levels_for(size):
+    for largest, gzip_level, brotli_quality in LEVELS:
+        if largest is None or size <= largest:
+            return gzip_level, brotli_quality
+
+
+def compress_bytes(data, encoding, level):
+    if encoding == "br":
+        return brotli.compress(data, quality=level)
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def compress_chunks(chunks, encoding, level):
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=level)
+        for chunk in chunks:
+            output = compressor.process(chunk) + compressor.flush()
+            if output:
+                yield output
+        yield compressor.finish()
+        return
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        output = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if output:
+            yield output
+    yield compressor.flush()
+
+
+def choose_encoding(request):
+    accepted = accepted_encodings(request.META.get("HTTP_ACCEPT_ENCODING", ""))
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+class CompressionMiddleware(AsyncCapableMiddleware):
+    """Compresses text responses with brotli or gzip, see the module docstring"""
+
+    def handle(self, request):
+        return self.compress(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return self.compress(request, await self.get_response(request))
+
+    def compress(self, request, response):
+        if (response.has_header("Content-Encoding") or response.status_code not in (200, 201, 203)
+                or not COMPRESSIBLE_TYPES.match(response.get("Content-Type", ""))):
+            return response
+        # Caches must keep the compressed and plain bodies apart.
+        patch_vary_headers(response, ("Accept-Encoding",))
+        encoding = choose_encoding(request)
+        if encoding is None:
+            return response
+
+        if response.streaming:
+            if response.has_header("Content-Length") and int(response["Content-Length"]) < MIN_SIZE:
+                return response
+            level = STREAMING_LEVELS[encoding == "br"]
+            response.streaming_content = compress_chunks(response.streaming_content, encoding, level)
+            del response["Content-Length"]
+        else:
+            if len(response.content) < MIN_SIZE:
+                return response
+            level = levels_for(len(response.content))[encoding == "br"]
+            compressed = compress_bytes(response.content, encoding, level)
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response["Content-Length"] = str(len(compressed))
+
+        # The bytes differ, but they mean the same thing, so the ETag only
+        # becomes weak and If-None-Match still matches it.
+        etag = response.get("ETag")
+        if etag and etag.startswith('"'):
+            response["ETag"] = f"W/{etag}"
+        response["Content-Encoding"] = encoding
+        return response
@@ -0,0 +1,173 @@
+"""Post counts for the faceted listing search, kept in FacetCount.
+
+Each FacetCount row counts the posts of one area with one listing type,
+property type and price band. The Post signals move a post from row to row
+with single UPDATE statements in the transaction that saves or deletes it,
+so facet_counts() adds up a few of these rows instead of grouping the
+posts. bulk_create and queryset update() send no signals, so code that uses
+them calls recompute() for the areas it touched, and drift() finds the rows
+that no longer match the posts.
+"""
+from collections import namedtuple
+
+from django.db import IntegrityError, transaction
+from django.db.models import Case, Count, F, PositiveSmallIntegerField, Sum, Value, When
+
+from .areas import area_registry, path_ids
+from .models import Area, FacetCount, Post
+
+# The Post fields that decide which row counts a post.
+CELL_FIELDS = ("area_id", "listing_type", "property_type", "price")
+FACETS = ("area", "listing_type", "property_type", "price_band")
+
+FacetValue = namedtuple("FacetValue", ["value", "label", "count"])
+Facets = namedtuple("Facets", ["total", *FACETS])
+Drift = namedtuple("Drift", ["area_id", "listing_type", "property_type", "price_band", "stored", "actual"])
+
+
+def cell(values):
+    """The FacetCount lookup of a post whose CELL_FIELDS are in `values`"""
+    return {"area_id": values["area_id"], "listing_type": values["listing_type"],
+            "property_type": values["property_type"], "price_band": Post.price_band(values["price"])}
+
+
+def _values(post):
+    return {field: getattr(post, field) for field in CELL_FIELDS}
+
+
+def _remember(post):
+    # The next save compares with what this one wrote, not with what was read.
+    post._loaded_values = {**getattr(post, "_loaded_values", {}), **_values(post)}
+
+
+def _add(lookup, delta):
+    if FacetCount.objects.filter(**lookup).update(count=F("count") + delta) or delta < 0:
+        return
+    try:
+        with transaction.atomic():
+            FacetCount.objects.create(count=delta, **lookup)
+    except IntegrityError:
+        # Another transaction created the row since the update.
+        FacetCount.objects.filter(**lookup).update(count=F("count") + delta)
+
+
+def post_added(post):
+    _add(cell(_values(post)), 1)
+    _remember(post)
+
+
+def post_changed(post):
+    loaded = getattr(post, "_loaded_values", {})
+    if not all(field in loaded for field in CELL_FIELDS):
+        # Saved without being read first, so where it was counted is unknown.
+        recompute([post.area_id])
+    else:
+        old, new = cell(loaded), cell(_values(post))
+        if old != new:
+            _add(old, -1)
+            _add(new, 1)
+    _remember(post)
+
+
+def post_removed(post):
+    loaded = getattr(post, "_loaded_values", {})
+    _add(cell(loaded if all(field in loaded for field in CELL_FIELDS) else _values(post)), -1)
+
+
+def price_band_expression():
+    """Post.price_band() as an SQL expression"""
+    bands = [When(price__gte=low, then=Value(band)) for band, low in enumerate(Post.PRICE_BANDS, start=1)]
+    return Case(*reversed(bands), default=Value(Post.NO_PRICE), output_field=PositiveSmallIntegerField())
+
+
+def actual_counts(area_ids=None):
+    """(area_id, listing_type, property_type, price_band) -> count, grouped from the posts"""
+    posts = Post.objects.order_by()
+    if area_ids is not None:
+        posts = posts.filter(area_id__in=list(area_ids))
+    rows = posts.annotate(band=price_band_expression()).values(
+        "area_id", "listing_type", "property_type", "band").annotate(posts=Count("pk"))
+    return {(row["area_id"], row["listing_type"], row["property_type"], row["band"]): row["posts"] for row in rows}
+
+
+def _replace(area_ids, counts):
+    rows = FacetCount.objects.all() if area_ids is None else FacetCount.objects.filter(area_id__in=area_ids)
+    rows.delete()
+    FacetCount.objects.bulk_create([
+        FacetCount(area_id=area_id, listing_type=listing_type, property_type=property_type, price_band=band,
+                   count=count)
+        for (area_id, listing_type, property_type, band), count in counts.items()])
+
+
+def recompute(area_ids):
+    """Rebuilds the rows of the given areas from their posts"""
+    area_ids = list(area_ids)
+    with transaction.atomic():
+        _replace(area_ids, actual_counts(area_ids))
+
+
+def rebuild():
+    """Rebuilds every row from the posts, returns how many rows there are"""
+    counts = actual_counts()
+    with transaction.atomic():
+        _replace(None, counts)
+    return len(counts)
+
+
+def drift():
+    """Yields a Drift for each row that differs from the posts, rows of zero posts left out"""
+    stored = {(row.area_id, row.listing_type, row.property_type, row.price_band): row.count
+              for row in FacetCount.objects.filter(count__gt=0)}
+    actual = actual_counts()
+    for key in sorted(stored.keys() | actual.keys()):
+        if stored.get(key, 0) != actual.get(key, 0):
+            yield Drift(*key, stored.get(key, 0), actual.get(key, 0))
+
+
+def _rows(snapshot, area_id, filters):
+    rows = FacetCount.objects.filter(count__gt=0, **{name: value for name, value in filters.items()
+                                                      if value is not None})
+    if area_id is None:
+        return rows
+    if area_id not in snapshot.branches:
+        return rows.filter(area_id=area_id)
+    low, high = Area.subtree_bounds(snapshot.paths[area_id])
+    return rows.filter(area__path__gte=low, area__path__lt=high)
+
+
+def _totals(rows, facet):
+    return dict(rows.values_list(facet).annotate(posts=Sum("count")).order_by())
+
+
+def facet_counts(area_id=None, listing_type=None, property_type=None, price_band=None):
+    """The posts matching the filters and, for each facet, how many each of its values would leave.
+
+    The counts of a facet apply every filter but its own, so that choosing
+    "For rent" still shows how many posts are for sale. The area facet
+    lists the areas right under `area_id`, or the top-level areas.
+    """
+    filters = {"listing_type": listing_type, "property_type": property_type, "price_band": price_band}
+    snapshot = area_registry.snapshot()
+    depth = len(path_ids(snapshot.paths.get(area_id, ""))) if area_id is not None else 0
+
+    total = 0
+    areas = {}
+    for leaf_id, posts in _totals(_rows(snapshot, area_id, filters), "area_id").items():
+        total += posts
+        lineage = path_ids(snapshot.paths.get(leaf_id, ""))
+        if len(lineage) > depth:
+            areas[lineage[depth]] = areas.get(lineage[depth], 0) + posts
+
+    def others(facet, choices):
+        totals = _totals(_rows(snapshot, area_id, {**filters, facet: None}), facet)
+        return [FacetValue(value, label, totals[value]) for value, label in choices if totals.get(value)]
+
+    bands = [(band, Post.band_label(band)) for band in range(1, len(Post.PRICE_BANDS) + 1)]
+    return Facets(
+        total=total,
+        area=[FacetValue(child_id, name, areas[child_id]) for child_id, name in snapshot.names.items()
+              if child_id in areas],
+        listing_type=others("listing_type", Post.LISTING_TYPES),
+        property_type=others("property_type", Post.PROPERTY_TYPES),
+        price_band=others("price_band", bands),
+    )
@@ -1,6 +1,20 @@
 from django import forms
 from django.forms.fields import ChoiceField, MultipleChoiceField
-from .models import Agency, AgencyMember
+from .areas import area_registry
+from .models import Post
+
+class AreaChoiceField(forms.TypedChoiceField):
+    """Choice field over all areas, served from the area registry instead of a query"""
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault("choices", self.area_choices)
+        kwargs.setdefault("coerce", int)
+        kwargs.setdefault("empty_value", None)
+        super().__init__(**kwargs)
+
+    def area_choices(self):
+        blank = [] if self.required else [("", "All areas")]
+        return blank + area_registry.choices()
 
 class AgencyCreateForm(forms.Form):
     name = forms.CharField()
@@ -12,12 +26,30 @@ class AgencyCreateForm(forms.Form):
     instagram = forms.CharField(max_length=50, required=False)
 
 class AgencyChoiceForm(forms.Form):
-    agency = forms.ModelChoiceField(queryset=AgencyMember.objects.none(), required=True, label= "Agency Choice")
+    agency = forms.TypedChoiceField(coerce=int, required=True, label= "Agency Choice")
 
     def __init__(self, *args, **kwargs):
         agency_memberships = kwargs.pop("agency_memberships", None)
-        super(AgencyChoiceForm, self).__init__()
+        super(AgencyChoiceForm, self).__init__(*args, **kwargs)
+
+        if agency_memberships is not None:
+            self.fields["agency"].choices = lambda: [
+                (membership.agency_id, str(membership)) for membership in agency_memberships]
+
+class PostSearchForm(forms.Form):
+    q = forms.CharField(max_length=100, label="Search")
+    area = AreaChoiceField(required=False)
 
-        if agency_memberships:
-            self.fields["agency"].queryset = agency_memberships
-        
\ No newline at end of file
+class ListingSearchForm(forms.Form):
+    area = AreaChoiceField(required=False)
+    listing_type = forms.TypedChoiceField(choices=[("", "Sale or rent")] + Post.LISTING_TYPES, empty_value=None,
+                                          required=False)
+    property_type = forms.TypedChoiceField(choices=[("", "Any property")] + Post.PROPERTY_TYPES, empty_value=None,
+                                           required=False)
+    price_band = forms.TypedChoiceField(
+        choices=[("", "Any price")] + [(band, Post.band_label(band)) for band in range(1, len(Post.PRICE_BANDS) + 1)],
+        coerce=int, empty_value=None, required=False, label="Price")
+    min_size = forms.IntegerField(min_value=0, required=False, label="From (m²)")
+    max_size = forms.IntegerField(min_value=0, required=False, label="To (m²)")
+    sort = forms.TypedChoiceField(choices=[("newest", "Newest"), ("price", "Lowest price"), ("-price", "Highest price")],
+                                  empty_value="newest", required=False)
@@ -0,0 +1,112 @@
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from PIL import Image, ImageOps, features
+
+from .storage import blob_digest
+
+logger = logging.getLogger(__name__)
+
+VARIANT_WIDTHS = (320, 640, 1024)
+VARIANT_DIR = "variants"
+UPLOAD_DIRS = ("blobs/", "posts/", "profile_picture/")
+
+# WebP needs libwebp in the Pillow build, JPEG is always available.
+VARIANT_FORMATS = {"jpeg": "JPEG"}
+if features.check("webp"):
+    VARIANT_FORMATS = {"webp": "WEBP", **VARIANT_FORMATS}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def upload_storage():
+    from .models import Post
+    return Post._meta.get_field("picture").storage
+
+
+def variant_storage():
+    # Variants are already named by content, so they skip the blob storage.
+    return default_storage
+
+
+@lru_cache(maxsize=4096)
+def source_digest(name):
+    """sha256 of an uploaded file, the key its variants are stored under"""
+    if blob_digest(name):
+        return blob_digest(name)[:32]
+    digest = hashlib.sha256()
+    with upload_storage().open(name) as source:
+        for chunk in source.chunks():
+            digest.update(chunk)
+    return digest.hexdigest()[:32]
+
+
+def variant_name(name, width, fmt):
+    digest = source_digest(name)
+    return f"{VARIANT_DIR}/{digest[:2]}/{digest}-{width}.{fmt}"
+
+
+def _render_variant(image, width, fmt):
+    variant = image.copy()
+    variant.thumbnail((width, width * 4))
+    if VARIANT_FORMATS[fmt] == "JPEG" and variant.mode != "RGB":
+        variant = variant.convert("RGB")
+    buffer = BytesIO()
+    # Nothing is passed as exif=, so the variants carry no EXIF metadata.
+    variant.save(buffer, format=VARIANT_FORMATS[fmt], quality=80, optimize=True)
+    return buffer.getvalue()
+
+
+def generate_variants(name, widths=VARIANT_WIDTHS, formats=None):
+    """Writes the missing variants of an upload and returns their names"""
+    storage = variant_storage()
+    formats = formats or list(VARIANT_FORMATS)
+    missing = [(width, fmt) for width in widths for fmt in formats
+               if not storage.exists(variant_name(name, width, fmt))]
+    if missing:
+        with upload_storage().open(name) as source:
+            image = ImageOps.exif_transpose(Image.open(source))
+            image.load()
+        for width, fmt in missing:
+            storage.save(variant_name(name, width, fmt), ContentFile(_render_variant(image, width, fmt)))
+    return [variant_name(name, width, fmt) for width in widths for fmt in formats]
+
+
+def ensure_variant(name, width, fmt):
+    return generate_variants(name, widths=[width], formats=[fmt])[0]
+
+
+def _generate_in_background(name):
+    try:
+        generate_variants(name)
+    except Exception:
+        logger.exception("Could not generate image variants for %s", name)
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.AQAR_IMAGE_WORKERS,
+                                           thread_name_prefix="aqar-images")
+        return _executor
+
+
+def schedule_variants(image):
+    """Queues variant generation for an uploaded image once the transaction commits"""
+    if not image:
+        return
+    name = image.name
+    if settings.AQAR_IMAGE_WORKERS:
+        transaction.on_commit(lambda: _get_executor().submit(_generate_in_background, name))
+    else:
+        transaction.on_commit(lambda: _generate_in_background(name))
@@ -0,0 +1,250 @@
+import csv
+import json
+from collections import Counter
+from itertools import islice
+from pathlib import Path
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from . import cache, facets, search, stats
+from .areas import area_registry, path_ids
+from .models import Agency, AgencyMember, Area, Post
+from .normalization import normalize_arabic
+
+AGENCY_FIELDS = ("name", "phone_number", "email", "address", "twitter", "instagram")
+POST_FIELDS = ("title", "body")
+# Optional columns, blank for posts that do not give them.
+POST_ATTRIBUTES = ("listing_type", "property_type", "price", "size_sqm")
+KUWAIT_AREAS = Path(__file__).resolve().parent / "data" / "kuwait_areas.json"
+# The kind of an area that does not name one, by depth.
+AREA_KINDS = (Area.GOVERNORATE, Area.AREA, Area.BLOCK)
+
+
+def read_rows(path):
+    """Yields (row number, dict) for each record of a CSV or JSON Lines file.
+
+    A JSON line that is not an object comes with a ValueError instead of
+    the dict, which the importer reports as the row's error.
+    """
+    if str(path).endswith(".jsonl"):
+        with open(path, encoding="utf-8") as source:
+            number = 0
+            for line in source:
+                if line.strip():
+                    number += 1
+                    try:
+                        row = json.loads(line)
+                    except ValueError as error:
+                        yield number, ValueError(f"Invalid JSON: {error}")
+                        continue
+                    yield number, row if isinstance(row, dict) else ValueError("Expected a JSON object")
+    else:
+        with open(path, newline="", encoding="utf-8-sig") as source:
+            yield from enumerate(csv.DictReader(source), start=1)
+
+
+def error_message(error):
+    if isinstance(error, ValidationError):
+        return "; ".join(error.messages)
+    if isinstance(error, KeyError):
+        return f"Missing column {error}"
+    return str(error)
+
+
+class ListingImporter:
+    """Validates and inserts agencies or posts in chunks of one transaction each.
+
+    Rows are checked with the same rules as AgencyManager.new and
+    PostManager.new, but the agencies, areas and users they refer to are
+    looked up once per chunk instead of once per row, and posts are written
+    with bulk_create. Invalid rows are passed to `on_error` and skipped.
+    """
+
+    def __init__(self, kind, chunk_size=1000, on_error=None, on_chunk=None):
+        if kind not in ("agencies", "posts"):
+            raise ValueError(f"Unknown kind {kind}")
+        self.kind = kind
+        self.chunk_size = chunk_size
+        self.on_error = on_error or (lambda number, message: None)
+        self.on_chunk = on_chunk or (lambda last_number: None)
+        self.imported = 0
+        self.failed = 0
+        self.areas = None
+
+    def run(self, rows):
+        rows = iter(rows)
+        while True:
+            chunk = list(islice(rows, self.chunk_size))
+            if not chunk:
+                break
+            for number, row in chunk:
+                if isinstance(row, Exception):
+                    self.fail(number, row)
+            valid = [(number, row) for number, row in chunk if not isinstance(row, Exception)]
+            if self.kind == "posts":
+                self.import_posts(valid)
+            else:
+                self.import_agencies(valid)
+            self.on_chunk(chunk[-1][0])
+
+    def fail(self, number, error):
+        self.failed += 1
+        self.on_error(number, error_message(error))
+
+    def area_id(self, value):
+        if self.areas is None:
+            # Taken once: inside the import's transactions the registry would
+            # read the table again on every lookup.
+            self.areas = area_registry.snapshot()
+        value = str(value).strip()
+        if value.isdigit() and int(value) in self.areas.names:
+            return int(value)
+        if normalize_arabic(value) in self.areas.ids:
+            return self.areas.ids[normalize_arabic(value)]
+        raise ValidationError(f"Area {value} does not exist")
+
+    def import_posts(self, chunk):
+        agency_ids = {str(row.get("agency")).strip() for _, row in chunk}
+        agency_ids = set(Agency.objects.filter(
+            pk__in=[pk for pk in agency_ids if pk.isdigit()]).values_list("pk", flat=True))
+        posts = []
+        for number, row in chunk:
+            try:
+                fields = {field: row[field] for field in POST_FIELDS}
+                for field in POST_ATTRIBUTES:
+                    value = str(row.get(field) or "").strip()
+                    if value:
+                        fields[field] = int(value) if field in ("price", "size_sqm") else value
+                Post.objects.validate(**fields)
+                agency_id = int(row["agency"])
+                if agency_id not in agency_ids:
+                    raise ValidationError(f"Agency {agency_id} does not exist")
+                posts.append(Post(agency_id=agency_id, area_id=self.area_id(row["area"]), **fields))
+            except (KeyError, TypeError, ValueError, ValidationError) as error:
+                self.fail(number, error)
+
+        with transaction.atomic():
+            # bulk_create does not return primary keys on SQLite, so the new
+            # rows are found again as the ones above the current highest id.
+            last_pk = Post.objects.order_by("-pk").values_list("pk", flat=True).first() or 0
+            Post.objects.bulk_create(posts)
+            if search.is_supported():
+                search.index_rows(Post.objects.filter(pk__gt=last_pk).values_list("id", "title", "body", "area_id"))
+            # bulk_create sends no signals, so the agency counters, the facet
+            # counts and the cached pages are brought up to date here.
+            stats.recompute({post.agency_id for post in posts})
+            facets.recompute({post.area_id for post in posts})
+            for agency_id in {post.agency_id for post in posts}:
+                cache.bump("agency", agency_id)
+            for area_id in {lineage_id for post in posts for lineage_id in path_ids(self.areas.paths[post.area_id])}:
+                cache.bump("area", area_id)
+        self.imported += len(posts)
+
+    def import_agencies(self, chunk):
+        owners = dict(User.objects.filter(
+            username__in=[row.get("owner") for _, row in chunk]).values_list("username", "pk"))
+        agencies = []
+        for number, row in chunk:
+            try:
+                fields = {field: row.get(field) or "" for field in AGENCY_FIELDS}
+                Agency.objects.validate(**fields)
+                if row.get("owner") not in owners:
+                    raise ValidationError(f"User {row.get('owner')} does not exist")
+                agency = Agency(**fields)
+                # What Agency.save() checks, which bulk_create does not call.
+                agency.full_clean()
+                agencies.append((agency, owners[row["owner"]]))
+            except (TypeError, ValidationError) as error:
+                self.fail(number, error)
+
+        with transaction.atomic():
+            # As for posts, the new rows are the ones above the highest id,
+            # and they come back in the order they were inserted.
+            last_pk = Agency.objects.order_by("-pk").values_list("pk", flat=True).first() or 0
+            Agency.objects.bulk_create([agency for agency, _ in agencies])
+            agency_ids = list(Agency.objects.filter(pk__gt=last_pk).order_by("pk").values_list("pk", flat=True))
+            AgencyMember.objects.bulk_create([AgencyMember(agency_id=agency_id, member_id=owner_id, is_admin=True)
+                                              for agency_id, (_, owner_id) in zip(agency_ids, agencies)])
+            # bulk_create sends no signals: the counters and the owners'
+            # membership lists, kept in their sessions, are updated here.
+            stats.recompute(agency_ids)
+            for owner_id in {owner_id for _, owner_id in agencies}:
+                cache.bump("memberships", owner_id)
+        self.imported += len(agencies)
+
+
+def load_area_tree(nodes, parent=None, set_aside=None):
+    """Creates the missing areas of a tree of {"name", "kind", "children", "blocks"} nodes.
+
+    "blocks": n adds blocks 1 to n under an area. Areas already under the
+    same parent are kept, and a top-level area from before the hierarchy
+    that has the name of an area of the tree is moved into its place, with
+    its posts; into the deepest one when the name repeats down a branch, as
+    for a governorate named after its main town. Returns a Counter of the
+    areas created, moved and updated.
+    """
+    counts = Counter()
+    set_aside = {} if set_aside is None else set_aside
+    depth = parent.depth + 1 if parent is not None else 0
+    for node in nodes:
+        kind = node.get("kind") or AREA_KINDS[min(depth, len(AREA_KINDS) - 1)]
+        children = list(node.get("children", []))
+        children += [{"name": f"قطعة {number}", "kind": Area.BLOCK} for number in range(1, node.get("blocks", 0) + 1)]
+        deepest = normalize_arabic(node["name"]) not in _names_below(children)
+        area = _place_area(node["name"], kind, parent, counts, deepest, set_aside)
+        counts.update(load_area_tree(children, area, set_aside))
+    return counts
+
+
+def _names_below(nodes):
+    names = set()
+    for node in nodes:
+        names.add(normalize_arabic(node["name"]))
+        names |= _names_below(node.get("children", []))
+    return names
+
+
+def _place_area(name, kind, parent, counts, deepest, set_aside):
+    normalized_name = normalize_arabic(name)
+    area = Area.objects.filter(parent=parent, normalized_name=normalized_name).first()
+    if area is not None and parent is None and area.kind != kind and not deepest:
+        # The flat area belongs to the deeper node of the same name. Its name
+        # is freed for this one until it is moved there, which saves it again.
+        Area.objects.filter(pk=area.pk).update(normalized_name=f"#{area.pk}")
+        set_aside[normalized_name] = area
+        area = None
+    elif area is None and parent is not None and deepest:
+        area = set_aside.pop(normalized_name, None) or Area.objects.filter(
+            parent=None, normalized_name=normalized_name).exclude(kind=Area.GOVERNORATE).first()
+        if area is not None:
+            area.parent = parent
+            area.kind = kind
+            area.save()
+            counts["moved"] += 1
+            return area
+    if area is None:
+        counts["created"] += 1
+        return Area.objects.new(name=name, kind=kind, parent=parent)
+    if area.kind != kind:
+        area.kind = kind
+        area.save()
+        counts["updated"] += 1
+    return area
+    if area is None:
+        counts["created"] += 1
+        return Area.objects.new(name=name, kind=kind, parent=parent)
+    if area.kind != kind:
+        area.kind = kind
+        area.save()
+        counts["updated"] += 1
+    return area
+    if area is None:
+        counts["created"] += 1
+        return Area.objects.new(name=name, kind=kind, parent=parent)
+    if area.kind != kind:
+        area.kind = kind
+        area.save()
+        counts["updated"] += 1
+    return area
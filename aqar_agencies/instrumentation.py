@@ -0,0 +1,255 @@
+"""Query counts, SQL time and template render time per request.
+
+A QueryRecorder sees every statement run on any connection while it is
+active, including the ones async views hand to sync_to_async threads: the
+execute wrapper installed on each connection looks the recorder up in a
+context variable, which asgiref copies into those threads.
+RequestMetricsMiddleware records each request, reports it in a
+Server-Timing header and a log line, and flags the ones that are slow or
+run more queries than their view's query_budget.
+"""
+import contextvars
+import logging
+import threading
+import time
+from collections import Counter, namedtuple
+
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+from django.template.base import Template
+
+from .middleware import AsyncCapableMiddleware
+
+logger = logging.getLogger("aqar_agencies.requests")
+
+_recorder = contextvars.ContextVar("aqar_query_recorder", default=None)
+_template_timer = contextvars.ContextVar("aqar_template_timer", default=None)
+
+RequestStats = namedtuple("RequestStats", [
+    "method", "path", "view", "status", "total_ms", "queries", "sql_ms", "duplicates", "budget", "template_ms"])
+
+
+def query_budget(queries):
+    """Declares the most queries a view may run for one request, checked by the tests.
+
+    Count every query of the request, the session and user lookups included,
+    with the page cache empty.
+    """
+    def decorate(view):
+        view.query_budget = queries
+        return view
+    return decorate
+
+
+def record_query(execute, sql, params, many, context):
+    recorder = _recorder.get()
+    if recorder is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        recorder.record(sql, params, time.perf_counter() - started)
+
+
+def install(connection):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class QueryRecorder:
+    """Counts and times the SQL run inside `with QueryRecorder() as recorder:`
+
+    Recorders nest, the statements seen by an inner one also count in the
+    outer ones. With `timeline`, `recorder.timeline` lists the (sql, seconds)
+    of each statement in the order they ran.
+    """
+
+    def __init__(self, timeline=False):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = Counter()
+        self.timeline = [] if timeline else None
+        self._lock = threading.Lock()
+        self._parent = None
+        self._token = None
+
+    def __enter__(self):
+        # Connections opened later get the wrapper from the connection_created signal.
+        for connection in connections.all():
+            install(connection)
+        self._parent = _recorder.get()
+        self._token = _recorder.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _recorder.reset(self._token)
+
+    def record(self, sql, params, seconds):
+        with self._lock:
+            self.count += 1
+            self.seconds += seconds
+            self.statements[sql, repr(params)] += 1
+            if self.timeline is not None:
+                self.timeline.append((sql, seconds))
+        if self._parent is not None:
+            self._parent.record(sql, params, seconds)
+
+    @property
+    def sql_ms(self):
+        return self.seconds * 1000
+
+    @property
+    def duplicates(self):
+        """Queries that ran again with the same SQL and parameters"""
+        return sum(count - 1 for count in self.statements.values())
+
+    def repeated(self, at_least=2):
+        """SQL run at least `at_least` times with any parameters, the shape of an N+1, most frequent first"""
+        by_sql = Counter()
+        for (sql, _), count in self.statements.items():
+            by_sql[sql] += count
+        return [(sql, count) for sql, count in by_sql.most_common() if count >= at_least]
+
+
+class TemplateTimer:
+    """Render times of the templates rendered inside `with TemplateTimer() as timer:`
+
+    `timer.timings` lists (name, ms, depth) innermost first, depth 0 being
+    a template rendered by the view itself rather than extended or included
+    by another one. Timers nest like QueryRecorder.
+    """
+
+    def __init__(self):
+        self.timings = []
+        self.depth = 0
+        self._parent = None
+        self._token = None
+
+    def __enter__(self):
+        self._parent = _template_timer.get()
+        self._token = _template_timer.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _template_timer.reset(self._token)
+
+    def record(self, name, ms, depth):
+        self.timings.append((name, ms, depth))
+        if self._parent is not None:
+            self._parent.record(name, ms, depth)
+
+    @property
+    def total_ms(self):
+        return sum(ms for _, ms, depth in self.timings if depth == 0)
+
+    def slowest(self, count=3):
+        """The (name, ms) of the templates that took longest, their inner templates included"""
+        by_name = Counter()
+        for name, ms, _ in self.timings:
+            by_name[name] += ms
+        return by_name.most_common(count)
+
+
+@contextmanager
+def timed_template(name):
+    """Times the rendering of template `name` inside the block for the active TemplateTimer"""
+    timer = _template_timer.get()
+    if timer is None:
+        yield
+        return
+    started = time.perf_counter()
+    timer.depth += 1
+    try:
+        yield
+    finally:
+        timer.depth -= 1
+        timer.record(name, (time.perf_counter() - started) * 1000, timer.depth)
+
+
+def _timed(render):
+    def timed_render(template, context):
+        if _template_timer.get() is None:
+            return render(template, context)
+        with timed_template(template.name or "<string>"):
+            return render(template, context)
+
+    timed_render.aqar_timed = True
+    return timed_render
+
+
+def time_templates():
+    """Wraps Template._render so that TemplateTimer sees the Django templates"""
+    # Checked on every middleware instance because the test runner swaps
+    # _render for its own instrumented version and back.
+    if not getattr(Template._render, "aqar_timed", False):
+        Template._render = _timed(Template._render)
+
+
+class RequestMetricsMiddleware(AsyncCapableMiddleware):
+    """Records the queries and templates of each request and reports them.
+
+    Sets request.query_stats, adds a Server-Timing header when
+    AQAR_SERVER_TIMING is on, and logs a line to aqar_agencies.requests with
+    the figures in the record's `request_stats`. Requests slower than
+    AQAR_SLOW_REQUEST_MS or over their view's query budget are logged as
+    warnings, with the most repeated SQL and the slowest templates.
+    """
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        time_templates()
+
+    def handle(self, request):
+        started = time.perf_counter()
+        with QueryRecorder() as recorder, TemplateTimer() as timer:
+            response = self.get_response(request)
+        return self.report(request, response, recorder, timer, started)
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        with QueryRecorder() as recorder, TemplateTimer() as timer:
+            response = await self.get_response(request)
+        return self.report(request, response, recorder, timer, started)
+
+    def report(self, request, response, recorder, timer, started):
+        total_ms = (time.perf_counter() - started) * 1000
+        match = request.resolver_match
+        stats = RequestStats(
+            method=request.method,
+            path=request.path,
+            view=match.view_name if match else None,
+            status=response.status_code,
+            total_ms=round(total_ms, 1),
+            queries=recorder.count,
+            sql_ms=round(recorder.sql_ms, 1),
+            duplicates=recorder.duplicates,
+            budget=getattr(match.func, "query_budget", None) if match else None,
+            template_ms=round(timer.total_ms, 1),
+        )
+        request.query_stats = stats
+
+        if settings.AQAR_SERVER_TIMING:
+            timing = (f'db;dur={stats.sql_ms};desc="{stats.queries} queries", tpl;dur={stats.template_ms}, '
+                      f'total;dur={stats.total_ms}')
+            if response.has_header("Server-Timing"):
+                timing = f"{response['Server-Timing']}, {timing}"
+            response["Server-Timing"] = timing
+
+        slow = total_ms >= settings.AQAR_SLOW_REQUEST_MS
+        over_budget = stats.budget is not None and stats.queries > stats.budget
+        message = (f"{stats.method} {stats.path} {stats.status} view={stats.view} total_ms={stats.total_ms} "
+                   f"queries={stats.queries} sql_ms={stats.sql_ms} duplicates={stats.duplicates} "
+                   f"template_ms={stats.template_ms}")
+        if slow or over_budget:
+            flags = ["slow"] * slow + [f"over_budget={stats.budget}"] * over_budget
+            repeated = "; ".join(f"{count}x {sql}" for sql, count in recorder.repeated()[:3])
+            templates = ", ".join(f"{name} {ms:.1f}ms" for name, ms in timer.slowest())
+            logger.warning("%s %s%s%s", message, " ".join(flags), f" repeated: {repeated}" if repeated else "",
+                           f" templates: {templates}" if templates and slow else "",
+                           extra={"request_stats": stats._asdict()})
+        else:
+            logger.info(message, extra={"request_stats": stats._asdict()})
+        return response
@@ -0,0 +1,24 @@
+"""The Jinja2 environment of the listing templates in aqar_agencies/jinja2"""
+from django.template.defaultfilters import pluralize, timesince_filter, urlencode
+from django.urls import reverse
+from django.utils.formats import localize
+from django.utils.timezone import template_localtime
+from jinja2 import Environment
+
+from .templatetags.aqar_images import responsive_image
+
+
+def display(value):
+    """Dates and numbers printed like the Django templates print them, in the current time zone"""
+    return localize(template_localtime(value))
+
+
+def url(name, *args):
+    return reverse(name, args=args)
+
+
+def environment(**options):
+    env = Environment(finalize=display, **options)
+    env.globals.update(url=url, responsive_image=responsive_image)
+    env.filters.update(pluralize=pluralize, timesince=timesince_filter, urlencode=urlencode)
+    return env
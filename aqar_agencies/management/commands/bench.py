@@ -0,0 +1,202 @@
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import time
+import tracemalloc
+from collections import namedtuple
+from urllib.parse import urlencode
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+from django.test import Client
+from django.urls import reverse
+
+from aqar_agencies.areas import area_registry
+from aqar_agencies.instrumentation import QueryRecorder
+from aqar_agencies.management.commands.bench_asgi import use_scratch_files
+from aqar_agencies.models import Agency, AgencyMember, Post
+from aqar_agencies.pagination import encode_cursor
+from aqar_agencies.synthetic import DEFAULT_SIZES, SyntheticData
+
+Endpoint = namedtuple("Endpoint", ["name", "path", "user"])
+
+COLUMNS = ("p50", "p95", "p99", "mean", "queries", "duplicates", "sql_ms", "peak_kib", "bytes")
+
+
+def endpoints():
+    """The pages worth timing, on the busiest rows of the database"""
+    busiest_area_id = Post.objects.values("area").annotate(posts=Count("pk")).order_by("-posts").values_list(
+        "area", flat=True).first()
+    if busiest_area_id is None:
+        raise CommandError("There are no posts to benchmark, run seed_synthetic or pass --scratch.")
+    top_area_id = area_registry.lineage(busiest_area_id)[0]
+    agency = Agency.objects.order_by("-posts_count").first()
+    owner = User.objects.get(pk=AgencyMember.objects.filter(agency=agency, is_admin=True).values_list(
+        "member", flat=True)[0])
+    deep_row = Post.objects.area_feed(busiest_area_id).order_by("-created_at", "-id").values(
+        "created_at", "id")[199:200].first()
+    commented = Post.objects.order_by("-comments_count").values_list("pk", flat=True).first()
+    pictured = Post.objects.exclude(picture="").exclude(picture=None).values_list("picture", flat=True).first()
+
+    found = [
+        Endpoint("index", reverse("index"), None),
+        Endpoint("area_feed", reverse("area_feed", args=[busiest_area_id]), None),
+        Endpoint("area_feed_top", reverse("area_feed", args=[top_area_id]), None),
+        Endpoint("agency_profile", reverse("agency_profile"), owner),
+        Endpoint("search", f"{reverse('search')}?{urlencode({'q': 'شقة للبيع'})}", None),
+        Endpoint("search_area", f"{reverse('search')}?{urlencode({'q': 'شقة', 'area': top_area_id})}", None),
+        Endpoint("listings", reverse("listings"), None),
+        Endpoint("listings_area", f"{reverse('listings')}?"
+                                  f"{urlencode({'area': top_area_id, 'listing_type': 'rent', 'sort': 'price'})}", None),
+        Endpoint("api_posts", reverse("api_posts"), None),
+        Endpoint("api_posts_area", f"{reverse('api_posts')}?area={busiest_area_id}", None),
+        Endpoint("api_agency", reverse("api_agency", args=[agency.pk]), None),
+        Endpoint("api_comments", reverse("api_comments", args=[commented]), None),
+    ]
+    if deep_row:
+        found.insert(3, Endpoint("area_feed_deep", f"{reverse('area_feed', args=[busiest_area_id])}?"
+                                                   f"{urlencode({'cursor': encode_cursor(deep_row)})}", None))
+    if pictured:
+        found.append(Endpoint("image_variant", reverse("image_variant", args=[640, "jpeg", pictured]), None))
+    return found
+
+
+def percentile(timings, point):
+    if len(timings) < 2:
+        return timings[0] if timings else float("nan")
+    return statistics.quantiles(timings, n=100)[point - 1]
+
+
+class Command(BaseCommand):
+    help = ("Requests the main pages and API endpoints through the test client and reports latency "
+            "percentiles, queries, SQL time, peak Python memory and response size for each. Runs "
+            "against the configured database, or a scratch one seeded with synthetic data with "
+            "--scratch. --json saves the results and --compare shows the change from a saved run.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=200, help="Timed requests per endpoint.")
+        parser.add_argument("--warmup", type=int, default=10)
+        parser.add_argument("--only", nargs="+", metavar="ENDPOINT", help="Only these endpoints.")
+        parser.add_argument("--cold", action="store_true",
+                            help="Clear the cache before every request, to time the pages as they are built.")
+        parser.add_argument("--json", metavar="PATH", help="Save the results to this file.")
+        parser.add_argument("--compare", metavar="PATH", help="Show the change from the results in this file.")
+        parser.add_argument("--scratch", action="store_true",
+                            help="Benchmark a temporary database seeded by seed_synthetic.")
+        parser.add_argument("--posts", type=int, default=DEFAULT_SIZES.posts, help="Posts seeded with --scratch.")
+        parser.add_argument("--skew", type=float, default=1.0, help="Skew of the data seeded with --scratch.")
+        parser.add_argument("--accept-encoding", default="",
+                            help="Accept-Encoding header of the requests, e.g. gzip. By default bodies are not "
+                                 "compressed and bytes is their plain size.")
+
+    def handle(self, *args, **options):
+        scratch = tempfile.mkdtemp(prefix="aqar-bench-") if options["scratch"] else None
+        try:
+            if scratch:
+                self.seed(scratch, options)
+            results = self.run(options)
+        finally:
+            if scratch:
+                shutil.rmtree(scratch)
+
+        self.report(results, options["compare"])
+        if options["json"]:
+            with open(options["json"], "w") as output:
+                json.dump({"options": {key: options[key] for key in ("requests", "cold", "scratch", "posts", "skew",
+                                                                   "accept_encoding")},
+                           "endpoints": results}, output, indent=2)
+            self.stdout.write(f"Saved the results to {options['json']}")
+
+    def seed(self, scratch, options):
+        os.mkdir(os.path.join(scratch, "uploads"))
+        use_scratch_files(os.path.join(scratch, "db.sqlite3"), os.path.join(scratch, "uploads"))
+        call_command("migrate", verbosity=0)
+        sizes = DEFAULT_SIZES._replace(posts=options["posts"], comments=options["posts"] * 2)
+        started = time.perf_counter()
+        SyntheticData(sizes, skew=options["skew"]).seed()
+        self.stdout.write(f"Seeded {options['posts']} posts in {time.perf_counter() - started:.1f}s")
+        cache.clear()
+
+    def run(self, options):
+        selected = endpoints()
+        if options["only"]:
+            unknown = set(options["only"]) - {endpoint.name for endpoint in selected}
+            if unknown:
+                raise CommandError(f"Unknown endpoints: {', '.join(sorted(unknown))}. "
+                                   f"Choose from {', '.join(endpoint.name for endpoint in selected)}")
+            selected = [endpoint for endpoint in selected if endpoint.name in options["only"]]
+        results = {}
+        for endpoint in selected:
+            results[endpoint.name] = self.measure(endpoint, options)
+        return results
+
+    def client(self, endpoint):
+        client = Client(SERVER_NAME="localhost")
+        if endpoint.user is not None:
+            client.force_login(endpoint.user)
+            agency_id = AgencyMember.objects.filter(member=endpoint.user).order_by("-agency__posts_count").values_list(
+                "agency", flat=True)[0]
+            client.post(reverse("agency_profile"), {"agency": agency_id})
+        return client
+
+    def measure(self, endpoint, options):
+        client = self.client(endpoint)
+        headers = {"HTTP_ACCEPT_ENCODING": options["accept_encoding"]} if options["accept_encoding"] else {}
+
+        def get():
+            if options["cold"]:
+                cache.clear()
+            started = time.perf_counter()
+            response = client.get(endpoint.path, **headers)
+            elapsed = (time.perf_counter() - started) * 1000
+            if response.status_code != 200:
+                raise CommandError(f"{endpoint.name} returned {response.status_code} for {endpoint.path}")
+            return response, elapsed
+
+        for _ in range(options["warmup"]):
+            get()
+        timings = [get()[1] for _ in range(options["requests"])]
+
+        with QueryRecorder() as recorder:
+            response, _ = get()
+        tracemalloc.start()
+        try:
+            get()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        body = b"".join(response.streaming_content) if response.streaming else response.content
+        return {
+            "path": endpoint.path,
+            "p50": percentile(timings, 50),
+            "p95": percentile(timings, 95),
+            "p99": percentile(timings, 99),
+            "mean": statistics.fmean(timings),
+            "queries": recorder.count,
+            "duplicates": recorder.duplicates,
+            "sql_ms": recorder.sql_ms,
+            "peak_kib": peak / 1024,
+            "bytes": len(body),
+        }
+
+    def report(self, results, compare_path):
+        baseline = {}
+        if compare_path:
+            with open(compare_path) as baseline_file:
+                baseline = json.load(baseline_file)["endpoints"]
+        self.stdout.write(f"{'endpoint':<16} " + " ".join(f"{column:>9}" for column in COLUMNS))
+        for name, result in results.items():
+            self.stdout.write(f"{name:<16} " + " ".join(f"{result[column]:>9.1f}" if isinstance(result[column], float)
+                                                       else f"{result[column]:>9}" for column in COLUMNS))
+            if name in baseline:
+                changes = []
+                for column in COLUMNS:
+                    before = baseline[name].get(column)
+                    change = (result[column] - before) / before * 100 if before else 0
+                    changes.append(f"{change:>+8.0f}%")
+                self.stdout.write(f"{'  vs baseline':<16} " + " ".join(changes))
@@ -0,0 +1,70 @@
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from aqar_agencies.models import Agency, Area, Post
+from aqar_agencies.pagination import encode_cursor, keyset_page
+
+
+class Command(BaseCommand):
+    help = ("Times keyset and OFFSET pagination of an area feed at increasing depths. "
+            "The posts are created inside a transaction that is rolled back.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--posts", type=int, default=1_000_000)
+        parser.add_argument("--areas", type=int, default=10)
+        parser.add_argument("--page-size", type=int, default=20)
+        parser.add_argument("--repeat", type=int, default=20)
+        parser.add_argument("--batch-size", type=int, default=10_000)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            area = self.seed(options)
+            self.measure(area, options)
+            transaction.set_rollback(True)
+
+    def seed(self, options):
+        user = User.objects.create(username="bench_area_feed")
+        agency = Agency.objects.new(user, name="Benchmark agency")
+        areas = [Area.objects.new(name=f"Benchmark area {number}") for number in range(options["areas"])]
+        started = time.perf_counter()
+        batch = []
+        for number in range(options["posts"]):
+            batch.append(Post(agency=agency, area=areas[number % len(areas)],
+                              title=f"Post {number}", body="Benchmark post"))
+            if len(batch) == options["batch_size"]:
+                Post.objects.bulk_create(batch)
+                batch = []
+        Post.objects.bulk_create(batch)
+        self.stdout.write(f"Seeded {options['posts']} posts in {time.perf_counter() - started:.1f}s")
+        return areas[0]
+
+    def timed(self, function, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            function()
+            timings.append((time.perf_counter() - started) * 1000)
+        return statistics.median(timings)
+
+    def measure(self, area, options):
+        page_size = options["page_size"]
+        feed = Post.objects.area_feed(area.pk)
+        total = feed.count()
+        self.stdout.write(f"{total} posts in the measured area")
+        self.stdout.write(f"{'page':>8} {'keyset ms':>10} {'offset ms':>10}")
+        page = 1
+        while (page - 1) * page_size < total:
+            offset = (page - 1) * page_size
+            cursor = None
+            if offset:
+                cursor = encode_cursor(feed.order_by("-created_at", "-id")[offset - 1])
+            keyset_ms = self.timed(lambda: keyset_page(feed, cursor, page_size), options["repeat"])
+            offset_ms = self.timed(
+                lambda: list(feed.order_by("-created_at", "-id")[offset:offset + page_size]),
+                options["repeat"])
+            self.stdout.write(f"{page:>8} {keyset_ms:>10.2f} {offset_ms:>10.2f}")
+            page *= 10
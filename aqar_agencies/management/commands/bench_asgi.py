@@ -0,0 +1,186 @@
+import asyncio
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.urls import reverse
+from PIL import Image
+
+from aqar_agencies import search
+from aqar_agencies.models import Agency, Area, Post
+
+HANDLERS = ("wsgi", "asgi")
+
+
+def jpeg():
+    image = BytesIO()
+    Image.new("RGB", (1600, 1200), (200, 120, 40)).save(image, "JPEG")
+    return image.getvalue()
+
+
+def use_scratch_files(database, media_root):
+    """Points every connection of this process, in any thread, and the uploads at scratch copies"""
+    connections.close_all()
+    connections.databases["default"]["NAME"] = database
+    settings.MEDIA_ROOT = media_root
+
+
+def call_wsgi(handler, path, query):
+    environ = {
+        "REQUEST_METHOD": "GET", "PATH_INFO": path, "QUERY_STRING": query, "SERVER_NAME": "localhost",
+        "SERVER_PORT": "80", "HTTP_HOST": "localhost", "SERVER_PROTOCOL": "HTTP/1.1",
+        "wsgi.input": BytesIO(), "wsgi.errors": sys.stderr, "wsgi.url_scheme": "http",
+    }
+    statuses = []
+    result = handler(environ, lambda status, headers, exc_info=None: statuses.append(status))
+    try:
+        for _ in result:
+            pass
+    finally:
+        result.close()
+    return int(statuses[0].split()[0])
+
+
+async def call_asgi(handler, path, query):
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+        "path": path, "raw_path": path.encode(), "query_string": query.encode(), "root_path": "",
+        "headers": [(b"host", b"localhost")], "server": ("localhost", 80), "client": ("127.0.0.1", 50000),
+    }
+    statuses = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            statuses.append(message["status"])
+
+    await handler(scope, receive, send)
+    return statuses[0]
+
+
+class Command(BaseCommand):
+    help = ("Compares the WSGI handler serving the sync views with the ASGI handler serving the async "
+            "views, in-process, with many concurrent clients requesting area feeds, search results and "
+            "image variants from a scratch database. Each handler runs in its own process.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=64)
+        parser.add_argument("--requests", type=int, default=3000)
+        parser.add_argument("--posts", type=int, default=5000)
+        # Internal: run one handler against an already prepared scratch directory.
+        parser.add_argument("--handler", choices=HANDLERS, help="Run only this handler (used by the child processes).")
+        parser.add_argument("--scratch")
+
+    def handle(self, *args, **options):
+        if options["handler"]:
+            return self.run_handler(options)
+
+        scratch = tempfile.mkdtemp(prefix="aqar-bench-")
+        try:
+            endpoints = self.prepare(scratch, options["posts"])
+            endpoints["mixed"] = [path for paths in endpoints.values() for path in paths]
+            self.stdout.write(f"{options['requests']} requests, {options['concurrency']} concurrent clients")
+            self.stdout.write(f"{'pages':>8} {'handler':>8} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+            for endpoint, paths in endpoints.items():
+                with open(os.path.join(scratch, "paths.json"), "w") as paths_file:
+                    json.dump(paths, paths_file)
+                for handler in HANDLERS:
+                    result = self.run_child(handler, scratch, options)
+                    self.stdout.write(f"{endpoint:>8} {handler:>8} {result['rps']:>8.0f} {result['p50']:>8.2f} "
+                                      f"{result['p99']:>8.2f} {result['errors']:>7}")
+        finally:
+            shutil.rmtree(scratch)
+
+    def run_child(self, handler, scratch, options):
+        environment = {**os.environ, "AQAR_ASYNC_VIEWS": "1" if handler == "asgi" else "0"}
+        output = subprocess.run(
+            [sys.executable, sys.argv[0], "bench_asgi", "--handler", handler, "--scratch", scratch,
+             "--concurrency", str(options["concurrency"]), "--requests", str(options["requests"])],
+            env=environment, check=True, capture_output=True, text=True).stdout
+        return json.loads(output.splitlines()[-1])
+
+    def prepare(self, scratch, number_of_posts):
+        os.mkdir(os.path.join(scratch, "uploads"))
+        use_scratch_files(os.path.join(scratch, "db.sqlite3"), os.path.join(scratch, "uploads"))
+        call_command("migrate", verbosity=0)
+        user = User.objects.create(username="bench_asgi")
+        agency = Agency.objects.new(user, name="Benchmark agency")
+        areas = [Area.objects.new(name=f"Benchmark area {number}") for number in range(10)]
+        post = Post.objects.new(agency=agency, area=areas[0], title="Sale with a photo", body="Benchmark post",
+                                picture=SimpleUploadedFile("photo.jpg", jpeg(), content_type="image/jpeg"))
+        Post.objects.bulk_create(
+            [Post(agency=agency, area=areas[number % len(areas)], title=f"Sale {number}", body="Benchmark post")
+             for number in range(number_of_posts)], batch_size=1000)
+        search.rebuild_index()
+        connections.close_all()
+        return {
+            "feed": [reverse("area_feed", args=[area.pk]) for area in areas],
+            "search": [f"{reverse('search')}?q=sale", f"{reverse('search')}?q=photo"],
+            "image": [reverse("image_variant", args=[320, "jpeg", post.picture.name])],
+        }
+
+    def run_handler(self, options):
+        scratch = options["scratch"]
+        use_scratch_files(os.path.join(scratch, "db.sqlite3"), os.path.join(scratch, "uploads"))
+        with open(os.path.join(scratch, "paths.json")) as paths_file:
+            paths = [path.partition("?")[::2] for path in json.load(paths_file)]
+        random.seed(0)
+        requests = [random.choice(paths) for _ in range(options["requests"])]
+
+        if options["handler"] == "wsgi":
+            from django.core.handlers.wsgi import WSGIHandler
+            handler = WSGIHandler()
+
+            def timed(request):
+                started = time.perf_counter()
+                status = call_wsgi(handler, *request)
+                return status, (time.perf_counter() - started) * 1000
+
+            for request in paths:
+                timed(request)
+            started = time.perf_counter()
+            with ThreadPoolExecutor(options["concurrency"]) as executor:
+                results = list(executor.map(timed, requests))
+        else:
+            from django.core.handlers.asgi import ASGIHandler
+            handler = ASGIHandler()
+
+            async def run():
+                clients = asyncio.Semaphore(options["concurrency"])
+
+                async def timed(request):
+                    async with clients:
+                        started = time.perf_counter()
+                        status = await call_asgi(handler, *request)
+                        return status, (time.perf_counter() - started) * 1000
+
+                for request in paths:
+                    await timed(request)
+                began = time.perf_counter()
+                return began, await asyncio.gather(*(timed(request) for request in requests))
+
+            started, results = asyncio.run(run())
+        elapsed = time.perf_counter() - started
+
+        timings = [timing for _, timing in results]
+        percentiles = statistics.quantiles(timings, n=100)
+        self.stdout.write(json.dumps({
+            "rps": len(results) / elapsed, "p50": percentiles[49], "p99": percentiles[98],
+            "errors": sum(1 for status, _ in results if status != 200),
+        }))
@@ -0,0 +1,130 @@
+import multiprocessing
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connections, transaction
+from django.db.utils import load_backend
+
+from aqar_agencies.models import Agency, Area, Post
+from aqar_agencies.pagination import keyset_page
+
+PROFILES = {
+    "default": {"ENGINE": "django.db.backends.sqlite3", "CONN_MAX_AGE": 0, "OPTIONS": {}},
+    "production": {"ENGINE": "aqarwebsite.sqlite3", "CONN_MAX_AGE": 600,
+                   "OPTIONS": {"timeout": 10, "serialize_writes": True}},
+}
+
+
+def use_database(path, profile):
+    """Points the default connection of this process at `path` with a profile's settings"""
+    settings_dict = {**connections["default"].settings_dict, "NAME": path, **PROFILES[profile]}
+    connections["default"].close()
+    connections["default"] = load_backend(settings_dict["ENGINE"]).DatabaseWrapper(settings_dict, "default")
+
+
+def worker(path, profile, operations, write_ratio, area_ids, post_ids, results):
+    use_database(path, profile)
+    random.seed(os.getpid())
+    timings = {"read": [], "write": []}
+    errors = 0
+    for _ in range(operations):
+        kind = "write" if random.random() < write_ratio else "read"
+        started = time.perf_counter()
+        try:
+            if kind == "read":
+                keyset_page(Post.objects.area_feed(random.choice(area_ids)), None, 20)
+            else:
+                # A request that reads before it writes, as most form
+                # submissions do, then saves its session.
+                with transaction.atomic():
+                    post = Post.objects.get(pk=random.choice(post_ids))
+                    Post.objects.filter(pk=post.pk).update(body=f"{post.body[:20]} edited")
+                SessionStore().create()
+        except DatabaseError:
+            errors += 1
+            continue
+        finally:
+            # Like the end of a request: dropped unless CONN_MAX_AGE keeps it.
+            connections["default"].close_if_unusable_or_obsolete()
+        timings[kind].append((time.perf_counter() - started) * 1000)
+    results.put((timings, errors))
+
+
+class Command(BaseCommand):
+    help = ("Runs concurrent worker processes that read area feeds and write posts and sessions "
+            "against a scratch copy of the schema, once with the default SQLite settings and "
+            "once with the production profile, and reports throughput, latency and lock errors.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=8)
+        parser.add_argument("--operations", type=int, default=300, help="Operations per worker.")
+        parser.add_argument("--write-ratio", type=float, default=0.2)
+        parser.add_argument("--posts", type=int, default=10_000)
+        parser.add_argument("--profiles", nargs="+", choices=sorted(PROFILES), default=["default", "production"])
+
+    def handle(self, *args, **options):
+        directory = tempfile.mkdtemp(prefix="aqar-bench-")
+        try:
+            template = os.path.join(directory, "template.sqlite3")
+            area_ids, post_ids = self.prepare(template, options["posts"])
+            self.stdout.write(f"{'profile':>12} {'ops/s':>8} {'errors':>7} {'read p50':>9} {'read p99':>9} "
+                              f"{'write p50':>10} {'write p99':>10}")
+            for profile in options["profiles"]:
+                path = os.path.join(directory, f"{profile}.sqlite3")
+                shutil.copy(template, path)
+                self.run(path, profile, area_ids, post_ids, options)
+        finally:
+            shutil.rmtree(directory)
+
+    def prepare(self, path, number_of_posts):
+        original = connections["default"]
+        use_database(path, "default")
+        try:
+            call_command("migrate", verbosity=0)
+            user = User.objects.create(username="bench_sqlite_concurrency")
+            agency = Agency.objects.new(user, name="Benchmark agency")
+            areas = [Area.objects.new(name=f"Benchmark area {number}") for number in range(10)]
+            Post.objects.bulk_create(
+                [Post(agency=agency, area=areas[number % len(areas)], title=f"Post {number}", body="Benchmark post")
+                 for number in range(number_of_posts)], batch_size=1000)
+            return [area.pk for area in areas], list(Post.objects.values_list("pk", flat=True))
+        finally:
+            connections["default"].close()
+            connections["default"] = original
+
+    def run(self, path, profile, area_ids, post_ids, options):
+        # Forked workers must not share the parent's SQLite handles.
+        connections.close_all()
+        context = multiprocessing.get_context("fork")
+        results = context.Queue()
+        started = time.perf_counter()
+        processes = [context.Process(target=worker, args=(path, profile, options["operations"],
+                                                          options["write_ratio"], area_ids, post_ids, results))
+                     for _ in range(options["workers"])]
+        for process in processes:
+            process.start()
+        outcomes = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+        elapsed = time.perf_counter() - started
+
+        reads = [timing for timings, _ in outcomes for timing in timings["read"]]
+        writes = [timing for timings, _ in outcomes for timing in timings["write"]]
+        errors = sum(errors for _, errors in outcomes)
+
+        def percentile(timings, point):
+            if len(timings) < 2:
+                return float("nan")
+            return statistics.quantiles(timings, n=100)[point - 1]
+
+        self.stdout.write(f"{profile:>12} {(len(reads) + len(writes)) / elapsed:>8.0f} {errors:>7} "
+                          f"{percentile(reads, 50):>9.2f} {percentile(reads, 99):>9.2f} "
+                          f"{percentile(writes, 50):>10.2f} {percentile(writes, 99):>10.2f}")
@@ -0,0 +1,65 @@
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+RAN = re.compile(r"^Ran (\d+) tests? in", re.MULTILINE)
+
+
+class Command(BaseCommand):
+    help = ("Times the test suite from start to exit, serially and with --parallel, as fresh "
+            "`manage.py test` processes. --json saves the results and --compare shows the change "
+            "from a saved run, to keep the suite fast as it grows.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("labels", nargs="*", default=["aqar_agencies"], help="Test labels to run.")
+        parser.add_argument("--parallel", type=int, nargs="+", default=[1, os.cpu_count() or 1],
+                            help="Numbers of processes to time the suite with, 1 runs it serially.")
+        parser.add_argument("--repeat", type=int, default=3, help="Runs per configuration, the median is kept.")
+        parser.add_argument("--json", metavar="PATH", help="Save the results to this file.")
+        parser.add_argument("--compare", metavar="PATH", help="Show the change from the results in this file.")
+
+    def handle(self, *args, **options):
+        results = {}
+        for processes in dict.fromkeys(options["parallel"]):
+            timings = []
+            for _ in range(options["repeat"]):
+                seconds, tests = self.run_suite(options["labels"], processes)
+                timings.append(seconds)
+            results[str(processes)] = {"seconds": statistics.median(timings), "best": min(timings), "tests": tests}
+
+        baseline = {}
+        if options["compare"]:
+            with open(options["compare"]) as baseline_file:
+                baseline = json.load(baseline_file)["runs"]
+        self.stdout.write(f"{'processes':>9} {'tests':>6} {'median s':>9} {'best s':>8}")
+        for processes, result in results.items():
+            line = f"{processes:>9} {result['tests']:>6} {result['seconds']:>9.2f} {result['best']:>8.2f}"
+            if processes in baseline:
+                before = baseline[processes]["seconds"]
+                line += f"  {(result['seconds'] - before) / before * 100:+.0f}% vs baseline"
+            self.stdout.write(line)
+        if options["json"]:
+            with open(options["json"], "w") as output:
+                json.dump({"labels": options["labels"], "runs": results}, output, indent=2)
+            self.stdout.write(f"Saved the results to {options['json']}")
+
+    def run_suite(self, labels, processes):
+        command = [sys.executable, str(settings.BASE_DIR / "manage.py"), "test", *labels, "--noinput"]
+        if processes > 1:
+            command += ["--parallel", str(processes)]
+        # Let manage.py pick the test settings.
+        env = {key: value for key, value in os.environ.items() if key != "DJANGO_SETTINGS_MODULE"}
+        started = time.perf_counter()
+        finished = subprocess.run(command, cwd=settings.BASE_DIR, env=env, capture_output=True, text=True)
+        seconds = time.perf_counter() - started
+        ran = RAN.search(finished.stderr)
+        if finished.returncode or not ran:
+            raise CommandError(f"The tests failed with {processes} process(es):\n{finished.stderr[-3000:]}")
+        return seconds, int(ran.group(1))
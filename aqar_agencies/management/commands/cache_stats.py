@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from aqar_agencies import cache
+
+
+class Command(BaseCommand):
+    help = "Shows the hit rate of the cached page fragments."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--reset", action="store_true", help="Reset the counters after showing them.")
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'fragment':<16} {'hits':>8} {'misses':>8} {'hit rate':>9}")
+        for fragment, (hits, misses) in cache.stats().items():
+            rate = f"{hits / (hits + misses):.1%}" if hits + misses else "-"
+            self.stdout.write(f"{fragment:<16} {hits:>8} {misses:>8} {rate:>9}")
+        if options["reset"]:
+            cache.reset_stats()
@@ -0,0 +1,60 @@
+import csv
+import json
+import os
+import time
+from itertools import dropwhile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError
+
+from aqar_agencies.importer import ListingImporter, read_rows
+
+
+class Command(BaseCommand):
+    help = ("Imports agencies or posts from a CSV or JSON Lines file. "
+            "Post rows need agency (id), area (id or name), title and body. "
+            "Agency rows need name and owner (username), and may have phone_number, "
+            "email, address, twitter and instagram.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument("--kind", choices=["agencies", "posts"], default="posts")
+        parser.add_argument("--chunk-size", type=int, default=1000,
+                            help="Rows written per transaction.")
+        parser.add_argument("--errors", help="CSV report of rejected rows, defaults to <path>.errors.csv")
+        parser.add_argument("--resume", action="store_true",
+                            help="Skip the rows committed by an earlier run of the same file.")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        progress_path = f"{path}.progress"
+        errors_path = options["errors"] or f"{path}.errors.csv"
+
+        done = 0
+        if options["resume"] and os.path.exists(progress_path):
+            with open(progress_path) as progress_file:
+                done = json.load(progress_file)["rows"]
+            self.stdout.write(f"Resuming after row {done}")
+
+        def save_progress(last_number):
+            with open(progress_path, "w") as progress_file:
+                json.dump({"rows": last_number}, progress_file)
+
+        started = time.perf_counter()
+        with open(errors_path, "a" if done else "w", newline="", encoding="utf-8") as errors_file:
+            errors = csv.writer(errors_file)
+            if not done:
+                errors.writerow(["row", "error"])
+            importer = ListingImporter(options["kind"], options["chunk_size"],
+                                       on_error=lambda number, message: errors.writerow([number, message]),
+                                       on_chunk=save_progress)
+            try:
+                importer.run(dropwhile(lambda row: row[0] <= done, read_rows(path)))
+            except DatabaseError as error:
+                raise CommandError(f"{error}. Run again with --resume to continue after the last committed chunk.")
+
+        if os.path.exists(progress_path):
+            os.remove(progress_path)
+        self.stdout.write(
+            f"Imported {importer.imported} {options['kind']} in {time.perf_counter() - started:.1f}s, "
+            f"{importer.failed} rows rejected (see {errors_path})")
@@ -0,0 +1,23 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from aqar_agencies.importer import KUWAIT_AREAS, load_area_tree
+
+
+class Command(BaseCommand):
+    help = ("Loads a tree of governorates, areas and blocks from a JSON file, by default the "
+            "governorates and areas of Kuwait. Existing areas are kept, and top-level areas "
+            "with the name of an area in the tree are moved under its governorate.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", nargs="?", default=str(KUWAIT_AREAS))
+
+    def handle(self, *args, **options):
+        with open(options["path"], encoding="utf-8") as source:
+            tree = json.load(source)
+        with transaction.atomic():
+            counts = load_area_tree(tree)
+        self.stdout.write(f"Created {counts['created']} areas, moved {counts['moved']} "
+                          f"and updated {counts['updated']}")
@@ -0,0 +1,70 @@
+import os
+import statistics
+from collections import Counter, defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+
+from aqar_agencies.profiling import sample_store
+
+
+class Command(BaseCommand):
+    help = ("Aggregates the requests saved by SamplingProfilerMiddleware per URL name: their latency, "
+            "hottest functions, SQL and templates. --output writes one <url name>.folded file of "
+            "collapsed stacks per URL name, for flamegraph.pl or speedscope.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url-name", nargs="+", metavar="NAME", help="Only these URL names.")
+        parser.add_argument("--output", metavar="DIR", help="Write the collapsed stacks to this directory.")
+        parser.add_argument("--top", type=int, default=5, help="Functions, SQL and templates shown per URL name.")
+
+    def handle(self, *args, **options):
+        by_name = defaultdict(list)
+        for sample in sample_store().read():
+            name = sample["url_name"] or "unresolved"
+            if not options["url_name"] or name in options["url_name"]:
+                by_name[name].append(sample)
+        if not by_name:
+            raise CommandError("No profiled requests found, is SamplingProfilerMiddleware on (AQAR_PROFILER=1)?")
+
+        if options["output"]:
+            os.makedirs(options["output"], exist_ok=True)
+        for name, samples in sorted(by_name.items()):
+            stacks = Counter()
+            for sample in samples:
+                stacks.update(sample["stacks"])
+            if options["output"]:
+                path = os.path.join(options["output"], f"{name.replace(':', '-')}.folded")
+                with open(path, "w", encoding="utf-8") as folded:
+                    for stack, count in sorted(stacks.items()):
+                        folded.write(f"{stack} {count}\n")
+            self.report(name, samples, stacks, options["top"])
+
+    def report(self, name, samples, stacks, top):
+        totals = [sample["total_ms"] for sample in samples]
+        slow = sum(sample["reason"] == "slow" for sample in samples)
+        self.stdout.write(f"{name}: {len(samples)} requests ({slow} slow), p50 {statistics.median(totals):.1f}ms, "
+                          f"max {max(totals):.1f}ms, {sum(stacks.values())} stack samples")
+
+        own = Counter()
+        for stack, count in stacks.items():
+            own[stack.rsplit(";", 1)[-1]] += count
+        sql = defaultdict(lambda: [0, 0.0])
+        templates = defaultdict(lambda: [0, 0.0])
+        for sample in samples:
+            for statement, ms in sample["sql"]:
+                sql[statement][0] += 1
+                sql[statement][1] += ms
+            for template, ms, depth in sample["templates"]:
+                templates[template][0] += 1
+                templates[template][1] += ms
+
+        for title, rows in (("functions (own samples)", [(label, count, None) for label, count in own.most_common(top)]),
+                            ("SQL (runs, total ms)", self.slowest(sql, top)),
+                            ("templates (renders, total ms)", self.slowest(templates, top))):
+            if rows:
+                self.stdout.write(f"  {title}")
+                for label, count, ms in rows:
+                    self.stdout.write(f"    {count:>6}" + (f" {ms:>10.1f}" if ms is not None else "") + f"  {label[:160]}")
+
+    def slowest(self, timings, top):
+        return [(label, count, ms) for label, (count, ms) in sorted(timings.items(), key=lambda item: -item[1][1])[:top]]
@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from aqar_agencies import facets
+
+
+class Command(BaseCommand):
+    help = ("Compares the facet counts of the listing search with the posts and rebuilds the areas "
+            "whose counts drifted, after bulk inserts or queryset updates that skipped the signals.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--check", action="store_true",
+                            help="Only report the drift, and fail if there is any.")
+        parser.add_argument("--all", action="store_true", help="Rebuild every row, drifted or not.")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        if options["all"]:
+            rows = facets.rebuild()
+            self.stdout.write(f"Rebuilt {rows} facet counts in {time.perf_counter() - started:.1f}s")
+            return
+
+        found = list(facets.drift())
+        for drift in found:
+            self.stdout.write(f"Area {drift.area_id}, {drift.listing_type or '-'}, {drift.property_type or '-'}, "
+                              f"price band {drift.price_band}: {drift.stored} posts, should be {drift.actual}")
+        area_ids = {drift.area_id for drift in found}
+        elapsed = time.perf_counter() - started
+        if options["check"]:
+            if found:
+                raise CommandError(f"{len(found)} facet counts in {len(area_ids)} areas have drifted.")
+            self.stdout.write(f"Checked the facet counts in {elapsed:.1f}s, none drifted")
+        else:
+            facets.recompute(area_ids)
+            self.stdout.write(f"Checked the facet counts in {elapsed:.1f}s, rebuilt {len(area_ids)} areas")
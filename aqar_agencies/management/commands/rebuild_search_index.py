@@ -0,0 +1,21 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from aqar_agencies import search
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the full-text search index of posts."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        if not search.is_supported():
+            raise CommandError("The search index needs SQLite with FTS5.")
+        started = time.perf_counter()
+        with transaction.atomic():
+            count = search.rebuild_index(options["batch_size"])
+        self.stdout.write(f"Indexed {count} posts in {time.perf_counter() - started:.1f}s")
@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from aqar_agencies import cache, stats
+
+
+class Command(BaseCommand):
+    help = ("Compares the post and member counts and the last posting time stored on each agency "
+            "with its rows and rebuilds the ones that drifted, one batch of agencies per transaction.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--check", action="store_true",
+                            help="Only report the drift, and fail if there is any.")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        checked = drifted = 0
+        for agency_ids in stats.batches(options["batch_size"]):
+            with transaction.atomic():
+                found = list(stats.drift(agency_ids))
+                for drift in found:
+                    self.stdout.write(f"Agency {drift.agency_id}: {drift.field} is {drift.stored}, "
+                                      f"should be {drift.actual}")
+                ids = {drift.agency_id for drift in found}
+                if ids and not options["check"]:
+                    stats.recompute(ids)
+                    for agency_id in ids:
+                        cache.bump("agency", agency_id)
+            checked += len(agency_ids)
+            drifted += len(ids)
+
+        elapsed = time.perf_counter() - started
+        if options["check"]:
+            if drifted:
+                raise CommandError(f"{drifted} of {checked} agencies have drifted.")
+            self.stdout.write(f"Checked {checked} agencies in {elapsed:.1f}s, none drifted")
+        else:
+            self.stdout.write(f"Checked {checked} agencies in {elapsed:.1f}s, rebuilt {drifted}")
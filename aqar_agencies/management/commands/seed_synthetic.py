@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from aqar_agencies.synthetic import DEFAULT_SIZES, SyntheticData, SyntheticSizes
+
+
+class Command(BaseCommand):
+    help = ("Fills the database with made-up users, agencies, members, posts with pictures and "
+            "threaded comments at production volumes. Posts per agency and per area and comments "
+            "per post follow a Zipf distribution with exponent --skew. The Kuwait areas are loaded "
+            "first if there are none.")
+
+    def add_arguments(self, parser):
+        for field in ("users", "agencies", "posts", "comments", "pictures"):
+            parser.add_argument(f"--{field}", type=int, default=getattr(DEFAULT_SIZES, field))
+        parser.add_argument("--members-per-agency", type=float, default=DEFAULT_SIZES.members_per_agency,
+                            help="Average members besides the owner.")
+        parser.add_argument("--picture-ratio", type=float, default=DEFAULT_SIZES.picture_ratio,
+                            help="Share of the posts with a picture, drawn from --pictures distinct images.")
+        parser.add_argument("--reply-ratio", type=float, default=DEFAULT_SIZES.reply_ratio,
+                            help="Share of the comments that answer another comment.")
+        parser.add_argument("--skew", type=float, default=1.0, help="0 spreads everything evenly.")
+        parser.add_argument("--seed", type=int, default=0, help="Random seed, the same seed gives the same data.")
+        parser.add_argument("--prefix", default="synthetic", help="Prefix of the usernames and agency names.")
+        parser.add_argument("--batch-size", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        if options["agencies"] and not options["users"]:
+            raise CommandError("Agencies need at least one user to own them.")
+        if options["posts"] and not options["agencies"]:
+            raise CommandError("Posts need at least one agency.")
+        sizes = SyntheticSizes(**{field: options[field] for field in SyntheticSizes._fields})
+        started = time.perf_counter()
+        seeder = SyntheticData(sizes, skew=options["skew"], seed=options["seed"], prefix=options["prefix"],
+                               batch_size=options["batch_size"],
+                               log=lambda message: self.stdout.write(
+                                   f"{time.perf_counter() - started:7.1f}s  {message}"))
+        seeder.seed()
+        self.stdout.write(f"Seeded in {time.perf_counter() - started:.1f}s")
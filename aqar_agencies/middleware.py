@@ -0,0 +1,130 @@
+import asyncio
+from collections import namedtuple
+
+from django.conf import settings
+from django.utils.functional import SimpleLazyObject
+
+from . import cache, routers
+from .models import AgencyMember
+
+MEMBERSHIPS_SESSION_KEY = "aqar_agency_memberships"
+ACTIVE_AGENCY_SESSION_KEY = "aqar_active_agency"
+PIN_PRIMARY_COOKIE = "aqar_primary"
+
+
+class Membership(namedtuple("Membership", ["agency_id", "agency_name", "is_admin"])):
+    @property
+    def id(self):
+        return self.agency_id
+
+    def __str__(self):
+        return self.agency_name
+
+
+def get_memberships(request):
+    """The user's agency memberships, loaded once and kept in the session.
+
+    The session copy carries the version counter that AgencyMember signals
+    bump for the user, so joining or leaving an agency reloads it.
+    """
+    user = request.user
+    if not user.is_authenticated:
+        return []
+    version, = cache.versions(("memberships", user.pk))
+    stored = request.session.get(MEMBERSHIPS_SESSION_KEY)
+    if not stored or stored["user"] != user.pk or stored["version"] != version:
+        memberships = AgencyMember.objects.filter(member=user).order_by("pk").values_list(
+            "agency_id", "agency__name", "is_admin")
+        stored = {"user": user.pk, "version": version, "memberships": [list(row) for row in memberships]}
+        request.session[MEMBERSHIPS_SESSION_KEY] = stored
+    return [Membership(*row) for row in stored["memberships"]]
+
+
+def get_active_agency(request):
+    memberships = request.agency_memberships
+    chosen = request.session.get(ACTIVE_AGENCY_SESSION_KEY)
+    for membership in memberships:
+        if membership.agency_id == chosen:
+            return membership
+    if len(memberships) == 1:
+        return memberships[0]
+    return None
+
+
+def set_active_agency(request, agency_id):
+    """Makes one of the user's agencies the one they act for, returns False if they are not a member"""
+    if not any(membership.agency_id == agency_id for membership in request.agency_memberships):
+        return False
+    request.session[ACTIVE_AGENCY_SESSION_KEY] = agency_id
+    return True
+
+
+class AsyncCapableMiddleware:
+    """Base of middleware that runs on the event loop under ASGI instead of in a thread"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # How Django's MiddlewareMixin marks instances as coroutine functions.
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        return self.handle(request)
+
+
+class ActiveAgencyMiddleware(AsyncCapableMiddleware):
+    """Sets request.agency_memberships and request.active_agency.
+
+    Both are resolved on first use. request.active_agency is the Membership
+    of the agency the user acts for and is falsy when there is none, when the
+    user has several agencies and has not chosen one yet, or when they are
+    logged out.
+    """
+
+    def prepare(self, request):
+        request.agency_memberships = SimpleLazyObject(lambda: get_memberships(request))
+        request.active_agency = SimpleLazyObject(lambda: get_active_agency(request))
+
+    def handle(self, request):
+        self.prepare(request)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        self.prepare(request)
+        return await self.get_response(request)
+
+
+class PrimaryPinningMiddleware(AsyncCapableMiddleware):
+    """Keeps a user's reads on the primary database for a while after they write.
+
+    A request that writes to an aqar_agencies model sets a cookie that lasts
+    AQAR_PIN_PRIMARY_SECONDS, and requests carrying it read from the
+    primary, so a new post shows up in the feed right after it is created
+    even if the replicas have not caught up yet.
+    """
+
+    def handle(self, request):
+        token = routers.pin_to_primary(PIN_PRIMARY_COOKIE in request.COOKIES)
+        try:
+            return self.pin_if_written(self.get_response(request))
+        finally:
+            routers.reset_pinning(token)
+
+    async def __acall__(self, request):
+        # Writes made in sync_to_async threads are copied back into this
+        # context by asgiref, so wrote_to_primary() sees them here.
+        token = routers.pin_to_primary(PIN_PRIMARY_COOKIE in request.COOKIES)
+        try:
+            return self.pin_if_written(await self.get_response(request))
+        finally:
+            routers.reset_pinning(token)
+
+    def pin_if_written(self, response):
+        if routers.wrote_to_primary():
+            response.set_cookie(PIN_PRIMARY_COOKIE, "1", max_age=settings.AQAR_PIN_PRIMARY_SECONDS,
+                                httponly=True, samesite="Lax")
+        return response
@@ -0,0 +1,38 @@
+from django.db import migrations, models
+
+from aqar_agencies.normalization import normalize_arabic
+
+
+def populate_normalized_names(apps, schema_editor):
+    Area = apps.get_model("aqar_agencies", "Area")
+    seen = set()
+    for area in Area.objects.order_by("pk"):
+        normalized_name = normalize_arabic(area.name)
+        if normalized_name in seen:
+            # Keep older duplicates loadable; they can be merged by hand.
+            normalized_name = f"{normalized_name[:40]}#{area.pk}"
+        seen.add(normalized_name)
+        area.normalized_name = normalized_name
+        area.save(update_fields=["normalized_name"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aqar_agencies', '0008_auto_20211212_0831'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='area',
+            name='normalized_name',
+            field=models.CharField(default='', editable=False, max_length=50),
+            preserve_default=False,
+        ),
+        migrations.RunPython(populate_normalized_names, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='area',
+            name='normalized_name',
+            field=models.CharField(editable=False, max_length=50, unique=True),
+        ),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aqar_agencies', '0009_area_normalized_name'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['area', 'created_at', 'id'], name='post_area_created_idx'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.2.9 on 2026-10-18 11:57
+
+import aqar_agencies.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aqar_agencies', '0011_comment_post_created_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('refcount', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='agency',
+            name='profile_picture',
+            field=models.ImageField(blank=True, null=True, storage=aqar_agencies.storage.ContentAddressedStorage(), upload_to='profile_picture'),
+        ),
+        migrations.AlterField(
+            model_name='post',
+            name='picture',
+            field=models.ImageField(null=True, storage=aqar_agencies.storage.ContentAddressedStorage(), upload_to='posts'),
+        ),
+    ]
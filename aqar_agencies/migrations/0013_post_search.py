@@ -0,0 +1,65 @@
+import re
+
+from django.db import migrations
+
+# A copy of search.py and normalization.py as they were when this migration
+# was written, so that later changes to them do not change what it does.
+SEARCH_TABLE = "aqar_agencies_post_search"
+CREATE_SEARCH_TABLE = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} "
+    "USING fts5(title, body, area, tokenize='unicode61 remove_diacritics 2')"
+)
+DROP_SEARCH_TABLE = f"DROP TABLE IF EXISTS {SEARCH_TABLE}"
+
+WORD = re.compile(r"\w+")
+ARTICLES = ("وال", "بال", "فال", "ال")
+DIACRITICS = re.compile("[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed]")
+WHITESPACE = re.compile(r"\s+")
+LETTER_MAP = str.maketrans({
+    **{alef: "ا" for alef in "أإآٱ"},
+    "ؤ": "و",
+    "ئ": "ي",
+    "ى": "ي",
+    "\u0640": None,
+})
+
+
+def search_terms(text):
+    text = WHITESPACE.sub(" ", DIACRITICS.sub("", text or "").translate(LETTER_MAP).casefold()).strip()
+    terms = []
+    for word in WORD.findall(text):
+        for article in ARTICLES:
+            if word.startswith(article) and len(word) - len(article) >= 2:
+                word = word[len(article):]
+                break
+        terms.append(word)
+    return terms
+
+
+def create_search_table(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    schema_editor.execute(CREATE_SEARCH_TABLE)
+    Post = apps.get_model("aqar_agencies", "Post")
+    # Areas had no parents yet, each post is indexed under its own area.
+    rows = [(pk, " ".join(search_terms(title)), " ".join(search_terms(body)), f"area{area_id}")
+            for pk, title, body, area_id in Post.objects.values_list("id", "title", "body", "area_id")]
+    with schema_editor.connection.cursor() as cursor:
+        cursor.executemany(
+            f"INSERT INTO {SEARCH_TABLE} (rowid, title, body, area) VALUES (%s, %s, %s, %s)", rows)
+
+
+def drop_search_table(apps, schema_editor):
+    if schema_editor.connection.vendor == "sqlite":
+        schema_editor.execute(DROP_SEARCH_TABLE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aqar_agencies', '0012_blob_storage'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_table, drop_search_table),
+    ]
@@ -0,0 +1,44 @@
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import CharField, Count, OuterRef, Subquery, Value
+from django.db.models.functions import Cast, Coalesce, Concat, LPad
+
+
+def populate_paths_and_counts(apps, schema_editor):
+    Comment = apps.get_model("aqar_agencies", "Comment")
+    Post = apps.get_model("aqar_agencies", "Post")
+    # Every existing comment answers the post itself.
+    Comment.objects.update(path=Concat(LPad(Cast("pk", CharField()), 10, Value("0")), Value("/")))
+    counts = Comment.objects.filter(post=OuterRef("pk")).order_by().values("post").annotate(
+        count=Count("pk")).values("count")
+    Post.objects.update(comments_count=Coalesce(Subquery(counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aqar_agencies', '0014_post_created_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='parent',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='children', to='aqar_agencies.comment'),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='path',
+            field=models.CharField(default='', editable=False, max_length=220),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='comments_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', 'path'], name='comment_post_path_idx'),
+        ),
+        migrations.RunPython(populate_paths_and_counts, migrations.RunPython.noop),
+    ]
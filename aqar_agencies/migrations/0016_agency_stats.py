@@ -0,0 +1,46 @@
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def populate_stats(apps, schema_editor):
+    Agency = apps.get_model("aqar_agencies", "Agency")
+    AgencyMember = apps.get_model("aqar_agencies", "AgencyMember")
+    Post = apps.get_model("aqar_agencies", "Post")
+
+    def count(model):
+        return Coalesce(Subquery(model.objects.filter(agency=OuterRef("pk")).order_by().values("agency").annotate(
+            count=Count("pk")).values("count")), 0)
+
+    Agency.objects.update(
+        posts_count=count(Post),
+        members_count=count(AgencyMember),
+        last_posted_at=Subquery(Post.objects.filter(agency=OuterRef("pk")).order_by("-created_at", "-id").values(
+            "created_at")[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aqar_agencies', '0015_comment_threads'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='agency',
+            name='last_posted_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='agency',
+            name='members_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='agency',
+            name='posts_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(populate_stats, migrations.RunPython.noop),
+    ]
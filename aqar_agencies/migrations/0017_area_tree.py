@@ -0,0 +1,53 @@
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import CharField, Value
+from django.db.models.functions import Cast, Concat, LPad
+
+
+def populate_paths(apps, schema_editor):
+    Area = apps.get_model("aqar_agencies", "Area")
+    # Every existing area is a top-level one.
+    Area.objects.update(path=Concat(LPad(Cast("pk", CharField()), 10, Value("0")), Value("/")))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aqar_agencies', '0016_agency_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='area',
+            name='kind',
+            field=models.CharField(choices=[('governorate', 'Governorate'), ('area', 'Area'), ('block', 'Block')], default='area', max_length=12),
+        ),
+        migrations.AddField(
+            model_name='area',
+            name='parent',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='children', to='aqar_agencies.area'),
+        ),
+        migrations.AddField(
+            model_name='area',
+            name='path',
+            field=models.CharField(default='', editable=False, max_length=44),
+        ),
+        migrations.AlterField(
+            model_name='area',
+            name='normalized_name',
+            field=models.CharField(editable=False, max_length=50),
+        ),
+        migrations.AddIndex(
+            model_name='area',
+            index=models.Index(fields=['path'], name='area_path_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='area',
+            constraint=models.UniqueConstraint(fields=('parent', 'normalized_name'), name='area_parent_name_unique'),
+        ),
+        migrations.AddConstraint(
+            model_name='area',
+            constraint=models.UniqueConstraint(condition=models.Q(('parent', None)), fields=('normalized_name',), name='area_top_name_unique'),
+        ),
+        migrations.RunPython(populate_paths, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,75 @@
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def populate_facet_counts(apps, schema_editor):
+    Post = apps.get_model("aqar_agencies", "Post")
+    FacetCount = apps.get_model("aqar_agencies", "FacetCount")
+    # Existing posts have no attributes yet, so one row per area counts them.
+    FacetCount.objects.bulk_create([
+        FacetCount(area_id=row["area"], count=row["posts"])
+        for row in Post.objects.order_by().values("area").annotate(posts=Count("pk"))
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aqar_agencies', '0017_area_tree'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='listing_type',
+            field=models.CharField(blank=True, choices=[('sale', 'For sale'), ('rent', 'For rent')], default='', max_length=4),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='property_type',
+            field=models.CharField(blank=True, choices=[('apartment', 'Apartment'), ('floor', 'Floor'), ('house', 'House'), ('villa', 'Villa'), ('land', 'Land'), ('building', 'Building'), ('chalet', 'Chalet'), ('shop', 'Shop'), ('office', 'Office'), ('warehouse', 'Warehouse')], default='', max_length=12),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='price',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='size_sqm',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['listing_type', 'property_type', 'price', 'id'], name='post_type_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['listing_type', 'price', 'id'], name='post_listing_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['price', 'id'], name='post_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['property_type', 'size_sqm'], name='post_type_size_idx'),
+        ),
+        migrations.CreateModel(
+            name='FacetCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('listing_type', models.CharField(blank=True, max_length=4)),
+                ('property_type', models.CharField(blank=True, max_length=12)),
+                ('price_band', models.PositiveSmallIntegerField(default=0)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('area', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='aqar_agencies.area')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='facetcount',
+            constraint=models.UniqueConstraint(fields=('area', 'listing_type', 'property_type', 'price_band'), name='facet_count_cell_unique'),
+        ),
+        migrations.RunPython(populate_facet_counts, migrations.RunPython.noop),
+    ]
@@ -1,12 +1,90 @@
-from django.db import models
+import bisect
+
+from django.db import IntegrityError, models, router, transaction
 from django.contrib.auth.models import User
-from django.db.models.deletion import CASCADE, SET_NULL
+from django.db.models import F, OuterRef, Prefetch, Q, Subquery, Value
+from django.db.models.deletion import CASCADE, PROTECT, SET_NULL
+from django.db.models.functions import Concat, Substr
 from django.core.exceptions import ValidationError
+from django.utils import timezone
 from django.core.validators import EmailValidator, MaxLengthValidator, MinLengthValidator, validate_image_file_extension
 
+from .areas import area_registry
+from .images import schedule_variants
+from .normalization import normalize_arabic
+from .storage import blob_storage
 
-class AgencyManager(models.Manager):
-    def new(self, user, **kwargs):
+
+def skip_maintained_fields(instance, kwargs, maintained):
+    """Leaves the columns kept by F() updates out of the UPDATE when an existing row is saved.
+
+    An instance read before one of those updates holds old values, which a
+    plain save() would write back.
+    """
+    if not instance._state.adding and kwargs.get("update_fields") is None:
+        kwargs["update_fields"] = [field.name for field in instance._meta.concrete_fields
+                                   if not field.primary_key and field.name not in maintained]
+
+
+class BlobManager(models.Manager):
+    def acquire(self, name):
+        with transaction.atomic():
+            if self.filter(name=name).update(refcount=F("refcount") + 1):
+                return
+            try:
+                with transaction.atomic():
+                    self.create(name=name, refcount=1)
+            except IntegrityError:
+                self.filter(name=name).update(refcount=F("refcount") + 1)
+
+    def release(self, name):
+        """Drops one reference, returns True if it was the last one"""
+        with transaction.atomic():
+            if self.filter(name=name, refcount__gt=1).update(refcount=F("refcount") - 1):
+                return False
+            deleted, _ = self.filter(name=name).delete()
+            return bool(deleted)
+
+
+class Blob(models.Model):
+    name = models.CharField(max_length=100, unique=True)
+    refcount = models.PositiveIntegerField(default=0)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = BlobManager()
+
+    def __str__(self):
+        return f"{self.name} ({self.refcount})"
+
+
+class AgencyQuerySet(models.QuerySet):
+    def verify(self, user):
+        """Verifies the unverified agencies in the queryset, returns the ids of those that changed"""
+        return self._transition(models.Q(verification__isnull=True), verification=user)
+
+    def unverify(self):
+        """Unverifies the verified agencies in the queryset, returns the ids of those that changed"""
+        return self._transition(models.Q(verification__isnull=False), verification=None)
+
+    def _transition(self, condition, **changes):
+        # The condition is repeated in the UPDATE, so an agency changed by
+        # someone else since it was read is left alone and not reported.
+        # Everything runs on the database written to: self.db names a replica
+        # for a queryset that has not been used to write yet.
+        db = self._db or router.db_for_write(self.model, **self._hints)
+        updated_at = timezone.now()
+        with transaction.atomic(using=db):
+            candidates = list(self.using(db).filter(condition).values_list("pk", flat=True))
+            if not candidates:
+                return []
+            Agency.objects.using(db).filter(condition, pk__in=candidates).update(updated_at=updated_at, **changes)
+            return list(Agency.objects.using(db).filter(pk__in=candidates, updated_at=updated_at).values_list(
+                "pk", flat=True))
+
+
+class AgencyManager(models.Manager.from_queryset(AgencyQuerySet)):
+    def validate(self, **kwargs):
         name = kwargs.get("name")
         if not name:
             raise ValidationError("Please enter a name for the Agency.")
@@ -38,8 +116,12 @@ class AgencyManager(models.Manager):
             address_max_validator = MaxLengthValidator(200)
             address_max_validator(address)
 
-        agency = self.create(**kwargs)
-        agency.add_member(user, is_admin=True)
+    def new(self, user, **kwargs):
+        self.validate(**kwargs)
+        with transaction.atomic():
+            agency = self.create(**kwargs)
+            agency.add_member(user, is_admin=True)
+        schedule_variants(agency.profile_picture)
         
         return agency
 
@@ -47,7 +129,7 @@ class AgencyManager(models.Manager):
 class Agency(models.Model):
     name = models.CharField(max_length=100,blank=False)
     phone_number = models.CharField(max_length=8, blank=True)
-    profile_picture = models.ImageField(upload_to="profile_picture", null=True, blank=True)
+    profile_picture = models.ImageField(upload_to="profile_picture", storage=blob_storage, null=True, blank=True)
     email = models.EmailField(blank=True)
     address = models.TextField(max_length=200, blank=True)
     verification = models.ForeignKey(User, null=True, blank=True, on_delete=SET_NULL, related_name="verified")
@@ -55,6 +137,11 @@ class Agency(models.Model):
     instagram = models.CharField(max_length=50, blank=True)
 
     members = models.ManyToManyField(User, through='AgencyMember')
+
+    # Kept by the Post and AgencyMember signals, see stats.py.
+    posts_count = models.PositiveIntegerField(default=0, editable=False)
+    members_count = models.PositiveIntegerField(default=0, editable=False)
+    last_posted_at = models.DateTimeField(null=True, blank=True, editable=False)
     
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -68,27 +155,44 @@ class Agency(models.Model):
         # Do something
         super().clean(*args, **kwargs)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        agency = super().from_db(db, field_names, values)
+        # The stored picture, released by the signals when it is replaced.
+        agency._loaded_values = dict(zip(field_names, values))
+        return agency
+
     def save(self, *args, **kwargs):
         self.full_clean()
-        super().save(*args, **kwargs)
+        skip_maintained_fields(self, kwargs, ["posts_count", "members_count", "last_posted_at"])
+        # The blob reference taken when a new picture is stored goes with the row.
+        with transaction.atomic(savepoint=False):
+            super().save(*args, **kwargs)
 
     def verified_by(self, user):
-        if self.verification is not None:
+        updated_at = timezone.now()
+        if not Agency.objects.filter(pk=self.pk, verification__isnull=True).update(
+                verification=user, updated_at=updated_at):
             raise ValidationError("Agency has already been verified")
         self.verification = user
-        self.save()
+        self.updated_at = updated_at
 
     def unverify(self):
-        if self.verification is None:
+        updated_at = timezone.now()
+        if not Agency.objects.filter(pk=self.pk, verification__isnull=False).update(
+                verification=None, updated_at=updated_at):
             raise ValidationError("Agency is not verified")
         self.verification = None
-        self.save()
+        self.updated_at = updated_at
 
     def add_post(self, **kwargs):
-        Post.objects.new(self, **kwargs)
+        # The post and the agency's posts_count and last_posted_at commit together.
+        with transaction.atomic():
+            return Post.objects.new(agency=self, **kwargs)
 
     def add_member(self, user, is_admin):
-        AgencyMember.objects.create(agency=self, member=user, is_admin=is_admin)
+        with transaction.atomic():
+            return AgencyMember.objects.create(agency=self, member=user, is_admin=is_admin)
 
     def __str__(self):
         return self.name
@@ -111,33 +215,128 @@ class AgencyMember(models.Model):
 
 
 class AreaManager(models.Manager):
-    def new(self, **kwargs):
+    def validate(self, **kwargs):
         name = kwargs.get("name")
         if name is None:
             raise ValidationError("Please enter a name for the Area.")
-        elif name in [area.name for area in self.all()]:
-            raise ValidationError("The name already exists. Please enter another one.")
         name_min_validator = MinLengthValidator(2)
         name_min_validator(name)
         name_max_validator = MaxLengthValidator(50)
         name_max_validator(name)
 
-        area = self.create(**kwargs)
+        kind = kwargs.get("kind", Area.AREA)
+        if kind not in dict(Area.KINDS):
+            raise ValidationError(f"{kind} is not a kind of area")
+
+    def new(self, **kwargs):
+        self.validate(**kwargs)
+        area, created = self._create_or_get(**kwargs)
+        if not created:
+            raise ValidationError("The name already exists. Please enter another one.")
 
         return area
 
+    def get_or_new(self, **kwargs):
+        """Returns (area, created), reusing the area of the same parent whose normalized name matches"""
+        self.validate(**kwargs)
+        return self._create_or_get(**kwargs)
+
+    def _create_or_get(self, **kwargs):
+        # The unique indexes on (parent, normalized_name) decide which of two
+        # concurrent inserts wins, so there is no read-then-write window.
+        try:
+            with transaction.atomic():
+                return self.create(**kwargs), True
+        except IntegrityError:
+            return self.get(parent=kwargs.get("parent"), normalized_name=normalize_arabic(kwargs["name"])), False
+
+    def subtree(self, area):
+        """The area and every area under it, with one range lookup on the path index"""
+        low, high = Area.subtree_bounds(area.path)
+        return self.filter(path__gte=low, path__lt=high)
+
+    def move_subtree(self, old_path, new_path):
+        """Rewrites the paths of the areas under `old_path` to start with `new_path`"""
+        low, high = Area.subtree_bounds(old_path)
+        self.filter(path__gte=low, path__lt=high).update(
+            path=Concat(Value(new_path), Substr("path", len(old_path) + 1)))
+
 
 class Area(models.Model):
+    GOVERNORATE = "governorate"
+    AREA = "area"
+    BLOCK = "block"
+    KINDS = [(GOVERNORATE, "Governorate"), (AREA, "Area"), (BLOCK, "Block")]
+
+    # Ids are zero-padded in the path so that ordering by it is tree order.
+    PATH_STEP = 10
+    MAX_DEPTH = 4
+
     name = models.CharField(max_length=50)
+    normalized_name = models.CharField(max_length=50, editable=False)
+    parent = models.ForeignKey("self", null=True, blank=True, on_delete=PROTECT, related_name="children")
+    kind = models.CharField(max_length=12, choices=KINDS, default=AREA)
+    # Ids from the governorate down to this area, "0000000002/0000000031/"
+    path = models.CharField(max_length=(PATH_STEP + 1) * MAX_DEPTH, editable=False, default="")
 
     objects = AreaManager()
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["parent", "normalized_name"], name="area_parent_name_unique"),
+            # NULL parents never collide in the constraint above.
+            models.UniqueConstraint(fields=["normalized_name"], condition=Q(parent=None),
+                                    name="area_top_name_unique"),
+        ]
+        indexes = [
+            models.Index(fields=["path"], name="area_path_idx"),
+        ]
+
+    @staticmethod
+    def subtree_bounds(path):
+        """(low, high) such that low <= p < high holds for exactly the paths starting with `path`"""
+        # Paths are digits and "/", and "0" is the character right after "/".
+        return path, path[:-1] + "0"
+
+    @property
+    def depth(self):
+        """0 for a governorate or other top-level area, 1 for an area in it and so on"""
+        return self.path.count("/") - 1
+
+    def clean(self):
+        if self.parent_id is None:
+            return
+        if self.path and self.parent.path.startswith(self.path):
+            raise ValidationError("An area cannot be moved under itself")
+        if self.parent.path.count("/") >= self.MAX_DEPTH:
+            raise ValidationError("Areas cannot be nested this deep")
+
+    def save(self, *args, **kwargs):
+        self.normalized_name = normalize_arabic(self.name)
+        self.clean()
+        parent_path = self.parent.path if self.parent_id else ""
+        # Where a moved area was, for the post_save signal: the feeds and
+        # search entries of its old ancestors change too.
+        self.previous_path = ""
+        with transaction.atomic():
+            if self._state.adding:
+                super().save(*args, **kwargs)
+                # The path ends with the area's own id, known only once it is inserted.
+                self.path = f"{parent_path}{self.pk:0{self.PATH_STEP}d}/"
+                Area.objects.filter(pk=self.pk).update(path=self.path)
+                return
+            path = f"{parent_path}{self.pk:0{self.PATH_STEP}d}/"
+            if path != self.path:
+                Area.objects.move_subtree(self.path, path)
+                self.previous_path, self.path = self.path, path
+            super().save(*args, **kwargs)
+
     def __str__(self):
-        return f"{self.area}"
+        return self.name
 
 
 class PostManager(models.Manager):
-    def new(self, **kwargs):
+    def validate(self, **kwargs):
         title = kwargs.get("title")
         if title is None:
             raise ValidationError("Please enter a title for the post")
@@ -154,54 +353,257 @@ class PostManager(models.Manager):
         if profile_picture is not None:
             validate_image_file_extension(profile_picture)
 
+        listing_type = kwargs.get("listing_type")
+        if listing_type and listing_type not in dict(Post.LISTING_TYPES):
+            raise ValidationError(f"{listing_type} is not a listing type")
+        property_type = kwargs.get("property_type")
+        if property_type and property_type not in dict(Post.PROPERTY_TYPES):
+            raise ValidationError(f"{property_type} is not a property type")
+        for field in ("price", "size_sqm"):
+            value = kwargs.get(field)
+            if value is not None and value < 0:
+                raise ValidationError(f"The {field} cannot be negative")
+
+    def new(self, **kwargs):
+        self.validate(**kwargs)
         post = self.create(**kwargs)
+        schedule_variants(post.picture)
 
         return post
 
+    def in_area(self, area_id):
+        """Posts in the area and in every area under it.
+
+        The paths come from the area registry, so a governorate is one range
+        lookup on the area path index rather than a list of its areas and blocks.
+        """
+        snapshot = area_registry.snapshot()
+        if area_id not in snapshot.paths:
+            return self.none()
+        if area_id not in snapshot.branches:
+            return self.filter(area_id=area_id)
+        low, high = Area.subtree_bounds(snapshot.paths[area_id])
+        return self.filter(area__path__gte=low, area__path__lt=high)
+
+    def area_feed(self, area_id):
+        return self.in_area(area_id).select_related("agency")
+
+    def listings(self, area_id=None, listing_type=None, property_type=None, price_band=None, min_size=None,
+                 max_size=None, sort="newest"):
+        """Posts matching the structured filters, the ones left as None match everything.
+
+        Equality on the listing and property types with a range on or an
+        order by the price is served by the post_*_price_idx indexes, a size
+        range on a property type by post_type_size_idx.
+        """
+        posts = self.in_area(area_id) if area_id is not None else self.all()
+        if listing_type is not None:
+            posts = posts.filter(listing_type=listing_type)
+        if property_type is not None:
+            posts = posts.filter(property_type=property_type)
+        if price_band is not None:
+            low, high = Post.band_range(price_band)
+            posts = posts.filter(price__gte=low) if high is None else posts.filter(price__gte=low, price__lt=high)
+        if min_size is not None:
+            posts = posts.filter(size_sqm__gte=min_size)
+        if max_size is not None:
+            posts = posts.filter(size_sqm__lte=max_size)
+        if sort != "newest":
+            # Posts without a price cannot be ordered by it.
+            posts = posts.filter(price__isnull=False)
+        return posts.select_related("agency", "area").order_by(*Post.SORTS[sort])
+
+    def for_agency_profile(self, agency, limit=10, comments_per_post=3):
+        """The agency's latest posts, each with its latest comments in `latest_comments`.
+
+        Posts, areas and the agency come in one query and the comments of all
+        the posts, with their users, in a second one, however many there are.
+        """
+        latest_comment_ids = Comment.objects.filter(post=OuterRef("post")).order_by(
+            "-created_at", "-id").values("pk")[:comments_per_post]
+        latest_comments = Comment.objects.filter(pk__in=Subquery(latest_comment_ids)).select_related(
+            "user").order_by("-created_at", "-id")
+        return self.filter(agency=agency).select_related("agency", "area").prefetch_related(
+            Prefetch("comments", queryset=latest_comments, to_attr="latest_comments")).order_by(
+            "-created_at", "-id")[:limit]
+
 
 class Post(models.Model):
+    SALE = "sale"
+    RENT = "rent"
+    LISTING_TYPES = [(SALE, "For sale"), (RENT, "For rent")]
+    PROPERTY_TYPES = [
+        ("apartment", "Apartment"), ("floor", "Floor"), ("house", "House"), ("villa", "Villa"),
+        ("land", "Land"), ("building", "Building"), ("chalet", "Chalet"), ("shop", "Shop"),
+        ("office", "Office"), ("warehouse", "Warehouse"),
+    ]
+    # Lower bounds of the price bands in Kuwaiti dinars. Rents fall in the
+    # first ones and sale prices in the others, so one set serves both.
+    PRICE_BANDS = [0, 500, 1_000, 2_000, 50_000, 100_000, 200_000, 400_000, 800_000]
+    NO_PRICE = 0
+    SORTS = {"newest": ("-created_at", "-id"), "price": ("price", "id"), "-price": ("-price", "-id")}
+
     agency = models.ForeignKey(Agency, on_delete=CASCADE, related_name="posts")
     area = models.ForeignKey(Area, on_delete=CASCADE)
     title = models.CharField(max_length=100, blank=False)
     body = models.TextField(max_length=400, blank=False)
-    picture = models.ImageField(upload_to="posts", null=True)
+    picture = models.ImageField(upload_to="posts", storage=blob_storage, null=True)
+    # Kept by the Comment signals with F() updates, never written by save().
+    comments_count = models.PositiveIntegerField(default=0, editable=False)
+    listing_type = models.CharField(max_length=4, choices=LISTING_TYPES, blank=True, default="")
+    property_type = models.CharField(max_length=12, choices=PROPERTY_TYPES, blank=True, default="")
+    # Kuwaiti dinars, per month for rentals.
+    price = models.PositiveIntegerField(null=True, blank=True)
+    size_sqm = models.PositiveIntegerField(null=True, blank=True)
 
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     objects = PostManager()
 
-    def add_comment(self, user, message):
-        pass
+    class Meta:
+        indexes = [
+            models.Index(fields=["area", "created_at", "id"], name="post_area_created_idx"),
+            models.Index(fields=["created_at", "id"], name="post_created_idx"),
+            models.Index(fields=["agency", "created_at", "id"], name="post_agency_created_idx"),
+            # Equality columns first, then the price for its ranges and order.
+            models.Index(fields=["listing_type", "property_type", "price", "id"], name="post_type_price_idx"),
+            models.Index(fields=["listing_type", "price", "id"], name="post_listing_price_idx"),
+            models.Index(fields=["price", "id"], name="post_price_idx"),
+            models.Index(fields=["property_type", "size_sqm"], name="post_type_size_idx"),
+        ]
+
+    @classmethod
+    def price_band(cls, price):
+        """1 for the first of PRICE_BANDS and so on, NO_PRICE for a post without a price"""
+        if price is None:
+            return cls.NO_PRICE
+        return bisect.bisect_right(cls.PRICE_BANDS, price)
+
+    @classmethod
+    def band_range(cls, band):
+        """(low, high) such that low <= price < high for the prices in `band`, high is None for the last one"""
+        low = cls.PRICE_BANDS[band - 1]
+        return low, cls.PRICE_BANDS[band] if band < len(cls.PRICE_BANDS) else None
+
+    @classmethod
+    def band_label(cls, band):
+        low, high = cls.band_range(band)
+        if high is None:
+            return f"{low:,} KD and more"
+        return f"Under {high:,} KD" if low == 0 else f"{low:,} - {high:,} KD"
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        post = super().from_db(db, field_names, values)
+        # What the row held when it was read, for the signals that need to
+        # know what a save moved the post away from.
+        post._loaded_values = dict(zip(field_names, values))
+        return post
+
+    def save(self, *args, **kwargs):
+        skip_maintained_fields(self, kwargs, ["comments_count"])
+        # The blob reference taken when a new picture is stored goes with the row.
+        with transaction.atomic(savepoint=False):
+            super().save(*args, **kwargs)
+
+    def add_comment(self, user, message, parent=None):
+        return Comment.objects.new(post=self, user=user, message=message, parent=parent)
 
     def __str__(self):
         title_abbreviation = self.title[:10]
         return f"{title_abbreviation}... posted on {self.created_at} by {self.agency}"
 
 
+class FacetCount(models.Model):
+    """How many posts one area has of a listing type, property type and price band.
+
+    Kept by the Post signals with F() updates, see facets.py, so that the
+    faceted search adds these rows up rather than grouping the posts.
+    """
+    area = models.ForeignKey(Area, on_delete=CASCADE, related_name="+")
+    listing_type = models.CharField(max_length=4, blank=True)
+    property_type = models.CharField(max_length=12, blank=True)
+    price_band = models.PositiveSmallIntegerField(default=Post.NO_PRICE)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["area", "listing_type", "property_type", "price_band"],
+                                    name="facet_count_cell_unique"),
+        ]
+
+
 class CommentManager(models.Manager):
-    def new(self, **kwargs):
+    def validate(self, **kwargs):
         message = kwargs.get("message")
         if message is None:
             raise ValidationError("Please enter a message in the comment section")
         message_max_validator = MaxLengthValidator(400)
         message_max_validator(message)
 
-        comment = self.create(**kwargs)
+        parent = kwargs.get("parent")
+        if parent is not None:
+            post = kwargs.get("post")
+            post_id = post.pk if post is not None else kwargs.get("post_id")
+            if parent.post_id != post_id:
+                raise ValidationError("Replies must be on the same post as the comment they answer")
+            if parent.depth + 1 >= Comment.MAX_DEPTH:
+                raise ValidationError("This thread is too deep to reply to")
+
+    def new(self, **kwargs):
+        self.validate(**kwargs)
+
+        with transaction.atomic():
+            comment = self.create(**kwargs)
+            # The path ends with the comment's own id, known only once it is inserted.
+            comment.path = comment.thread_path()
+            self.filter(pk=comment.pk).update(path=comment.path)
 
         return comment
 
+    def thread(self, post):
+        """The post's comments in thread order, each reply right after what it answers, in one query"""
+        return self.filter(post=post).select_related("user").order_by("path")
+
+    def replies(self, comment):
+        """All the replies under `comment`, however deep, in thread order"""
+        return self.filter(post_id=comment.post_id, path__startswith=comment.path).exclude(
+            pk=comment.pk).select_related("user").order_by("path")
+
 
 class Comment(models.Model):
+    # Ids are zero-padded in the path so that ordering by it is thread order.
+    PATH_STEP = 10
+    MAX_DEPTH = 20
+
     post = models.ForeignKey(Post, on_delete=CASCADE, related_name="comments")
     user = models.ForeignKey(User, on_delete=CASCADE)
     message = models.TextField(max_length=400, blank=False)
+    parent = models.ForeignKey("self", null=True, blank=True, on_delete=CASCADE, related_name="children")
+    # Ids from the thread's first comment down to this one, "0000000007/0000000012/"
+    path = models.CharField(max_length=(PATH_STEP + 1) * MAX_DEPTH, editable=False, default="")
 
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     objects = CommentManager()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["post", "created_at", "id"], name="comment_post_created_idx"),
+            models.Index(fields=["post", "path"], name="comment_post_path_idx"),
+        ]
+
+    @property
+    def depth(self):
+        """0 for a comment on the post, 1 for a reply to it and so on"""
+        return self.path.count("/") - 1
+
+    def thread_path(self):
+        parent_path = self.parent.path if self.parent_id else ""
+        return f"{parent_path}{self.pk:0{self.PATH_STEP}d}/"
+
     def __str__(self):
         message_abbreviation = self.message[:10]
-        return f"{message_abbreviation}... posted on {self.created_at} by {self.agency}"
+        return f"{message_abbreviation}... posted on {self.created_at} by {self.user}"
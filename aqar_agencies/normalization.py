@@ -0,0 +1,28 @@
+import re
+
+ALEF_FORMS = "أإآٱ"
+TATWEEL = "\u0640"
+DIACRITICS = re.compile("[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed]")
+WHITESPACE = re.compile(r"\s+")
+
+LETTER_MAP = str.maketrans({
+    **{alef: "ا" for alef in ALEF_FORMS},
+    "ؤ": "و",
+    "ئ": "ي",
+    "ى": "ي",
+    TATWEEL: None,
+})
+
+
+def normalize_arabic(text):
+    """Returns a comparison key for Arabic (and Latin) text.
+
+    Alef and hamza forms are collapsed, tatweel and diacritics are removed,
+    Latin letters are case folded and whitespace is collapsed, so that
+    "أحمدي" and "احمـدي" give the same key.
+    """
+    if text is None:
+        return ""
+    text = DIACRITICS.sub("", text)
+    text = text.translate(LETTER_MAP).casefold()
+    return WHITESPACE.sub(" ", text).strip()
@@ -0,0 +1,59 @@
+import base64
+from collections import namedtuple
+from datetime import datetime
+
+from django.db.models import Q
+
+KeysetPage = namedtuple("KeysetPage", ["rows", "next_cursor"])
+# The largest id the database can compare with, a signed 64-bit integer.
+MAX_ID = 2 ** 63 - 1
+
+
+def _row_key(row):
+    if isinstance(row, dict):
+        return row["created_at"], row["id"]
+    return row.created_at, row.id
+
+
+def encode_cursor(row):
+    created_at, pk = _row_key(row)
+    raw = f"{created_at.isoformat()}|{pk}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Returns (created_at, id) from an encoded cursor, raises ValueError if it is malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, pk = raw.split("|")
+        created_at, pk = datetime.fromisoformat(created_at), int(pk)
+    except (TypeError, ValueError, UnicodeDecodeError) as error:
+        raise ValueError("Invalid cursor") from error
+    # Cursors come from encode_cursor(), which never makes these.
+    if created_at.tzinfo is None or not 0 <= pk <= MAX_ID:
+        raise ValueError("Invalid cursor")
+    return created_at, pk
+
+
+def keyset_window(queryset, cursor=None, page_size=20):
+    """The rows of the page after `cursor` plus one, which tells whether another page follows"""
+    queryset = queryset.order_by("-created_at", "-id")
+    if cursor:
+        created_at, pk = decode_cursor(cursor)
+        # The leading created_at__lte is what lets the database seek into the
+        # (…, created_at, id) index; the OR only breaks ties on created_at.
+        queryset = queryset.filter(created_at__lte=created_at).filter(
+            Q(created_at__lt=created_at) | Q(id__lt=pk))
+    return queryset[:page_size + 1]
+
+
+def keyset_page(queryset, cursor=None, page_size=20):
+    """Returns the page after `cursor` of a queryset ordered newest first.
+
+    Rows are ordered by (created_at, id) descending and the cursor is the key
+    of the last row of the previous page, so every page is an index range
+    scan of the same cost instead of an OFFSET that grows with the page number.
+    """
+    rows = list(keyset_window(queryset, cursor, page_size))
+    next_cursor = encode_cursor(rows[page_size - 1]) if len(rows) > page_size else None
+    return KeysetPage(rows[:page_size], next_cursor)
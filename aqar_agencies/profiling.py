@@ -0,0 +1,194 @@
+"""Sampling profiler for the requests that matter.
+
+SamplingProfilerMiddleware picks AQAR_PROFILER_SAMPLE_RATE of the requests
+to profile from the start, and profiles any other request from the moment
+it has run for AQAR_PROFILER_SLOW_MS. One thread per process wakes every
+AQAR_PROFILER_INTERVAL_MS and reads the stacks of those requests' threads
+with sys._current_frames(), so a request that is neither picked nor slow
+only pays for being registered and for its SQL and template timings being
+noted. Profiled requests are appended to a SampleStore, a JSON lines file
+rotated like a log, and `manage.py profile_report` folds them into
+flame graph stacks per URL name.
+
+Only requests served in a thread are profiled: under ASGI the event loop
+thread runs many requests at once, so its stacks belong to none of them.
+"""
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.utils import timezone
+
+from .instrumentation import QueryRecorder, TemplateTimer, time_templates
+from .middleware import AsyncCapableMiddleware
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return f"{frame.f_globals.get('__name__', '?')}.{getattr(code, 'co_qualname', code.co_name)}"
+
+
+def fold_stack(frame, stop):
+    """The stack from `stop` (excluded) down to `frame`, outermost first, joined with ;"""
+    labels = []
+    while frame is not None and frame is not stop:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+class ProfiledRequest:
+    def __init__(self, thread_id, root_frame, sampled):
+        self.thread_id = thread_id
+        self.root_frame = root_frame
+        self.sampled = sampled
+        self.started = time.perf_counter()
+        self.stacks = Counter()
+
+
+class Sampler:
+    """The thread reading the stacks of the profiled requests of this process"""
+
+    def __init__(self):
+        self.requests = {}
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+
+    def start(self, request):
+        with self.lock:
+            self.requests[id(request)] = request
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="aqar-profiler", daemon=True)
+                self.thread.start()
+        self.wake.set()
+
+    def stop(self, request):
+        with self.lock:
+            del self.requests[id(request)]
+
+    def run(self):
+        while True:
+            with self.lock:
+                active = list(self.requests.values())
+                if not active:
+                    self.wake.clear()
+            if not active:
+                self.wake.wait()
+                continue
+            time.sleep(settings.AQAR_PROFILER_INTERVAL_MS / 1000)
+            now = time.perf_counter()
+            slow_after = settings.AQAR_PROFILER_SLOW_MS / 1000
+            due = [request for request in active if request.sampled or now - request.started >= slow_after]
+            if not due:
+                continue
+            frames = sys._current_frames()
+            with self.lock:
+                for request in due:
+                    frame = frames.get(request.thread_id)
+                    # A request that finished since is no longer running that stack.
+                    if frame is not None and id(request) in self.requests:
+                        request.stacks[fold_stack(frame, request.root_frame)] += 1
+
+
+sampler = Sampler()
+
+
+class SampleStore:
+    """Profiled requests as JSON lines in `directory`/samples.jsonl.
+
+    Once the file passes `max_bytes` it is renamed samples.jsonl.1, the older
+    files move up one number and the ones past `backups` are deleted.
+    """
+    lock = threading.Lock()
+
+    def __init__(self, directory, max_bytes, backups):
+        self.path = os.path.join(directory, "samples.jsonl")
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+    def append(self, sample):
+        line = json.dumps(sample, ensure_ascii=False) + "\n"
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as samples:
+                samples.write(line)
+                size = samples.tell()
+            if size >= self.max_bytes:
+                self.rotate()
+
+    def rotate(self):
+        for number in range(self.backups, 0, -1):
+            older = f"{self.path}.{number}"
+            if os.path.exists(older):
+                if number == self.backups:
+                    os.remove(older)
+                else:
+                    os.replace(older, f"{self.path}.{number + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def files(self):
+        """The sample files, oldest first"""
+        names = [f"{self.path}.{number}" for number in range(self.backups, 0, -1)] + [self.path]
+        return [name for name in names if os.path.exists(name)]
+
+    def read(self):
+        for name in self.files():
+            with open(name, encoding="utf-8") as samples:
+                for line in samples:
+                    if line.strip():
+                        yield json.loads(line)
+
+
+def sample_store():
+    return SampleStore(settings.AQAR_PROFILER_DIR, settings.AQAR_PROFILER_MAX_BYTES, settings.AQAR_PROFILER_BACKUPS)
+
+
+class SamplingProfilerMiddleware(AsyncCapableMiddleware):
+    """Profiles a share of the requests and the slow ones, see the module docstring"""
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        time_templates()
+
+    def handle(self, request):
+        profiled = ProfiledRequest(threading.get_ident(), sys._getframe(),
+                                   sampled=random.random() < settings.AQAR_PROFILER_SAMPLE_RATE)
+        sampler.start(profiled)
+        try:
+            with QueryRecorder(timeline=True) as recorder, TemplateTimer() as timer:
+                response = self.get_response(request)
+        finally:
+            sampler.stop(profiled)
+        total_ms = (time.perf_counter() - profiled.started) * 1000
+        if profiled.sampled or total_ms >= settings.AQAR_PROFILER_SLOW_MS:
+            self.save(request, response, profiled, total_ms, recorder, timer)
+        return response
+
+    async def __acall__(self, request):
+        return await self.get_response(request)
+
+    def save(self, request, response, profiled, total_ms, recorder, timer):
+        match = request.resolver_match
+        sample_store().append({
+            "time": timezone.now().isoformat(),
+            "url_name": match.view_name if match else None,
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            "reason": "sampled" if profiled.sampled else "slow",
+            "total_ms": round(total_ms, 2),
+            "interval_ms": settings.AQAR_PROFILER_INTERVAL_MS,
+            "stacks": dict(profiled.stacks),
+            # Without parameters, which may hold personal data.
+            "sql": [[sql, round(seconds * 1000, 3)] for sql, seconds in recorder.timeline],
+            "templates": [[name, round(ms, 3), depth] for name, ms, depth in timer.timings],
+        })
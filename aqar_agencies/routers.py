@@ -0,0 +1,70 @@
+import contextvars
+import random
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+APP_LABEL = "aqar_agencies"
+
+_wrote = contextvars.ContextVar("aqar_wrote_to_primary", default=False)
+_pinned = contextvars.ContextVar("aqar_pinned_to_primary", default=False)
+
+
+def replicas():
+    return getattr(settings, "AQAR_READ_REPLICAS", [])
+
+
+def pin_to_primary(pinned=True):
+    """Sends the reads of the current request (or thread) to the primary.
+
+    Returns a token for reset_pinning().
+    """
+    return _pinned.set(pinned), _wrote.set(False)
+
+
+def reset_pinning(token):
+    pinned, wrote = token
+    _pinned.reset(pinned)
+    _wrote.reset(wrote)
+
+
+def wrote_to_primary():
+    return _wrote.get()
+
+
+class PrimaryReplicaRouter:
+    """Sends reads of aqar_agencies models to AQAR_READ_REPLICAS and writes to default.
+
+    Reads stay on the primary once the request has written to it, when the
+    user wrote a few seconds ago (see PrimaryPinningMiddleware), and inside
+    transactions on the primary, so nobody reads a replica that has not yet
+    caught up with their own changes.
+    """
+
+    def use_primary(self):
+        return not replicas() or _pinned.get() or _wrote.get() or connections[DEFAULT_DB_ALIAS].in_atomic_block
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != APP_LABEL:
+            return None
+        if self.use_primary():
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas())
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label != APP_LABEL:
+            return None
+        _wrote.set(True)
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas are copies of the primary and are never migrated themselves.
+        if db in replicas():
+            return False
+        return None
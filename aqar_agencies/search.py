@@ -0,0 +1,148 @@
+import re
+
+from django.db import connection
+from django.db.models import Q
+
+from .areas import area_registry, path_ids
+from .normalization import normalize_arabic
+
+SEARCH_TABLE = "aqar_agencies_post_search"
+WORD = re.compile(r"\w+")
+ARTICLES = ("وال", "بال", "فال", "ال")
+
+CREATE_SEARCH_TABLE = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} "
+    "USING fts5(title, body, area, tokenize='unicode61 remove_diacritics 2')"
+)
+DROP_SEARCH_TABLE = f"DROP TABLE IF EXISTS {SEARCH_TABLE}"
+
+
+def is_supported():
+    return connection.vendor == "sqlite"
+
+
+def search_terms(text):
+    """Normalized words of a text, with the Arabic definite article removed.
+
+    The same function prepares the indexed text and the query, which is what
+    lets "الأحمدي", "احمدي" and "الاحمـدي" find each other.
+    """
+    terms = []
+    for word in WORD.findall(normalize_arabic(text)):
+        for article in ARTICLES:
+            if word.startswith(article) and len(word) - len(article) >= 2:
+                word = word[len(article):]
+                break
+        terms.append(word)
+    return terms
+
+
+def area_token(area_id):
+    return f"area{area_id}"
+
+
+def index_rows(rows, area_paths=None):
+    """Adds (id, title, body, area_id) rows to the search table, replacing older entries.
+
+    A post's area column holds its area and every area above it, so that a
+    search in a governorate finds the posts of all its areas and blocks.
+    `area_paths` maps area ids to paths and defaults to the area registry's.
+    """
+    paths = area_registry.snapshot().paths if area_paths is None else area_paths
+
+    def area_tokens(area_id):
+        return " ".join(area_token(lineage_id) for lineage_id in path_ids(paths.get(area_id, "")) or [area_id])
+
+    rows = [(pk, " ".join(search_terms(title)), " ".join(search_terms(body)), area_tokens(area_id))
+            for pk, title, body, area_id in rows]
+    with connection.cursor() as cursor:
+        cursor.executemany(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = %s", [(row[0],) for row in rows])
+        cursor.executemany(
+            f"INSERT INTO {SEARCH_TABLE} (rowid, title, body, area) VALUES (%s, %s, %s, %s)", rows)
+
+
+def index_post(post):
+    if is_supported():
+        index_rows([(post.pk, post.title, post.body, post.area_id)])
+
+
+def unindex_post(post):
+    if is_supported():
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = %s", [post.pk])
+
+
+def reindex_areas(area_ids):
+    """Indexes the posts of the areas again, after they moved to another parent"""
+    from .models import Post
+
+    if is_supported():
+        index_rows(Post.objects.filter(area_id__in=area_ids).order_by().values_list("id", "title", "body", "area_id"))
+
+
+def rebuild_index(batch_size=5000):
+    from .models import Post
+
+    count = 0
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {SEARCH_TABLE}")
+    batch = []
+    for row in Post.objects.order_by().values_list("id", "title", "body", "area_id").iterator(batch_size):
+        batch.append(row)
+        if len(batch) == batch_size:
+            index_rows(batch)
+            count += len(batch)
+            batch = []
+    index_rows(batch)
+    count += len(batch)
+    with connection.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}) VALUES ('optimize')")
+    return count
+
+
+def match_expression(query, area_id=None, columns="title body"):
+    terms = search_terms(query)
+    if not terms:
+        return None
+    expression = f"{{{columns}}} : (" + " ".join(f'"{term}"' for term in terms) + ")"
+    if area_id is not None:
+        expression = f'area : "{area_token(area_id)}" AND {expression}'
+    return expression
+
+
+def _newest_matches(cursor, expression, limit):
+    cursor.execute(
+        f"SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s ORDER BY rowid DESC LIMIT %s",
+        [expression, limit])
+    return [row[0] for row in cursor.fetchall()]
+
+
+def search_posts(query, area_id=None, limit=20):
+    """Posts matching every word of the query, best matches first.
+
+    Posts with all the words in their title come before posts that only have
+    them in the body, newest first in each group. FTS5 walks its index in
+    rowid order and stops at the limit, so this costs milliseconds even for
+    words found in half the posts, where bm25() would first have to count
+    every matching post to weigh the words.
+    """
+    from .models import Post
+
+    posts = Post.objects.select_related("agency", "area")
+    if not is_supported():
+        if area_id is not None:
+            posts = Post.objects.in_area(area_id).select_related("agency", "area")
+        for term in query.split():
+            posts = posts.filter(Q(title__icontains=term) | Q(body__icontains=term))
+        return list(posts.order_by("-created_at")[:limit])
+
+    if not search_terms(query):
+        return []
+    with connection.cursor() as cursor:
+        ids = _newest_matches(cursor, match_expression(query, area_id, "title"), limit)
+        if len(ids) < limit:
+            title_ids = set(ids)
+            ids += [pk for pk in _newest_matches(cursor, match_expression(query, area_id), limit + len(ids))
+                    if pk not in title_ids][:limit - len(ids)]
+    found = posts.in_bulk(ids)
+    return [found[pk] for pk in ids if pk in found]
@@ -0,0 +1,191 @@
+import threading
+
+from django.db.backends.signals import connection_created
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from . import cache, facets, instrumentation, search, stats
+from .areas import area_registry, path_ids
+from .models import Agency, AgencyMember, Area, Comment, Post
+
+_deleting = threading.local()
+
+
+@receiver(post_save, sender=Area)
+@receiver(post_delete, sender=Area)
+def invalidate_area_registry(sender, instance, **kwargs):
+    area_registry.invalidate()
+    cache.bump("areas", "all")
+    if getattr(instance, "previous_path", ""):
+        # The area moved, with everything under it: the feeds and search
+        # entries of its old and new ancestors change.
+        moved = list(Area.objects.subtree(instance).values_list("pk", flat=True))
+        for area_id in {*path_ids(instance.previous_path), *path_ids(instance.path)}:
+            cache.bump("area", area_id)
+        search.reindex_areas(moved)
+
+
+def _stored_image_name(instance, field_name):
+    # What the row holds, which the instance may have replaced since it was read.
+    loaded = getattr(instance, "_loaded_values", {})
+    return loaded[field_name] if field_name in loaded else getattr(instance, field_name).name
+
+
+@receiver(post_save, sender=Agency)
+@receiver(post_save, sender=Post)
+def release_replaced_images(sender, instance, created, update_fields=None, **kwargs):
+    field_name = "profile_picture" if sender is Agency else "picture"
+    if update_fields is not None and field_name not in update_fields:
+        return
+    image = getattr(instance, field_name)
+    stored_name = None if created else _stored_image_name(instance, field_name)
+    if stored_name and stored_name != image.name:
+        image.storage.delete(stored_name)
+    instance._loaded_values = {**getattr(instance, "_loaded_values", {}), field_name: image.name}
+
+
+@receiver(post_delete, sender=Agency)
+@receiver(post_delete, sender=Post)
+def release_uploaded_images(sender, instance, **kwargs):
+    field_name = "profile_picture" if sender is Agency else "picture"
+    stored_name = _stored_image_name(instance, field_name)
+    if stored_name:
+        getattr(instance, field_name).storage.delete(stored_name)
+
+
+@receiver(post_save, sender=Post)
+def index_post(sender, instance, **kwargs):
+    search.index_post(instance)
+
+
+@receiver(post_delete, sender=Post)
+def unindex_post(sender, instance, **kwargs):
+    search.unindex_post(instance)
+
+
+@receiver(post_save, sender=Agency)
+@receiver(post_delete, sender=Agency)
+def invalidate_agency_pages(sender, instance, **kwargs):
+    cache.bump("agency", instance.pk)
+    # Memberships keep the agency name in the session.
+    for member_id in instance.agencymember_set.values_list("member_id", flat=True):
+        cache.bump("memberships", member_id)
+
+
+@receiver(post_save, sender=Agency)
+def invalidate_agency_feeds(sender, instance, created, **kwargs):
+    # The area feeds show the agency's name next to each of its posts.
+    loaded = getattr(instance, "_loaded_values", {})
+    if not created and loaded.get("name") != instance.name:
+        area_ids = instance.posts.order_by().values_list("area_id", flat=True).distinct()
+        for lineage_id in {lineage_id for area_id in area_ids for lineage_id in area_registry.lineage(area_id)}:
+            cache.bump("area", lineage_id)
+    instance._loaded_values = {**loaded, "name": instance.name}
+
+
+@receiver(post_save, sender=AgencyMember)
+@receiver(post_delete, sender=AgencyMember)
+def invalidate_member_pages(sender, instance, **kwargs):
+    cache.bump("agency", instance.agency_id)
+    cache.bump("memberships", instance.member_id)
+
+
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+def invalidate_post_pages(sender, instance, **kwargs):
+    cache.bump("agency", instance.agency_id)
+    # The feeds of the areas above show the post too.
+    area_ids = set(area_registry.lineage(instance.area_id))
+    loaded_area_id = getattr(instance, "_loaded_values", {}).get("area_id")
+    if loaded_area_id not in (None, instance.area_id):
+        area_ids.update(area_registry.lineage(loaded_area_id))
+    for area_id in area_ids:
+        cache.bump("area", area_id)
+
+
+@receiver(post_save, sender=Post)
+def count_new_post(sender, instance, created, **kwargs):
+    if created:
+        stats.post_added(instance)
+        return
+    loaded_agency_id = getattr(instance, "_loaded_values", {}).get("agency_id")
+    if loaded_agency_id not in (None, instance.agency_id):
+        stats.recompute([loaded_agency_id, instance.agency_id])
+
+
+@receiver(post_delete, sender=Post)
+def uncount_deleted_post(sender, instance, **kwargs):
+    stats.post_removed(instance.agency_id)
+
+
+@receiver(post_save, sender=Post)
+def count_post_facets(sender, instance, created, **kwargs):
+    if created:
+        facets.post_added(instance)
+    else:
+        facets.post_changed(instance)
+
+
+@receiver(post_delete, sender=Post)
+def uncount_post_facets(sender, instance, **kwargs):
+    facets.post_removed(instance)
+
+
+@receiver(post_save, sender=AgencyMember)
+def count_new_member(sender, instance, created, **kwargs):
+    if created:
+        stats.member_added(instance.agency_id)
+
+
+@receiver(post_delete, sender=AgencyMember)
+def uncount_deleted_member(sender, instance, **kwargs):
+    stats.member_removed(instance.agency_id)
+
+
+def _deleting_post_ids():
+    # Posts whose comments are being deleted with them: the counter goes
+    # with the row, and the post's own signals invalidate its pages.
+    return getattr(_deleting, "post_ids", frozenset())
+
+
+@receiver(pre_delete, sender=Post)
+def mark_deleting_post(sender, instance, **kwargs):
+    _deleting.post_ids = {*_deleting_post_ids(), instance.pk}
+
+
+@receiver(post_delete, sender=Post)
+def unmark_deleting_post(sender, instance, **kwargs):
+    _deleting.post_ids = _deleting_post_ids() - {instance.pk}
+
+
+@receiver(post_save, sender=Comment)
+def count_new_comment(sender, instance, created, **kwargs):
+    if created:
+        Post.objects.filter(pk=instance.post_id).update(comments_count=F("comments_count") + 1)
+
+
+@receiver(post_delete, sender=Comment)
+def uncount_deleted_comment(sender, instance, **kwargs):
+    if instance.post_id not in _deleting_post_ids():
+        Post.objects.filter(pk=instance.post_id).update(comments_count=F("comments_count") - 1)
+
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def invalidate_comment_pages(sender, instance, **kwargs):
+    if instance.post_id in _deleting_post_ids():
+        return
+    if Comment.post.is_cached(instance):
+        agency_id, area_id = instance.post.agency_id, instance.post.area_id
+    else:
+        agency_id, area_id = Post.objects.filter(pk=instance.post_id).values_list("agency_id", "area_id").get()
+    cache.bump("agency", agency_id)
+    # The feeds show comment counts.
+    for lineage_id in area_registry.lineage(area_id):
+        cache.bump("area", lineage_id)
+
+
+@receiver(connection_created)
+def record_queries(sender, connection, **kwargs):
+    instrumentation.install(connection)
@@ -0,0 +1,217 @@
+"""Fingerprinted, precompressed static files served by the app itself.
+
+CompressedManifestStaticFilesStorage hashes the files at collectstatic
+time like Django's manifest storage, then writes a .gz copy of every text
+file next to it, and a .br copy when the brotli package is installed.
+StaticFilesMiddleware serves STATIC_ROOT: it picks the smallest encoding
+the client accepts, marks fingerprinted names immutable and answers
+conditional and Range requests, so a single box needs no web server in
+front for its assets.
+"""
+import gzip
+import mimetypes
+import os
+import re
+from email.utils import parsedate_to_datetime
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.base import ContentFile
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.http import http_date, parse_etags
+
+from .middleware import AsyncCapableMiddleware
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE = re.compile(r"\.(css|js|mjs|map|json|svg|txt|html|xml|ico|ttf|otf|eot|wasm)$", re.IGNORECASE)
+# Names made by ManifestStaticFilesStorage, e.g. app.0123456789ab.css
+FINGERPRINTED = re.compile(r"\.[0-9a-f]{12}\.[^/.]+$")
+IMMUTABLE = "public, max-age=31536000, immutable"
+# Unhashed names may change with the next deploy.
+REVALIDATE = "public, max-age=300"
+MIN_SIZE = 256
+RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+CHUNK_SIZE = 64 * 1024
+
+# Best first, with the suffix of the precompressed copy.
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+
+
+def compress(data):
+    """{encoding: compressed bytes} for the encodings that make `data` smaller"""
+    found = {"gzip": gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        found["br"] = brotli.compress(data, quality=11)
+    return {encoding: compressed for encoding, compressed in found.items() if len(compressed) < len(data) * 0.95}
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """ManifestStaticFilesStorage that also precompresses the text files it collects"""
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+        for name in sorted({*paths, *self.hashed_files.values()}):
+            if not COMPRESSIBLE.search(name) or not self.exists(name) or self.size(name) < MIN_SIZE:
+                continue
+            with self.open(name) as original:
+                data = original.read()
+            for encoding, suffix in ENCODINGS:
+                if self.exists(name + suffix):
+                    self.delete(name + suffix)
+            for encoding, compressed in compress(data).items():
+                suffix = dict(ENCODINGS)[encoding]
+                self._save(name + suffix, ContentFile(compressed))
+                yield name, name + suffix, True
+
+
+def accepted_encodings(header):
+    """Content codings the Accept-Encoding header allows, without q=0 ones"""
+    accepted = set()
+    for part in header.split(","):
+        coding, _, params = part.strip().partition(";")
+        q = params.strip().partition("=")[2] if params.strip().startswith("q=") else "1"
+        try:
+            if float(q) > 0:
+                accepted.add(coding.strip().lower())
+        except ValueError:
+            continue
+    return accepted
+
+
+def byte_range(header, size):
+    """(start, end) inclusive of a single range Range header, None to send everything, False if unsatisfiable"""
+    match = RANGE.match(header.strip())
+    if not match or match.groups() == ("", ""):
+        # Several ranges or another unit: the whole file is a valid answer.
+        return None
+    first, last = match.groups()
+    if first == "":
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end or size == 0:
+        return False
+    return start, end
+
+
+def read_range(path, start, length):
+    with open(path, "rb") as source:
+        source.seek(start)
+        while length > 0:
+            chunk = source.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                return
+            length -= len(chunk)
+            yield chunk
+
+
+class StaticFilesMiddleware(AsyncCapableMiddleware):
+    """Serves the files collectstatic put in STATIC_ROOT, when AQAR_SERVE_STATIC is on.
+
+    Requests for anything else, or for files that are not there, go on to
+    the views. Under DEBUG, runserver serves static files before any
+    middleware runs.
+    """
+
+    def handle(self, request):
+        return self.serve(request) or self.get_response(request)
+
+    async def __acall__(self, request):
+        # Only stats and opens files, the body is streamed by the handler.
+        return self.serve(request) or await self.get_response(request)
+
+    def serve(self, request):
+        if (not settings.AQAR_SERVE_STATIC or not settings.STATIC_ROOT or request.method not in ("GET", "HEAD")
+                or not request.path.startswith(settings.STATIC_URL)):
+            return None
+        name = request.path[len(settings.STATIC_URL):]
+        try:
+            path = safe_join(settings.STATIC_ROOT, name)
+        except (SuspiciousFileOperation, ValueError):
+            return None
+        if not name or not os.path.isfile(path):
+            return None
+
+        range_header = request.META.get("HTTP_RANGE")
+        encoding, served_path = None, path
+        # Ranges are of the file itself, never of a compressed copy.
+        if not range_header:
+            accepted = accepted_encodings(request.META.get("HTTP_ACCEPT_ENCODING", ""))
+            for candidate, suffix in ENCODINGS:
+                if candidate in accepted and os.path.isfile(path + suffix):
+                    encoding, served_path = candidate, path + suffix
+                    break
+        stat = os.stat(served_path)
+        etag = f'"{int(stat.st_mtime):x}-{stat.st_size:x}{"-" + encoding if encoding else ""}"'
+        headers = {
+            "ETag": etag,
+            "Last-Modified": http_date(stat.st_mtime),
+            "Cache-Control": IMMUTABLE if FINGERPRINTED.search(name) else REVALIDATE,
+            "Accept-Ranges": "bytes",
+        }
+        if any(os.path.isfile(path + suffix) for _, suffix in ENCODINGS):
+            headers["Vary"] = "Accept-Encoding"
+
+        if self.not_modified(request, etag, stat.st_mtime):
+            response = HttpResponseNotModified()
+            for header, value in headers.items():
+                response[header] = value
+            return response
+
+        content_type, _ = mimetypes.guess_type(name)
+        content_type = content_type or "application/octet-stream"
+        if content_type.startswith("text/") or content_type in ("application/javascript", "image/svg+xml"):
+            content_type += "; charset=utf-8"
+
+        size = stat.st_size
+        requested = None
+        if range_header and (not request.META.get("HTTP_IF_RANGE")
+                             or request.META["HTTP_IF_RANGE"].strip() == etag):
+            requested = byte_range(range_header, size)
+        if requested is False:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{size}"
+            return response
+
+        if request.method == "HEAD":
+            response = HttpResponse(content_type=content_type)
+            response["Content-Length"] = str(size)
+        elif requested:
+            start, end = requested
+            response = StreamingHttpResponse(read_range(served_path, start, end - start + 1),
+                                             status=206, content_type=content_type)
+            response["Content-Range"] = f"bytes {start}-{end}/{size}"
+            response["Content-Length"] = str(end - start + 1)
+        else:
+            response = FileResponse(open(served_path, "rb"))
+            # FileResponse guesses from the name, which may be the .gz one.
+            response["Content-Type"] = content_type
+            del response["Content-Disposition"]
+        if encoding:
+            response["Content-Encoding"] = encoding
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+    def not_modified(self, request, etag, mtime):
+        if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+        if if_none_match is not None:
+            # Weak comparison: CompressionMiddleware weakens the ETag of a file
+            # it compresses on the way out.
+            tags = {tag[2:] if tag.startswith("W/") else tag for tag in parse_etags(if_none_match)}
+            return "*" in tags or etag in tags
+        if_modified_since = request.META.get("HTTP_IF_MODIFIED_SINCE")
+        if if_modified_since:
+            try:
+                return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
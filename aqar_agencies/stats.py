@@ -0,0 +1,79 @@
+"""Post and member counts and the last posting time, kept on Agency.
+
+The Post and AgencyMember signals change them with single UPDATE statements
+in the transaction that adds or removes the row, so agency lists and
+profiles read them instead of counting. bulk_create sends no signals, so
+code that uses it calls recompute() for the agencies it touched, and
+drift() finds the agencies whose columns no longer match their rows.
+"""
+from collections import namedtuple
+
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from .models import Agency, AgencyMember, Post
+
+STATS = ("posts_count", "members_count", "last_posted_at")
+
+Drift = namedtuple("Drift", ["agency_id", "field", "stored", "actual"])
+
+
+def _count(model):
+    return Coalesce(Subquery(model.objects.filter(agency=OuterRef("pk")).order_by().values("agency").annotate(
+        count=Count("pk")).values("count")), 0)
+
+
+def _last_posted_at():
+    # Served by post_agency_created_idx.
+    return Subquery(Post.objects.filter(agency=OuterRef("pk")).order_by("-created_at", "-id").values(
+        "created_at")[:1])
+
+
+def actual_stats():
+    """The expressions computing each column from the rows, for update() or annotate()"""
+    return {"posts_count": _count(Post), "members_count": _count(AgencyMember),
+            "last_posted_at": _last_posted_at()}
+
+
+def post_added(post):
+    Agency.objects.filter(pk=post.agency_id).update(posts_count=F("posts_count") + 1,
+                                                    last_posted_at=_last_posted_at())
+
+
+def post_removed(agency_id):
+    Agency.objects.filter(pk=agency_id).update(posts_count=F("posts_count") - 1,
+                                               last_posted_at=_last_posted_at())
+
+
+def member_added(agency_id):
+    Agency.objects.filter(pk=agency_id).update(members_count=F("members_count") + 1)
+
+
+def member_removed(agency_id):
+    Agency.objects.filter(pk=agency_id).update(members_count=F("members_count") - 1)
+
+
+def recompute(agency_ids):
+    """Rebuilds the columns of the given agencies from their rows, returns how many were updated"""
+    return Agency.objects.filter(pk__in=list(agency_ids)).update(**actual_stats())
+
+
+def batches(batch_size):
+    """Yields the agency ids in ascending lists of at most `batch_size`"""
+    last_id = 0
+    while True:
+        ids = list(Agency.objects.filter(pk__gt=last_id).order_by("pk").values_list("pk", flat=True)[:batch_size])
+        if not ids:
+            return
+        yield ids
+        last_id = ids[-1]
+
+
+def drift(agency_ids):
+    """Yields a Drift for each column of the given agencies that differs from its rows"""
+    actual = {f"actual_{field}": expression for field, expression in actual_stats().items()}
+    rows = Agency.objects.filter(pk__in=list(agency_ids)).annotate(**actual).values("pk", *STATS, *actual)
+    for row in rows.order_by("pk"):
+        for field in STATS:
+            if row[field] != row[f"actual_{field}"]:
+                yield Drift(row["pk"], field, row[field], row[f"actual_{field}"])
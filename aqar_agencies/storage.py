@@ -0,0 +1,178 @@
+import hashlib
+import os
+import re
+import tempfile
+import threading
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, Storage
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.deconstruct import deconstructible
+from django.utils.encoding import filepath_to_uri
+from django.utils.module_loading import import_string
+
+BLOB_DIR = "blobs"
+BLOB_NAME = re.compile(rf"^{BLOB_DIR}/[0-9a-f]{{2}}/[0-9a-f]{{2}}/(?P<digest>[0-9a-f]{{64}})(\.\w+)?$")
+
+
+def blob_digest(name):
+    """The sha256 a blob is stored under, None for files saved before content addressing"""
+    match = BLOB_NAME.match(name or "")
+    return match.group("digest") if match else None
+
+
+def blob_name(hexdigest, name):
+    extension = os.path.splitext(name)[1].lower()
+    return f"{BLOB_DIR}/{hexdigest[:2]}/{hexdigest[2:4]}/{hexdigest}{extension}"
+
+
+class BlobReferences:
+    """Reference counting of content addressed files, on top of a Storage class"""
+
+    def get_available_name(self, name, max_length=None):
+        # The final name comes from the content in _save, never from the upload.
+        return name
+
+    def delete(self, name):
+        from .models import Blob
+
+        if blob_digest(name) is None:
+            return super().delete(name)
+        if Blob.objects.release(name):
+            transaction.on_commit(lambda: self._remove_unreferenced(name))
+
+    def _remove_unreferenced(self, name):
+        from .models import Blob
+
+        # An empty row holds the unique name while the file goes, so an upload
+        # of the same bytes that acquires it meanwhile, committed or not,
+        # either makes this fail or waits for the file to be gone and then
+        # puts it back.
+        try:
+            with transaction.atomic():
+                Blob.objects.create(name=name, refcount=0)
+                super().delete(name)
+                Blob.objects.filter(name=name, refcount=0).delete()
+        except IntegrityError:
+            pass
+
+
+@deconstructible
+class ContentAddressedStorage(BlobReferences, FileSystemStorage):
+    """File storage that keeps one copy of each distinct upload.
+
+    Uploads are hashed while they are streamed to a temporary file and then
+    moved to blobs/ab/cd/<sha256><ext>, so the same photo uploaded for many
+    posts is stored once. The Blob table counts the references to each file
+    and the file is only removed when the last one is deleted or replaced.
+    The reference is taken in the transaction that saves the row, so it is
+    rolled back with a save that fails. Because a
+    name always holds the same bytes, blob URLs can be cached forever.
+    """
+
+    def _save(self, name, content):
+        from .models import Blob
+
+        os.makedirs(self.path(".incoming"), exist_ok=True)
+        digest = hashlib.sha256()
+        fd, temporary_path = tempfile.mkstemp(dir=self.path(".incoming"))
+        try:
+            with os.fdopen(fd, "wb") as temporary_file:
+                if hasattr(content, "seek"):
+                    content.seek(0)
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    temporary_file.write(chunk)
+            name = blob_name(digest.hexdigest(), name)
+
+            # The reference is taken before the file is put in place, so a
+            # concurrent removal of the last one either finds the reference or
+            # is done with the file, see _remove_unreferenced.
+            Blob.objects.acquire(name)
+            os.makedirs(os.path.dirname(self.path(name)), exist_ok=True)
+            if self.file_permissions_mode is not None:
+                os.chmod(temporary_path, self.file_permissions_mode)
+            os.replace(temporary_path, self.path(name))
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+        return name
+
+
+@deconstructible
+class InMemoryStorage(Storage):
+    """Files kept in the process's memory, for the tests.
+
+    Nothing touches the disk, so parallel test processes cannot collide and
+    real uploads cannot be overwritten or deleted.
+    """
+
+    def __init__(self, base_url=None):
+        self._base_url = base_url
+        self._files = {}
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return self._base_url or settings.MEDIA_URL
+
+    def _open(self, name, mode="rb"):
+        if name not in self._files:
+            raise FileNotFoundError(name)
+        return ContentFile(self._files[name][0], name=name)
+
+    def _save(self, name, content):
+        if hasattr(content, "seek"):
+            content.seek(0)
+        data = b"".join(content.chunks())
+        with self._lock:
+            self._files[name] = (data, timezone.now())
+        return name
+
+    def delete(self, name):
+        with self._lock:
+            self._files.pop(name, None)
+
+    def exists(self, name):
+        return name in self._files
+
+    def size(self, name):
+        return len(self._files[name][0])
+
+    def get_modified_time(self, name):
+        return self._files[name][1]
+
+    def listdir(self, path):
+        prefix = f"{path.rstrip('/')}/" if path else ""
+        directories, files = set(), set()
+        for name in list(self._files):
+            if name.startswith(prefix):
+                first, _, rest = name[len(prefix):].partition("/")
+                (directories if rest else files).add(first)
+        return sorted(directories), sorted(files)
+
+    def url(self, name):
+        return self.base_url + filepath_to_uri(name)
+
+
+@deconstructible
+class InMemoryContentAddressedStorage(BlobReferences, InMemoryStorage):
+    """ContentAddressedStorage for the tests, in memory"""
+
+    def _save(self, name, content):
+        from .models import Blob
+
+        if hasattr(content, "seek"):
+            content.seek(0)
+        data = b"".join(content.chunks())
+        name = blob_name(hashlib.sha256(data).hexdigest(), name)
+        Blob.objects.acquire(name)
+        return super()._save(name, ContentFile(data))
+
+
+# AQAR_BLOB_STORAGE swaps the class, e.g. for InMemoryContentAddressedStorage
+# in aqarwebsite/settings_test.py.
+blob_storage = import_string(getattr(settings, "AQAR_BLOB_STORAGE", "aqar_agencies.storage.ContentAddressedStorage"))()
@@ -0,0 +1,225 @@
+"""Realistic volumes of made-up users, agencies, posts and comments.
+
+Real listings are unevenly spread: a few agencies post most of them, a few
+areas get most of the posts and a few posts get most of the comments. Each
+of those choices is drawn from a Zipf-like distribution whose exponent is
+`skew` (0 is uniform, 1 is roughly what classified sites see). Rows are
+written with bulk_create, so the counters, comment paths, facet counts and
+search index that signals would keep up to date are rebuilt with set-based
+updates at the end.
+"""
+import itertools
+import json
+import random
+from collections import Counter, namedtuple
+from io import BytesIO
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.db.models import CharField, Count, F, OuterRef, Subquery, Value
+from django.db.models.functions import Cast, Coalesce, Concat, LPad
+from PIL import Image, ImageDraw
+
+from . import facets, search, stats
+from .areas import area_registry
+from .importer import KUWAIT_AREAS, load_area_tree
+from .models import Agency, AgencyMember, Area, Blob, Comment, Post
+from .storage import blob_storage
+
+SyntheticSizes = namedtuple("SyntheticSizes", [
+    "users", "agencies", "posts", "comments", "members_per_agency", "picture_ratio", "pictures", "reply_ratio"])
+
+DEFAULT_SIZES = SyntheticSizes(users=5000, agencies=500, posts=100_000, comments=200_000, members_per_agency=2,
+                               picture_ratio=0.3, pictures=40, reply_ratio=0.3)
+
+# Words for the property types and listing types of Post, in their order.
+PROPERTIES = ["شقة", "دور", "بيت", "فيلا", "أرض", "عمارة", "شاليه", "محل", "مكتب", "مخزن"]
+DEALS = ["للبيع", "للإيجار", "للبدل"]
+# Kuwaiti dinars, rents per month.
+PRICES = {Post.SALE: (40_000, 1_500_000), Post.RENT: (150, 3_000)}
+WORDS = ["واسعة", "جديدة", "مؤثثة", "قريبة", "من", "البحر", "المدارس", "الخدمات", "زاوية", "شارعين", "حديقة",
+         "مسبح", "غرف", "ثلاث", "أربع", "حمامات", "صالة", "مطبخ", "موقف", "سيارات", "تشطيب", "ممتاز", "سعر",
+         "مناسب", "للتواصل", "واتساب", "مباشرة", "المالك", "ديوانية", "سرداب", "مصعد", "تكييف", "مركزي"]
+COMMENTS = ["كم السعر؟", "هل ما زال متوفر؟", "ممكن التفاصيل", "تم التواصل", "السعر قابل للتفاوض؟",
+            "وين الموقع بالضبط؟", "ممكن صور أكثر", "مهتم", "ما شاء الله", "متى ممكن المعاينة؟"]
+
+
+def zipf_weights(count, skew):
+    """Cumulative weights of `count` ranks where rank r weighs 1 / r ** skew"""
+    return list(itertools.accumulate(1 / rank ** skew for rank in range(1, count + 1)))
+
+
+def skewed_sampler(population, skew, rng):
+    """A function returning `k` members of `population`, the first ones far more often when skew > 0"""
+    population = list(population)
+    rng.shuffle(population)
+    cum_weights = zipf_weights(len(population), skew)
+    return lambda k: rng.choices(population, cum_weights=cum_weights, k=k)
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def picture(number, rng):
+    image = Image.new("RGB", (1280, 960), tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        corner = (rng.randrange(1280), rng.randrange(960))
+        draw.rectangle([corner, (corner[0] + rng.randrange(400), corner[1] + rng.randrange(300))],
+                       fill=tuple(rng.randrange(256) for _ in range(3)))
+    content = BytesIO()
+    image.save(content, "JPEG", quality=85)
+    return ContentFile(content.getvalue(), name=f"synthetic-{number}.jpg")
+
+
+class SyntheticData:
+    """Seeds the database, reporting each step to `log(message)`"""
+
+    def __init__(self, sizes=DEFAULT_SIZES, skew=1.0, seed=0, prefix="synthetic", batch_size=5000, log=None):
+        self.sizes = sizes
+        self.skew = skew
+        self.rng = random.Random(seed)
+        self.prefix = prefix
+        self.batch_size = batch_size
+        self.log = log or (lambda message: None)
+
+    def seed(self):
+        with transaction.atomic():
+            user_ids = self.create_users()
+            agency_ids = self.create_agencies(user_ids)
+            area_ids = self.leaf_areas()
+            post_ids = self.create_posts(agency_ids, area_ids)
+            self.create_comments(post_ids, user_ids)
+            self.rebuild_derived(agency_ids, post_ids)
+        area_registry.invalidate()
+        return {"users": len(user_ids), "agencies": len(agency_ids), "areas": len(area_ids),
+                "posts": len(post_ids), "comments": self.sizes.comments}
+
+    def new_ids(self, model, create):
+        # bulk_create does not return primary keys on SQLite, so the new
+        # rows are found again as the ones above the current highest id.
+        last_pk = model.objects.order_by("-pk").values_list("pk", flat=True).first() or 0
+        create()
+        return list(model.objects.filter(pk__gt=last_pk).order_by("pk").values_list("pk", flat=True))
+
+    def create_users(self):
+        start = User.objects.filter(username__startswith=f"{self.prefix}-user-").count()
+        # Hashing a password per user would take longer than everything else.
+        password = make_password(None)
+        users = (User(username=f"{self.prefix}-user-{start + number}", password=password)
+                 for number in range(self.sizes.users))
+        user_ids = self.new_ids(User, lambda: User.objects.bulk_create(users, batch_size=self.batch_size))
+        self.log(f"{len(user_ids)} users")
+        return user_ids
+
+    def create_agencies(self, user_ids):
+        start = Agency.objects.count()
+        agencies = (Agency(name=f"{self.prefix} agency {start + number}", phone_number=f"{50000000 + number}",
+                           email=f"agency{start + number}@example.com")
+                    for number in range(self.sizes.agencies))
+        agency_ids = self.new_ids(Agency, lambda: Agency.objects.bulk_create(agencies, batch_size=self.batch_size))
+
+        members = []
+        for agency_id, owner_id in zip(agency_ids, itertools.cycle(user_ids)):
+            extra = 0
+            if self.sizes.members_per_agency:
+                extra = min(int(self.rng.expovariate(1 / self.sizes.members_per_agency)), 25, len(user_ids))
+            member_ids = {owner_id, *self.rng.sample(user_ids, extra)}
+            members += [AgencyMember(agency_id=agency_id, member_id=member_id, is_admin=member_id == owner_id)
+                        for member_id in member_ids]
+        AgencyMember.objects.bulk_create(members, batch_size=self.batch_size)
+        self.log(f"{len(agency_ids)} agencies with {len(members)} members")
+        return agency_ids
+
+    def leaf_areas(self):
+        if not Area.objects.exists():
+            with open(KUWAIT_AREAS, encoding="utf-8") as source:
+                load_area_tree(json.load(source))
+        return list(Area.objects.filter(children=None).values_list("pk", flat=True))
+
+    def create_pictures(self):
+        names = []
+        for number in range(self.sizes.pictures):
+            # Saving takes one reference, which is handed over to the posts.
+            names.append(blob_storage.save(f"posts/synthetic-{number}.jpg", picture(number, self.rng)))
+        return names
+
+    def create_posts(self, agency_ids, area_ids):
+        agency_for = skewed_sampler(agency_ids, self.skew, self.rng)
+        area_for = skewed_sampler(area_ids, self.skew, self.rng)
+        pictures = self.create_pictures() if self.sizes.picture_ratio and self.sizes.pictures else []
+        uses = Counter()
+
+        def posts():
+            for agencies, areas in zip(batched(agency_for(self.sizes.posts), self.batch_size),
+                                       batched(area_for(self.sizes.posts), self.batch_size)):
+                for agency_id, area_id in zip(agencies, areas):
+                    kind, deal = self.rng.randrange(len(PROPERTIES)), self.rng.randrange(len(DEALS))
+                    post = Post(agency_id=agency_id, area_id=area_id, title=f"{PROPERTIES[kind]} {DEALS[deal]}",
+                                body=" ".join(self.rng.choices(WORDS, k=self.rng.randint(8, 40))),
+                                property_type=Post.PROPERTY_TYPES[kind][0], size_sqm=self.rng.randint(60, 1000))
+                    # Swaps have neither a listing type nor a price.
+                    if deal < len(Post.LISTING_TYPES):
+                        post.listing_type = Post.LISTING_TYPES[deal][0]
+                        low, high = PRICES[post.listing_type]
+                        post.price = int(round(self.rng.uniform(low, high), -1 if high < 10_000 else -3))
+                    if pictures and self.rng.random() < self.sizes.picture_ratio:
+                        post.picture = self.rng.choice(pictures)
+                        uses[post.picture.name] += 1
+                    yield post
+
+        post_ids = self.new_ids(Post, lambda: Post.objects.bulk_create(posts(), batch_size=self.batch_size))
+        for name in pictures:
+            if uses[name]:
+                Blob.objects.filter(name=name).update(refcount=F("refcount") + uses[name] - 1)
+            else:
+                blob_storage.delete(name)
+        self.log(f"{len(post_ids)} posts, {sum(uses.values())} with one of {len(pictures)} pictures")
+        return post_ids
+
+    def create_comments(self, post_ids, user_ids):
+        if not post_ids or not user_ids or self.sizes.comments < 1:
+            return
+        post_for = skewed_sampler(post_ids, self.skew, self.rng)
+        # At least one comment answers the post itself, for the replies to answer.
+        replies = min(int(self.sizes.comments * self.sizes.reply_ratio), self.sizes.comments - 1)
+
+        def comments(count, parents=None):
+            posts = post_for(count) if parents is None else [None] * count
+            for post_id in posts:
+                comment = Comment(user_id=self.rng.choice(user_ids), message=self.rng.choice(COMMENTS))
+                if parents is None:
+                    comment.post_id = post_id
+                else:
+                    comment.parent_id, comment.post_id = self.rng.choice(parents)
+                yield comment
+
+        step = Comment.PATH_STEP
+        own_id = LPad(Cast("pk", CharField()), step, Value("0"))
+        top_ids = self.new_ids(Comment, lambda: Comment.objects.bulk_create(
+            comments(self.sizes.comments - replies), batch_size=self.batch_size))
+        Comment.objects.filter(pk__range=(top_ids[0], top_ids[-1])).update(path=Concat(own_id, Value("/")))
+        if replies:
+            parents = list(Comment.objects.filter(pk__range=(top_ids[0], top_ids[-1])).values_list("pk", "post_id"))
+            reply_ids = self.new_ids(Comment, lambda: Comment.objects.bulk_create(
+                comments(replies, parents), batch_size=self.batch_size))
+            parent_path = Subquery(Comment.objects.filter(pk=OuterRef("parent_id")).values("path")[:1])
+            Comment.objects.filter(pk__range=(reply_ids[0], reply_ids[-1])).update(path=Concat(parent_path, own_id, Value("/")))
+        self.log(f"{self.sizes.comments} comments, {replies} of them replies")
+
+    def rebuild_derived(self, agency_ids, post_ids):
+        for ids in batched(post_ids, self.batch_size):
+            counts = Comment.objects.filter(post=OuterRef("pk")).order_by().values("post").annotate(
+                count=Count("pk")).values("count")
+            Post.objects.filter(pk__range=(ids[0], ids[-1])).update(comments_count=Coalesce(Subquery(counts), 0))
+        for ids in batched(agency_ids, self.batch_size):
+            stats.recompute(ids)
+        facets.rebuild()
+        if search.is_supported():
+            search.rebuild_index(self.batch_size)
+        self.log("Rebuilt the counters, the facet counts and the search index")
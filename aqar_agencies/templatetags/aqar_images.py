@@ -0,0 +1,29 @@
+from django import template
+from django.urls import reverse
+from django.utils.html import format_html, format_html_join
+
+from ..images import VARIANT_FORMATS, VARIANT_WIDTHS
+
+register = template.Library()
+
+
+@register.simple_tag
+def srcset(image, fmt="jpeg"):
+    """The srcset of an uploaded image, pointing at variants that are generated on first request"""
+    if not image:
+        return ""
+    return ", ".join(
+        f"{reverse('image_variant', args=[width, fmt, image.name])} {width}w" for width in VARIANT_WIDTHS)
+
+
+@register.simple_tag
+def responsive_image(image, alt="", sizes="100vw"):
+    if not image:
+        return ""
+    sources = format_html_join(
+        "", '<source type="image/{}" srcset="{}" sizes="{}">',
+        ((fmt, srcset(image, fmt), sizes) for fmt in VARIANT_FORMATS if fmt != "jpeg"))
+    return format_html(
+        '<picture>{}<img src="{}" srcset="{}" sizes="{}" alt="{}" loading="lazy"></picture>',
+        sources, reverse("image_variant", args=[VARIANT_WIDTHS[0], "jpeg", image.name]),
+        srcset(image), sizes, alt)
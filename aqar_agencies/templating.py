@@ -0,0 +1,75 @@
+"""Template loading for production and the Jinja2 listing templates.
+
+With AQAR_PROFILE=production the Django engine parses each template once
+per process through the cached loader, and wsgi.py and asgi.py call
+precompile_templates() so that the first requests do not pay for it.
+Under gunicorn --preload this happens once, before the workers fork.
+
+The listing fragments, the area feed and the agency profile posts, also
+exist as Jinja2 templates in aqar_agencies/jinja2. When jinja2 is
+installed settings.py adds that engine and render_listing() uses it, with
+the Django templates as the fallback.
+"""
+from pathlib import Path
+
+from django.conf import settings
+from django.template import TemplateDoesNotExist, engines
+from django.template.backends.django import DjangoTemplates
+from django.template.loader import render_to_string
+
+from .instrumentation import timed_template
+
+try:
+    from django.template.backends.jinja2 import Jinja2
+except ImportError:
+    Jinja2 = None
+
+LISTING_ENGINE = "jinja2"
+
+
+def project_template_names(engine):
+    """Names of the templates of a Django engine found under BASE_DIR, the admin's are left out"""
+    base_dir = Path(settings.BASE_DIR).resolve()
+    names = set()
+    for loader in engine.engine.template_loaders:
+        for directory in getattr(loader, "get_dirs", lambda: [])():
+            directory = Path(directory)
+            if not directory.is_dir() or base_dir not in directory.resolve().parents:
+                continue
+            names.update(path.relative_to(directory).as_posix() for path in directory.rglob("*") if path.is_file())
+    return sorted(names)
+
+
+def precompile_templates():
+    """Loads every project template into the engines' caches and returns their names.
+
+    Only useful with the cached loader, a syntax error is raised here
+    rather than on the first request that needs the template.
+    """
+    compiled = []
+    for engine in engines.all():
+        if isinstance(engine, DjangoTemplates):
+            names = project_template_names(engine)
+            for name in names:
+                engine.get_template(name)
+        elif Jinja2 is not None and isinstance(engine, Jinja2):
+            names = engine.env.list_templates()
+            for name in names:
+                engine.env.get_template(name)
+        else:
+            continue
+        compiled += names
+    return compiled
+
+
+def render_listing(template_name, context):
+    """render_to_string() through the Jinja2 listing engine when it is configured and has the template"""
+    if LISTING_ENGINE in engines.templates:
+        try:
+            template = engines[LISTING_ENGINE].get_template(template_name)
+        except TemplateDoesNotExist:
+            pass
+        else:
+            with timed_template(f"{LISTING_ENGINE}:{template_name}"):
+                return template.render(context)
+    return render_to_string(template_name, context)
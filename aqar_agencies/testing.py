@@ -0,0 +1,79 @@
+"""Helpers for the test suite"""
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.test import AsyncClient, Client
+from django.urls import URLPattern, URLResolver, get_resolver
+
+from . import cache, facets, search, stats
+from .areas import area_registry
+from .models import Post
+
+
+def check_query_budget(response):
+    """Raises AssertionError if the request behind a test client response ran more queries than its view allows"""
+    request = getattr(response, "wsgi_request", None) or getattr(response, "asgi_request", None)
+    recorded = getattr(request, "query_stats", None)
+    if recorded is None or recorded.budget is None:
+        return response
+    if recorded.queries > recorded.budget:
+        raise AssertionError(f"{recorded.method} {recorded.path} ran {recorded.queries} queries, "
+                             f"{recorded.view} has a query_budget of {recorded.budget}")
+    return response
+
+
+class QueryBudgetClient(Client):
+    def request(self, **request):
+        return check_query_budget(super().request(**request))
+
+
+class AsyncQueryBudgetClient(AsyncClient):
+    async def request(self, **request):
+        return check_query_budget(await super().request(**request))
+
+
+class QueryBudgetMixin:
+    """Fails a TestCase whenever a view it requests runs more queries than its query_budget"""
+    client_class = QueryBudgetClient
+    async_client_class = AsyncQueryBudgetClient
+
+
+def views_without_budget(module_prefix="aqar_agencies", resolver=None):
+    """Names of the URL patterns whose view, defined under `module_prefix`, declares no query_budget"""
+    missing = []
+    for pattern in (resolver or get_resolver()).url_patterns:
+        if isinstance(pattern, URLResolver):
+            missing += views_without_budget(module_prefix, pattern)
+        elif isinstance(pattern, URLPattern):
+            view = pattern.callback
+            if view.__module__.startswith(module_prefix) and getattr(view, "query_budget", None) is None:
+                missing.append(pattern.name or pattern.lookup_str)
+    return missing
+
+
+def make_users(count, prefix="user"):
+    """`count` users inserted with one query, named prefix0, prefix1... and without a usable password"""
+    password = make_password(None)
+    usernames = [f"{prefix}{number}" for number in range(count)]
+    User.objects.bulk_create([User(username=username, password=password) for username in usernames])
+    return list(User.objects.filter(username__in=usernames).order_by("pk"))
+
+
+def make_posts(agency, area, count, title="Sale {number}", body="Great sale", **attributes):
+    """`count` posts of `agency` in `area` inserted with one query, oldest first.
+
+    bulk_create skips the signals, so the agency's counters, the facet
+    counts, the search index and the cached pages are brought up to date
+    here instead.
+    """
+    last_pk = Post.objects.order_by("-pk").values_list("pk", flat=True).first() or 0
+    Post.objects.bulk_create([Post(agency=agency, area=area, title=title.format(number=number), body=body,
+                                   **attributes) for number in range(count)])
+    posts = list(Post.objects.filter(pk__gt=last_pk).order_by("pk"))
+    stats.recompute([agency.pk])
+    facets.recompute([area.pk])
+    if search.is_supported():
+        search.index_rows([(post.pk, post.title, post.body, post.area_id) for post in posts])
+    cache.bump("agency", agency.pk)
+    for area_id in area_registry.lineage(area.pk):
+        cache.bump("area", area_id)
+    return posts
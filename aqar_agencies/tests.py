@@ -1,22 +1,31 @@
 import os
-from django.test import TestCase
-from django.urls import reverse
+import shutil
+import tempfile
+from django.conf import settings
+from django.template import Context, Template
+from django.http import HttpResponse
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import include, path, reverse
+from django.utils import timezone
 from django.contrib import auth
 from django.contrib.auth.models import User
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import IntegrityError, transaction
 
+from aqar_agencies import views
 from aqar_agencies.views import agency_choice
-from .models import Agency, AgencyMember, Area, Post, Comment
+from .models import Agency, AgencyMember, Area, Blob, Post, Comment
+from .areas import area_registry
+from .testing import QueryBudgetMixin, make_posts, make_users, views_without_budget
+from . import images
 from .forms import AgencyCreateForm, AgencyChoiceForm
 from django.core.exceptions import ValidationError
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth import authenticate
-from io import BytesIO
+from io import BytesIO, StringIO
+from PIL import Image
 
-def delete_test_images(dir):
-    """Deletes all photos in the specified path"""
-    for photo in os.listdir(dir):
-        os.remove(os.path.join(dir, photo)) # Delete all generated photos
+TEST_IMAGE = settings.BASE_DIR / "static" / "images" / "test.jpeg"
 
 
 class AgencyModelTests(TestCase):
@@ -63,7 +72,6 @@ class AgencyModelTests(TestCase):
             name="عقار بوحسين",
             profile_picture=SimpleUploadedFile(name='test_image.jpg', content=b'', content_type='image/jpeg')
             )
-        delete_test_images("uploads/profile_picture")
 
     def test_agency_bad_profile_picture(self):
         """An agency creation with a photo that has the wrong file extension will raise an error"""
@@ -123,6 +131,34 @@ class AgencyModelTests(TestCase):
         self.assertNotEqual(agency.verification, self.member)
         self.assertIsNone(agency.verification)
 
+    def test_agency_verified_through_stale_instance(self):
+        """Two admins holding the same agency cannot both verify it"""
+        second_user = User.objects.create(username="alkhulaifi2")
+        agency = Agency.objects.new(self.member, name="عقار بوحسين")
+        same_agency = Agency.objects.get(pk=agency.pk)
+        agency.verified_by(self.member)
+        with self.assertRaises(ValidationError):
+            same_agency.verified_by(second_user)
+        self.assertEqual(Agency.objects.get(pk=agency.pk).verification, self.member)
+
+    def test_agency_verification_is_one_update(self):
+        agency = Agency.objects.new(self.member, name="عقار بوحسين")
+        with self.assertNumQueries(1):
+            agency.verified_by(self.member)
+        with self.assertNumQueries(1):
+            agency.unverify()
+
+    def test_bulk_verify_reports_changed_agencies(self):
+        agencies = [Agency.objects.new(self.member, name=f"عقار بوحسين {number}") for number in range(3)]
+        agencies[0].verified_by(self.member)
+        changed = Agency.objects.filter(pk__in=[agency.pk for agency in agencies]).verify(self.member)
+        self.assertEqual(sorted(changed), [agencies[1].pk, agencies[2].pk])
+        self.assertEqual(Agency.objects.filter(verification=self.member).count(), 3)
+
+        changed = Agency.objects.filter(pk=agencies[0].pk).unverify()
+        self.assertEqual(changed, [agencies[0].pk])
+        self.assertEqual(Agency.objects.filter(pk=agencies[0].pk).unverify(), [])
+
     def test_agency_with_multiple_members(self):
         agency = Agency.objects.new(self.member, name="عقار بوحسين")
         member2 = User.objects.create(username="guy2")
@@ -135,6 +171,72 @@ class AgencyModelTests(TestCase):
         self.assertEqual(len(agency.members.all()), 3)
 
 
+class AgencyStatsTests(TestCase):
+
+    def setUp(self):
+        self.member = User.objects.create(username="alkhulaifi")
+        self.agency = Agency.objects.new(self.member, name="Test Agency")
+        self.area = Area.objects.new(name="Qortuba")
+
+    def stats(self, agency=None):
+        return Agency.objects.values("posts_count", "members_count", "last_posted_at").get(
+            pk=(agency or self.agency).pk)
+
+    def test_new_agency_counts_its_owner(self):
+        self.assertEqual(self.stats(), {"posts_count": 0, "members_count": 1, "last_posted_at": None})
+
+    def test_posts_and_members_are_counted(self):
+        first = self.agency.add_post(area=self.area, title="First", body="First sale")
+        second = self.agency.add_post(area=self.area, title="Second", body="Second sale")
+        self.agency.add_member(User.objects.create(username="guy2"), is_admin=False)
+        self.assertEqual(self.stats(), {"posts_count": 2, "members_count": 2, "last_posted_at": second.created_at})
+
+        second.delete()
+        self.assertEqual(self.stats()["last_posted_at"], first.created_at)
+        first.delete()
+        AgencyMember.objects.filter(agency=self.agency, member__username="guy2").delete()
+        self.assertEqual(self.stats(), {"posts_count": 0, "members_count": 1, "last_posted_at": None})
+
+    def test_moving_a_post_moves_its_count(self):
+        other = Agency.objects.new(self.member, name="Other Agency")
+        post = self.agency.add_post(area=self.area, title="Sale", body="Sale")
+        post = Post.objects.get(pk=post.pk)
+        post.agency = other
+        post.save()
+        self.assertEqual(self.stats()["posts_count"], 0)
+        self.assertEqual(self.stats(other), {"posts_count": 1, "members_count": 1, "last_posted_at": post.created_at})
+
+    def test_stale_instance_does_not_overwrite_counts(self):
+        stale = Agency.objects.get(pk=self.agency.pk)
+        self.agency.add_post(area=self.area, title="Sale", body="Sale")
+        stale.twitter = "agency"
+        stale.save()
+        self.assertEqual(self.stats()["posts_count"], 1)
+
+    def test_failed_post_leaves_counts_alone(self):
+        with self.assertRaises(ValidationError):
+            self.agency.add_post(area=self.area, title="Sale")
+        self.assertEqual(self.stats()["posts_count"], 0)
+
+    def test_recompute_agency_stats_repairs_drift(self):
+        from django.core.management import call_command, CommandError
+        post = self.agency.add_post(area=self.area, title="Sale", body="Sale")
+        Post.objects.bulk_create([Post(agency=self.agency, area=self.area, title="Bulk", body="Bulk")])
+        Agency.objects.filter(pk=self.agency.pk).update(members_count=7)
+
+        output = StringIO()
+        with self.assertRaises(CommandError):
+            call_command("recompute_agency_stats", "--check", stdout=output)
+        self.assertIn(f"Agency {self.agency.pk}: posts_count is 1, should be 2", output.getvalue())
+        self.assertIn("members_count is 7, should be 1", output.getvalue())
+
+        call_command("recompute_agency_stats", "--batch-size", "1", stdout=StringIO())
+        self.assertEqual(self.stats()["posts_count"], 2)
+        self.assertEqual(self.stats()["members_count"], 1)
+        self.assertGreaterEqual(self.stats()["last_posted_at"], post.created_at)
+        call_command("recompute_agency_stats", "--check", stdout=StringIO())
+
+
 class AgencyMemberModelTests(TestCase):
 
     def setUp(self):
@@ -178,6 +280,173 @@ class AreaModelTests(TestCase):
         with self.assertRaises(ValidationError):
             Area.objects.new(name="Qortuba")
 
+    def test_create_area_normalized_name_already_exists(self):
+        """Alef/hamza forms, tatweel and diacritics do not make a new name"""
+        Area.objects.new(name="الأحمدي")
+        with self.assertRaises(ValidationError):
+            Area.objects.new(name="الاحمـدِي")
+
+    def test_get_or_new_returns_existing_area(self):
+        area = Area.objects.new(name="Qortuba")
+        same_area, created = Area.objects.get_or_new(name="qortuba ")
+        self.assertFalse(created)
+        self.assertEqual(area, same_area)
+
+
+class AreaTreeTests(TestCase):
+
+    def setUp(self):
+        self.hawalli = Area.objects.new(name="حولي", kind=Area.GOVERNORATE)
+        self.salmiya = Area.objects.new(name="السالمية", parent=self.hawalli)
+        self.block = Area.objects.new(name="قطعة 1", parent=self.salmiya, kind=Area.BLOCK)
+        self.capital = Area.objects.new(name="العاصمة", kind=Area.GOVERNORATE)
+        self.member = User.objects.create(username="alkhulaifi")
+        self.agency = Agency.objects.new(self.member, name="Test Agency")
+
+    def test_paths_follow_the_parents(self):
+        self.assertEqual(self.block.path, f"{self.hawalli.pk:010d}/{self.salmiya.pk:010d}/{self.block.pk:010d}/")
+        self.assertEqual(self.block.depth, 2)
+        self.assertEqual(area_registry.lineage(self.block.pk), [self.hawalli.pk, self.salmiya.pk, self.block.pk])
+        self.assertEqual(list(Area.objects.subtree(self.hawalli).order_by("path")),
+                         [self.hawalli, self.salmiya, self.block])
+
+    def test_names_are_unique_per_parent(self):
+        Area.objects.new(name="قطعة 1", parent=self.hawalli, kind=Area.BLOCK)
+        Area.objects.new(name="حولي", parent=self.hawalli)
+        with self.assertRaises(ValidationError):
+            Area.objects.new(name="قطعة 1", parent=self.salmiya, kind=Area.BLOCK)
+        with self.assertRaises(ValidationError):
+            Area.objects.new(name="حولي")
+        self.assertEqual(area_registry.id_for("حولي"), self.hawalli.pk)
+
+    def test_posts_of_a_subtree(self):
+        in_block = Post.objects.new(agency=self.agency, area=self.block, title="Block", body="Sale")
+        in_salmiya = Post.objects.new(agency=self.agency, area=self.salmiya, title="Salmiya", body="Sale")
+        Post.objects.new(agency=self.agency, area=self.capital, title="Capital", body="Sale")
+        self.assertEqual(set(Post.objects.in_area(self.hawalli.pk)), {in_block, in_salmiya})
+        self.assertEqual(list(Post.objects.in_area(self.block.pk)), [in_block])
+        self.assertEqual(list(Post.objects.in_area(0)), [])
+
+        get_response = self.client.get(reverse("area_feed", args=[self.hawalli.pk]))
+        self.assertEqual(set(get_response.context["posts"]), {in_block, in_salmiya})
+        self.assertEqual(self.client.get(reverse("search"), {"q": "sale", "area": self.hawalli.pk}).context["posts"],
+                         [in_salmiya, in_block])
+
+    def test_moving_an_area_moves_its_subtree(self):
+        post = Post.objects.new(agency=self.agency, area=self.block, title="Block", body="Sale")
+        self.salmiya.parent = self.capital
+        self.salmiya.save()
+        self.block.refresh_from_db()
+        self.assertTrue(self.block.path.startswith(self.capital.path))
+        self.assertEqual(list(Post.objects.in_area(self.capital.pk)), [post])
+        self.assertEqual(list(Post.objects.in_area(self.hawalli.pk)), [])
+        self.assertEqual(self.client.get(reverse("search"), {"q": "sale", "area": self.capital.pk}).context["posts"],
+                         [post])
+
+    def test_area_cannot_move_under_itself(self):
+        self.hawalli.parent = self.block
+        with self.assertRaises(ValidationError):
+            self.hawalli.save()
+
+    def test_load_areas_adopts_top_level_areas(self):
+        from django.core.management import call_command
+        qortuba = Area.objects.new(name="قرطبة")
+        call_command("load_areas", stdout=StringIO())
+        qortuba.refresh_from_db()
+        capital = Area.objects.get(parent=None, name="العاصمة")
+        self.assertEqual((qortuba.parent, qortuba.kind), (capital, Area.AREA))
+        self.assertEqual(Area.objects.filter(kind=Area.GOVERNORATE).count(), 6)
+
+        output = StringIO()
+        call_command("load_areas", stdout=output)
+        self.assertIn("Created 0 areas, moved 0", output.getvalue())
+
+    def test_load_area_tree_adds_blocks(self):
+        from .importer import load_area_tree
+        counts = load_area_tree([{"name": "حولي", "kind": Area.GOVERNORATE,
+                                  "children": [{"name": "السالمية", "blocks": 3}]}])
+        self.assertEqual(counts["created"], 2)
+        self.assertEqual(list(self.salmiya.children.order_by("path").values_list("name", flat=True)),
+                         ["قطعة 1", "قطعة 2", "قطعة 3"])
+
+
+    def test_load_area_tree_moves_a_town_named_like_its_governorate(self):
+        from .importer import load_area_tree
+        jahra = Area.objects.new(name="الجهراء")
+        post = Post.objects.new(agency=self.agency, area=jahra, title="Jahra", body="Sale")
+        tree = [{"name": "الجهراء", "kind": Area.GOVERNORATE, "children": [{"name": "الجهراء"}]}]
+        counts = load_area_tree(tree)
+        self.assertEqual((counts["created"], counts["moved"]), (1, 1))
+        jahra.refresh_from_db()
+        governorate = Area.objects.get(parent=None, name="الجهراء")
+        self.assertEqual((governorate.kind, jahra.parent, jahra.kind), (Area.GOVERNORATE, governorate, Area.AREA))
+        self.assertEqual(list(Post.objects.in_area(jahra.pk)), [post])
+        self.assertEqual(list(Post.objects.in_area(governorate.pk)), [post])
+        self.assertEqual(sum(load_area_tree(tree).values()), 0)
+
+class AreaRegistryTests(TransactionTestCase):
+
+    def setUp(self):
+        area_registry.invalidate()
+        self.area = Area.objects.new(name="قرطبة")
+
+    def test_lookups_are_cached(self):
+        area_registry.name(self.area.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(area_registry.name(self.area.pk), "قرطبة")
+            self.assertEqual(area_registry.id_for("قُرطبة"), self.area.pk)
+            self.assertIn(self.area.pk, area_registry)
+
+    def test_saving_an_area_invalidates_the_registry(self):
+        area_registry.name(self.area.pk)
+        Area.objects.new(name="السالمية")
+        self.assertEqual(len(area_registry), 2)
+
+    def test_deleting_an_area_invalidates_the_registry(self):
+        area_registry.name(self.area.pk)
+        self.area.delete()
+        self.assertNotIn(self.area.pk, area_registry)
+
+    def test_areas_changed_by_another_worker_are_reloaded(self):
+        from unittest import mock
+        from . import areas, cache
+        area_registry.name(self.area.pk)
+        with mock.patch.object(areas, "VERSION_CHECK_SECONDS", 0):
+            with self.assertNumQueries(0):
+                self.assertEqual(area_registry.name(self.area.pk), "قرطبة")
+            # What another process does: the row changes without the signals
+            # of this one, which only sees the shared version move.
+            Area.objects.filter(pk=self.area.pk).update(name="قرطبة الجديدة")
+            cache.bump("areas", "all")
+            self.assertFalse(area_registry.loaded)
+            self.assertEqual(area_registry.name(self.area.pk), "قرطبة الجديدة")
+
+    def test_transactions_use_the_cached_snapshot(self):
+        area_registry.name(self.area.pk)
+        with transaction.atomic(), self.assertNumQueries(0):
+            self.assertEqual(area_registry.name(self.area.pk), "قرطبة")
+            self.assertEqual(area_registry.lineage(self.area.pk), [self.area.pk])
+
+    def test_a_transaction_sees_the_areas_it_writes(self):
+        area_registry.name(self.area.pk)
+        with transaction.atomic():
+            salmiya = Area.objects.new(name="السالمية")
+            self.assertIn(salmiya.pk, area_registry)
+        with transaction.atomic(), self.assertNumQueries(1):
+            self.assertIn(salmiya.pk, area_registry)
+            self.assertIn(salmiya.pk, area_registry)
+
+    def test_a_rolled_back_area_is_forgotten(self):
+        area_registry.name(self.area.pk)
+        with transaction.atomic():
+            with transaction.atomic():
+                salmiya = Area.objects.new(name="السالمية")
+                self.assertIn(salmiya.pk, area_registry)
+                transaction.set_rollback(True)
+            with self.assertNumQueries(1):
+                self.assertNotIn(salmiya.pk, area_registry)
+                self.assertEqual(len(area_registry), 1)
+
 
 class PostModelTests(TestCase):
 
@@ -209,13 +478,11 @@ class PostModelTests(TestCase):
     def test_post_good_post_picture(self):
         Post.objects.new(agency=self.agency, area=self.area, title="Best Sale", body="This Sale is Great", 
             picture=SimpleUploadedFile(name='test_image.jpg', content=b'', content_type='image/jpeg'))
-        delete_test_images("uploads/posts")
 
     def test_post_bad_post_picture(self):
         with self.assertRaises(ValidationError):
             Post.objects.new(agency=self.agency, area=self.area, title="Best Sale", body="This Sale is Great", 
                 picture=SimpleUploadedFile(name="test.txt", content=b"test", content_type='text/txt'))
-        delete_test_images("uploads/posts")
 
 
 class CommentModelTests(TestCase):
@@ -242,9 +509,127 @@ class CommentModelTests(TestCase):
             Best SaleBest SaleBBest SaleBest SaleBBest SaleBest SaleBBest SaleBest SaleB
             Best SaleBest SaleBBest SaleBest SaleBBest SaleBest SaleBBest SaleBest SaleB""")
 
+    def test_deleting_a_post_skips_the_work_for_each_comment(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        def delete_queries(comments):
+            post = Post.objects.new(agency=self.agency, area=self.area, title="Sale", body="Look at this sale")
+            for number in range(comments):
+                post.add_comment(self.member, f"Comment {number}")
+            post = Post.objects.get(pk=post.pk)
+            with CaptureQueriesContext(connection) as queries:
+                post.delete()
+            return len(queries)
+
+        self.assertEqual(delete_queries(11), delete_queries(1))
+
+    def test_deleting_a_comment_updates_the_count(self):
+        comment = self.post.add_comment(self.member, "Nice Sale, good job")
+        self.post.add_comment(self.member, "Another one")
+        Comment.objects.get(pk=comment.pk).delete()
+        self.assertEqual(Post.objects.get(pk=self.post.pk).comments_count, 1)
+
+    def test_add_comment(self):
+        comment = self.post.add_comment(self.member, "Nice Sale, good job")
+        self.assertEqual(comment.depth, 0)
+        self.assertIn("alkhulaifi", str(comment))
+
+    def test_replies_load_as_one_thread(self):
+        first = self.post.add_comment(self.member, "First")
+        second = self.post.add_comment(self.member, "Second")
+        reply = self.post.add_comment(self.member, "Reply to first", parent=first)
+        nested = self.post.add_comment(self.member, "Reply to reply", parent=reply)
+        self.assertEqual(nested.depth, 2)
+        with self.assertNumQueries(1):
+            thread = [comment.message for comment in Comment.objects.thread(self.post)]
+        self.assertEqual(thread, ["First", "Reply to first", "Reply to reply", "Second"])
+        self.assertEqual(list(Comment.objects.replies(first)), [reply, nested])
+        self.assertEqual(list(Comment.objects.replies(second)), [])
+
+    def test_reply_must_be_on_the_same_post(self):
+        other_post = Post.objects.new(agency=self.agency, area=self.area, title="Other Sale", body="Another sale")
+        comment = self.post.add_comment(self.member, "First")
+        with self.assertRaises(ValidationError):
+            other_post.add_comment(self.member, "Reply", parent=comment)
+
+    def test_thread_depth_is_limited(self):
+        comment = self.post.add_comment(self.member, "0")
+        for depth in range(1, Comment.MAX_DEPTH):
+            comment = self.post.add_comment(self.member, str(depth), parent=comment)
+        with self.assertRaises(ValidationError):
+            self.post.add_comment(self.member, "Too deep", parent=comment)
+
+    def test_comments_count(self):
+        first = self.post.add_comment(self.member, "First")
+        self.post.add_comment(self.member, "Reply", parent=first)
+        self.post.add_comment(self.member, "Second")
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.comments_count, 3)
+        first.delete()
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.comments_count, 1)
+
+    def test_saving_a_stale_post_keeps_the_count(self):
+        stale = Post.objects.get(pk=self.post.pk)
+        self.post.add_comment(self.member, "First")
+        stale.title = "Edited Sale"
+        stale.save()
+        self.post.refresh_from_db()
+        self.assertEqual((self.post.title, self.post.comments_count), ("Edited Sale", 1))
+
+    def test_add_comment(self):
+        comment = self.post.add_comment(self.member, "Nice Sale, good job")
+        self.assertEqual(comment.depth, 0)
+        self.assertIn("alkhulaifi", str(comment))
+
+    def test_replies_load_as_one_thread(self):
+        first = self.post.add_comment(self.member, "First")
+        second = self.post.add_comment(self.member, "Second")
+        reply = self.post.add_comment(self.member, "Reply to first", parent=first)
+        nested = self.post.add_comment(self.member, "Reply to reply", parent=reply)
+        self.assertEqual(nested.depth, 2)
+        with self.assertNumQueries(1):
+            thread = [comment.message for comment in Comment.objects.thread(self.post)]
+        self.assertEqual(thread, ["First", "Reply to first", "Reply to reply", "Second"])
+        self.assertEqual(list(Comment.objects.replies(first)), [reply, nested])
+        self.assertEqual(list(Comment.objects.replies(second)), [])
+
+    def test_reply_must_be_on_the_same_post(self):
+        other_post = Post.objects.new(agency=self.agency, area=self.area, title="Other Sale", body="Another sale")
+        comment = self.post.add_comment(self.member, "First")
+        with self.assertRaises(ValidationError):
+            other_post.add_comment(self.member, "Reply", parent=comment)
+
+    def test_thread_depth_is_limited(self):
+        comment = self.post.add_comment(self.member, "0")
+        for depth in range(1, Comment.MAX_DEPTH):
+            comment = self.post.add_comment(self.member, str(depth), parent=comment)
+        with self.assertRaises(ValidationError):
+            self.post.add_comment(self.member, "Too deep", parent=comment)
+
+    def test_comments_count(self):
+        first = self.post.add_comment(self.member, "First")
+        self.post.add_comment(self.member, "Reply", parent=first)
+        self.post.add_comment(self.member, "Second")
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.comments_count, 3)
+        first.delete()
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.comments_count, 1)
+
+    def test_saving_a_stale_post_keeps_the_count(self):
+        stale = Post.objects.get(pk=self.post.pk)
+        self.post.add_comment(self.member, "First")
+        stale.title = "Edited Sale"
+        stale.save()
+        self.post.refresh_from_db()
+        self.assertEqual((self.post.title, self.post.comments_count), ("Edited Sale", 1))
+
+
 # --------------------------------------------------------------------------------------
 
-class IndexViewTests(TestCase):
+class IndexViewTests(QueryBudgetMixin, TestCase):
     
     def test_response(self):
         get_response = self.client.get(reverse("index"))
@@ -264,7 +649,7 @@ class IndexViewTests(TestCase):
         self.assertContains(get_response, "Your name is: alkhulaifi", status_code=200)
 
 
-class RegisterViewTests(TestCase):
+class RegisterViewTests(QueryBudgetMixin, TestCase):
 
     def test_get_response(self):
         get_response = self.client.get(reverse("register"))
@@ -287,7 +672,7 @@ class RegisterViewTests(TestCase):
         self.assertRedirects(post_response, "/")
 
 
-class AuthViewsTests(TestCase):
+class AuthViewsTests(QueryBudgetMixin, TestCase):
     def setUp(self):
         self.client.post(reverse("register"), {
             "username": "alkhulaifi",
@@ -390,15 +775,15 @@ class AuthViewsTests(TestCase):
         self.assertTemplateUsed(get_request, "registration/password_change_done.html")
 
 
-class AgencyCreateViewTest(TestCase):
+class AgencyCreateViewTest(QueryBudgetMixin, TestCase):
     
     def setUp(self):
         self.client.post(reverse("register"), {
             "username": "alkhulaifi",
             "password1": "Open4khulaifi",
             "password2": "Open4khulaifi"})
-        self.upload_file = open(
-            "/Users/alialkhelaifi/Google_Drive/Projects/aqarwebsite/static/images/test.jpeg", 'rb')
+        self.upload_file = open(TEST_IMAGE, 'rb')
+        self.addCleanup(self.upload_file.close)
 
     def test_agency_view_logged_out(self):
         """Tests that the user cannot see the agency create page without logging in"""
@@ -434,9 +819,6 @@ class AgencyCreateViewTest(TestCase):
             SimpleUploadedFile(self.upload_file.name, self.upload_file.read())}
         form = AgencyCreateForm(text_data, file_data)
         self.assertTrue(form.is_valid())
-        mydir = "uploads/profile_picture"
-        for photo in os.listdir(mydir):
-            os.remove(os.path.join(mydir, photo)) # Delete all generated photos
         
     def test_agency_create_validates_all_fields(self):
         """Tests the all fields in the form work along with their validation"""
@@ -461,10 +843,9 @@ class AgencyCreateViewTest(TestCase):
         self.assertEqual(agency.members.all()[0].username, "alkhulaifi")
         self.assertRedirects(post_response, reverse('index'))
 
-        delete_test_images("uploads/profile_picture")
         
 
-class AgencyChoiceViewTest(TestCase):
+class AgencyChoiceViewTest(QueryBudgetMixin, TestCase):
     def setUp(self):
         self.client.post(reverse("register"), {
             "username": "alkhulaifi",
@@ -560,14 +941,14 @@ class AgencyChoiceViewTest(TestCase):
     #     })
         
 
-class AgencyProfileViewTest(TestCase):
+class AgencyProfileViewTest(QueryBudgetMixin, TestCase):
     def setUp(self):
         self.client.post(reverse("register"), {
             "username": "alkhulaifi",
             "password1": "Open4khulaifi",
             "password2": "Open4khulaifi"})
-        self.upload_file = open(
-            "/Users/alialkhelaifi/Google_Drive/Projects/aqarwebsite/static/images/test.jpeg", 'rb')
+        self.upload_file = open(TEST_IMAGE, 'rb')
+        self.addCleanup(self.upload_file.close)
         profile_picture = SimpleUploadedFile(self.upload_file.name, self.upload_file.read())
         self.client.post(reverse('agency_create'), {
                 'name': "Ali's agency",
@@ -578,7 +959,6 @@ class AgencyProfileViewTest(TestCase):
                 'twitter': "@alkhulaifi",
                 'instagram': "ali.i.alkhulaifi"
             })
-        delete_test_images("uploads/profile_picture")
 
     def test_agency_profile_without_logging_in(self):
         self.client.logout()
@@ -594,4 +974,1376 @@ class AgencyProfileViewTest(TestCase):
 
     def test_agency_profile_member_has_multiple_agencies(self):
         pass
-        
\ No newline at end of file
+        
+
+@override_settings(AQAR_PAGE_CACHE_TIMEOUT=0)
+class AreaFeedViewTest(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.member = User.objects.create(username="alkhulaifi")
+        cls.agency = Agency.objects.new(cls.member, name="Test Agency")
+        cls.area = Area.objects.new(name="Qortuba")
+        make_posts(cls.agency, cls.area, 45)
+        make_posts(cls.agency, Area.objects.new(name="Salmiya"), 1, title="Other sale")
+
+    def test_area_feed_unknown_area(self):
+        get_response = self.client.get(reverse("area_feed", args=[self.area.pk + 100]))
+        self.assertEqual(get_response.status_code, 404)
+
+    def test_area_feed_bad_cursor(self):
+        get_response = self.client.get(reverse("area_feed", args=[self.area.pk]), {"cursor": "nope"})
+        self.assertEqual(get_response.status_code, 400)
+
+    def test_area_feed_out_of_range_cursor(self):
+        import base64
+        for raw in ("2020-01-01T00:00:00+00:00|99999999999999999999999", "2020-01-01T00:00:00|5",
+                    "2020-01-01T00:00:00+00:00|-1"):
+            cursor = base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+            get_response = self.client.get(reverse("area_feed", args=[self.area.pk]), {"cursor": cursor})
+            self.assertEqual(get_response.status_code, 400)
+
+    def test_area_feed_pages_through_every_post_once(self):
+        """Following the cursors visits each post of the area once, newest first"""
+        seen = []
+        cursor = None
+        while True:
+            params = {"cursor": cursor} if cursor else {}
+            get_response = self.client.get(reverse("area_feed", args=[self.area.pk]), params)
+            seen.extend(post.pk for post in get_response.context["posts"])
+            cursor = get_response.context["next_cursor"]
+            if cursor is None:
+                break
+        expected = list(Post.objects.filter(area=self.area).order_by("-created_at", "-id")
+                        .values_list("pk", flat=True))
+        self.assertEqual(seen, expected)
+
+    def test_area_feed_deep_page_costs_the_same_as_first_page(self):
+        first_page = self.client.get(reverse("area_feed", args=[self.area.pk]))
+        cursor = first_page.context["next_cursor"]
+        # Inside the test's transaction the area registry is read for the
+        # name and again for the area's subtree.
+        with self.assertNumQueries(3):
+            self.client.get(reverse("area_feed", args=[self.area.pk]))
+        with self.assertNumQueries(3):
+            get_response = self.client.get(reverse("area_feed", args=[self.area.pk]), {"cursor": cursor})
+        self.assertContains(get_response, "Test Agency")
+
+
+class AgencyProfileQueriesTest(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        self.member = User.objects.create(username="alkhulaifi")
+        self.agency = Agency.objects.new(self.member, name="Test Agency")
+        self.area = Area.objects.new(name="Qortuba")
+        self.client.force_login(self.member)
+
+    def add_posts(self, number_of_posts, comments_per_post):
+        first = Post.objects.count()
+        for number in range(first, first + number_of_posts):
+            post = Post.objects.new(agency=self.agency, area=self.area, title=f"Sale {number}", body="Great sale")
+            commenters = make_users(comments_per_post, prefix=f"user{number}-")
+            for comment_number, commenter in enumerate(commenters):
+                Comment.objects.new(post=post, user=commenter, message=f"Comment {comment_number}")
+
+    def profile_query_count(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as queries:
+            get_response = self.client.get(reverse("agency_profile"))
+        self.assertEqual(get_response.status_code, 200)
+        return len(queries)
+
+    def test_agency_profile_shows_posts_and_comments(self):
+        self.add_posts(1, 1)
+        get_response = self.client.get(reverse("agency_profile"))
+        self.assertContains(get_response, "Test Agency")
+        self.assertContains(get_response, "Sale 0")
+        self.assertContains(get_response, "user0-0: Comment 0")
+
+    def test_agency_profile_limits_comments_per_post(self):
+        self.add_posts(1, 5)
+        get_response = self.client.get(reverse("agency_profile"))
+        self.assertEqual(len(get_response.context["posts"][0].latest_comments), 3)
+        self.assertContains(get_response, "Comment 4")
+        self.assertNotContains(get_response, "Comment 1")
+
+    def test_agency_profile_query_count_does_not_grow(self):
+        # The first request also stores the memberships in the session.
+        self.profile_query_count()
+        self.add_posts(1, 1)
+        few = self.profile_query_count()
+        self.add_posts(8, 4)
+        self.assertEqual(self.profile_query_count(), few)
+
+
+def make_jpeg(width=1600, height=1200):
+    """A JPEG with an EXIF camera model"""
+    image = Image.new("RGB", (width, height), "red")
+    exif = image.getexif()
+    exif[0x0110] = "Test Camera"
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", exif=exif.tobytes())
+    return buffer.getvalue()
+
+
+class ImageVariantTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root, AQAR_IMAGE_WORKERS=0)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        images.source_digest.cache_clear()
+
+        self.member = User.objects.create(username="alkhulaifi")
+        self.agency = Agency.objects.new(self.member, name="Test Agency")
+        self.area = Area.objects.new(name="Qortuba")
+
+    def new_post(self):
+        return Post.objects.new(agency=self.agency, area=self.area, title="Best Sale", body="This Sale is Great",
+            picture=SimpleUploadedFile(name="photo.jpg", content=make_jpeg(), content_type="image/jpeg"))
+
+    def test_upload_generates_variants_without_exif(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            post = self.new_post()
+        storage = images.variant_storage()
+        for width in images.VARIANT_WIDTHS:
+            for fmt in images.VARIANT_FORMATS:
+                with storage.open(images.variant_name(post.picture.name, width, fmt)) as variant_file:
+                    variant = Image.open(variant_file)
+                    self.assertEqual(variant.width, width)
+                    self.assertEqual(len(variant.getexif()), 0)
+
+    def test_variant_view_generates_missing_variant(self):
+        post = self.new_post()
+        get_response = self.client.get(reverse("image_variant", args=[640, "jpeg", post.picture.name]))
+        self.assertEqual(get_response.status_code, 200)
+        self.assertEqual(get_response["Content-Type"], "image/jpeg")
+        self.assertEqual(Image.open(BytesIO(b"".join(get_response.streaming_content))).width, 640)
+
+    def test_variant_view_unknown_width(self):
+        post = self.new_post()
+        get_response = self.client.get(reverse("image_variant", args=[123, "jpeg", post.picture.name]))
+        self.assertEqual(get_response.status_code, 404)
+
+    def test_srcset_tag(self):
+        post = self.new_post()
+        rendered = Template("{% load aqar_images %}{% srcset post.picture %}").render(Context({"post": post}))
+        self.assertIn(reverse("image_variant", args=[320, "jpeg", post.picture.name]) + " 320w", rendered)
+        self.assertIn("1024w", rendered)
+
+
+class ContentAddressedStorageTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.member = User.objects.create(username="alkhulaifi")
+        self.agency = Agency.objects.new(self.member, name="Test Agency")
+        self.area = Area.objects.new(name="Qortuba")
+        self.content = make_jpeg(64, 48)
+
+    def new_post(self, file_name="photo.jpg"):
+        return Post.objects.new(agency=self.agency, area=self.area, title="Best Sale", body="This Sale is Great",
+            picture=SimpleUploadedFile(name=file_name, content=self.content, content_type="image/jpeg"))
+
+    def test_same_upload_is_stored_once(self):
+        first_post = self.new_post("photo.jpg")
+        second_post = self.new_post("copy of photo.jpg")
+        self.assertEqual(first_post.picture.name, second_post.picture.name)
+        self.assertTrue(first_post.picture.name.startswith("blobs/"))
+        self.assertEqual(Blob.objects.get(name=first_post.picture.name).refcount, 2)
+        with first_post.picture.open() as stored:
+            self.assertEqual(stored.read(), self.content)
+
+    def test_file_is_kept_until_last_reference_is_deleted(self):
+        first_post = self.new_post()
+        second_post = self.new_post()
+        storage = first_post.picture.storage
+        name = first_post.picture.name
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first_post.delete()
+        self.assertTrue(storage.exists(name))
+        self.assertEqual(Blob.objects.get(name=name).refcount, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second_post.delete()
+        self.assertFalse(storage.exists(name))
+        self.assertFalse(Blob.objects.filter(name=name).exists())
+
+    def test_replacing_a_picture_releases_the_old_blob(self):
+        post = Post.objects.get(pk=self.new_post().pk)
+        storage = post.picture.storage
+        old_name = post.picture.name
+
+        with self.captureOnCommitCallbacks(execute=True):
+            post.picture = SimpleUploadedFile(name="other.jpg", content=make_jpeg(32, 24), content_type="image/jpeg")
+            post.save()
+        self.assertNotEqual(post.picture.name, old_name)
+        self.assertFalse(Blob.objects.filter(name=old_name).exists())
+        self.assertFalse(storage.exists(old_name))
+        self.assertEqual(Blob.objects.get(name=post.picture.name).refcount, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            post.save()
+        self.assertEqual(Blob.objects.get(name=post.picture.name).refcount, 1)
+
+    def test_failed_save_takes_no_reference(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Post(agency=self.agency, title="Best Sale", body="This Sale is Great",
+                 picture=SimpleUploadedFile(name="photo.jpg", content=self.content, content_type="image/jpeg")).save()
+        self.assertFalse(Blob.objects.exists())
+
+    def test_reacquired_blob_is_not_removed(self):
+        post = self.new_post()
+        storage = post.picture.storage
+        name = post.picture.name
+        storage._remove_unreferenced(name)
+        self.assertTrue(storage.exists(name))
+        self.assertEqual(Blob.objects.get(name=name).refcount, 1)
+
+    def test_blob_media_is_served_immutable(self):
+        post = self.new_post()
+        get_response = self.client.get(post.picture.url)
+        self.assertEqual(get_response.status_code, 200)
+        self.assertIn("immutable", get_response["Cache-Control"])
+
+
+class PostSearchTests(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.member = User.objects.create(username="alkhulaifi")
+        cls.agency = Agency.objects.new(cls.member, name="Test Agency")
+        cls.ahmadi = Area.objects.new(name="الأحمدي")
+        cls.salmiya = Area.objects.new(name="السالمية")
+        cls.flat = Post.objects.new(agency=cls.agency, area=cls.ahmadi,
+            title="شقة للبيع في الأحمدي", body="شقة واسعة قريبة من البحر")
+        cls.house = Post.objects.new(agency=cls.agency, area=cls.salmiya,
+            title="بيت للإيجار", body="بيت في السالمية مع حديقة")
+
+    def search(self, **params):
+        get_response = self.client.get(reverse("search"), params)
+        self.assertEqual(get_response.status_code, 200)
+        return get_response.context["posts"]
+
+    def test_search_normalizes_arabic_variants(self):
+        """Hamza, tatweel, diacritics and the definite article do not matter"""
+        self.assertEqual(self.search(q="احمـدي"), [self.flat])
+        self.assertEqual(self.search(q="شَقّة"), [self.flat])
+
+    def test_search_filters_by_area(self):
+        self.assertEqual(self.search(q="للبيع"), [self.flat])
+        self.assertEqual(self.search(q="للبيع", area=self.salmiya.pk), [])
+
+    def test_search_ranks_title_matches_first(self):
+        garden = Post.objects.new(agency=self.agency, area=self.salmiya, title="حديقة كبيرة", body="بيت")
+        self.assertEqual(self.search(q="حديقة"), [garden, self.house])
+
+    def test_search_index_follows_updates_and_deletes(self):
+        self.house.title = "فيلا للإيجار"
+        self.house.save()
+        self.assertEqual(self.search(q="فيلا"), [self.house])
+        self.house.delete()
+        self.assertEqual(self.search(q="فيلا"), [])
+
+    def test_rebuild_search_index_command(self):
+        from django.core.management import call_command
+        from django.db import connection
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM aqar_agencies_post_search")
+        self.assertEqual(self.search(q="بيت"), [])
+        call_command("rebuild_search_index", stdout=StringIO())
+        self.assertEqual(self.search(q="بيت"), [self.house])
+
+
+class ImportListingsTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.member = User.objects.create(username="alkhulaifi")
+        self.agency = Agency.objects.new(self.member, name="Test Agency")
+        self.area = Area.objects.new(name="الأحمدي")
+
+    def write(self, name, text):
+        path = os.path.join(self.directory, name)
+        with open(path, "w", encoding="utf-8") as import_file:
+            import_file.write(text)
+        return path
+
+    def import_listings(self, path, *args):
+        from django.core.management import call_command
+        call_command("import_listings", path, *args, stdout=StringIO())
+        with open(f"{path}.errors.csv", encoding="utf-8") as errors_file:
+            return errors_file.read().splitlines()[1:]
+
+    def test_import_posts_from_csv(self):
+        path = self.write("posts.csv", "agency,area,title,body\n"
+            f"{self.agency.pk},الاحمدي,شقة للبيع,شقة واسعة\n"
+            f"{self.agency.pk},{self.area.pk},Best Sale,Great\n"
+            f"{self.agency.pk},Nowhere,Best Sale,Great\n"
+            f"{self.agency.pk + 1},{self.area.pk},Best Sale,Great\n"
+            f"{self.agency.pk},{self.area.pk},{'long' * 30},Great\n")
+        errors = self.import_listings(path, "--chunk-size", "2")
+
+        self.assertEqual(Post.objects.filter(area=self.area).count(), 2)
+        self.assertEqual([error.split(",")[0] for error in errors], ["3", "4", "5"])
+        self.assertIn("Area Nowhere does not exist", errors[0])
+        self.assertEqual(post_search_results("شقة"), ["شقة للبيع"])
+
+    def test_import_agencies_from_jsonl(self):
+        path = self.write("agencies.jsonl",
+            '{"name": "Imported Agency", "owner": "alkhulaifi", "phone_number": "98821030"}\n'
+            '{"name": "short", "owner": "alkhulaifi"}\n'
+            '{"name": "Unknown Owner Agency", "owner": "nobody"}\n')
+        errors = self.import_listings(path, "--kind", "agencies")
+
+        agency = Agency.objects.get(name="Imported Agency")
+        self.assertEqual(agency.phone_number, "98821030")
+        self.assertTrue(AgencyMember.objects.get(agency=agency, member=self.member).is_admin)
+        self.assertEqual([error.split(",")[0] for error in errors], ["2", "3"])
+
+    def test_imported_agencies_reach_the_owners_session(self):
+        self.client.force_login(self.member)
+        self.assertRedirects(self.client.get(reverse("agency_choice")), reverse("agency_profile"),
+                             fetch_redirect_response=False)
+        path = self.write("agencies.jsonl", '{"name": "Imported Agency", "owner": "alkhulaifi"}\n'
+                                             '{"name": "Second Imported Agency", "owner": "alkhulaifi"}\n')
+        self.assertEqual(self.import_listings(path, "--kind", "agencies"), [])
+
+        get_response = self.client.get(reverse("agency_choice"))
+        self.assertEqual(get_response.status_code, 200)
+        self.assertContains(get_response, "Second Imported Agency")
+        self.assertEqual(Agency.objects.get(name="Imported Agency").members_count, 1)
+
+    def test_malformed_jsonl_rows_are_reported(self):
+        path = self.write("posts.jsonl",
+            f'{{"agency": {self.agency.pk}, "area": {self.area.pk}, "title": "Best Sale", "body": "Great"}}\n'
+            '{"agency": 1, "area": \n'
+            '["not", "an", "object"]\n'
+            f'{{"agency": null, "area": {self.area.pk}, "title": "Best Sale", "body": "Great"}}\n'
+            f'{{"agency": {self.agency.pk}, "area": {self.area.pk}, "title": 42, "body": "Great"}}\n')
+        errors = self.import_listings(path)
+
+        self.assertEqual(Post.objects.filter(area=self.area).count(), 1)
+        self.assertEqual([error.split(",")[0] for error in errors], ["2", "3", "4", "5"])
+        self.assertIn("Invalid JSON", errors[0])
+
+    def test_import_resumes_after_committed_rows(self):
+        path = self.write("posts.jsonl", "".join(
+            f'{{"agency": {self.agency.pk}, "area": "{self.area.name}", "title": "Sale {number}", "body": "Great"}}\n'
+            for number in range(1, 6)))
+        with open(f"{path}.progress", "w") as progress_file:
+            progress_file.write('{"rows": 3}')
+        self.import_listings(path, "--resume")
+
+        self.assertEqual(sorted(Post.objects.values_list("title", flat=True)), ["Sale 4", "Sale 5"])
+        self.assertFalse(os.path.exists(f"{path}.progress"))
+
+
+def post_search_results(query):
+    from .search import search_posts
+    return [post.title for post in search_posts(query)]
+
+
+class AgencyAdminTests(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser("admin", "admin@example.com", "Open4admin")
+        self.agencies = [Agency.objects.new(self.admin, name=f"Test Agency {number}") for number in range(3)]
+        self.agencies[0].verified_by(self.admin)
+        self.client.force_login(self.admin)
+
+    def test_verify_action(self):
+        post_response = self.client.post(reverse("admin:aqar_agencies_agency_changelist"), {
+            "action": "verify_agencies",
+            "_selected_action": [agency.pk for agency in self.agencies],
+        }, follow=True)
+        self.assertContains(post_response, "Verified 2 agencies.")
+        self.assertContains(post_response, "1 agencies were already verified.")
+        self.assertEqual(Agency.objects.filter(verification=self.admin).count(), 3)
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                                       "LOCATION": "page-cache-tests"}})
+class PageCacheTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        self.member = User.objects.create(username="alkhulaifi")
+        self.agency = Agency.objects.new(self.member, name="Test Agency")
+        self.area = Area.objects.new(name="Qortuba")
+        self.post = Post.objects.new(agency=self.agency, area=self.area, title="First Sale", body="Great sale")
+        self.client.force_login(self.member)
+
+    def profile_queries(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as queries:
+            get_response = self.client.get(reverse("agency_profile"))
+        return get_response, len(queries)
+
+    def test_agency_profile_is_served_from_cache(self):
+        _, miss_queries = self.profile_queries()
+        get_response, hit_queries = self.profile_queries()
+        self.assertLess(hit_queries, miss_queries)
+        self.assertContains(get_response, "First Sale")
+
+    def test_new_post_and_comment_invalidate_agency_profile(self):
+        self.profile_queries()
+        Post.objects.new(agency=self.agency, area=self.area, title="Second Sale", body="Great sale")
+        get_response, _ = self.profile_queries()
+        self.assertContains(get_response, "Second Sale")
+
+        Comment.objects.new(post=self.post, user=self.member, message="Nice Sale")
+        get_response, _ = self.profile_queries()
+        self.assertContains(get_response, "Nice Sale")
+
+    def test_renaming_an_area_invalidates_agency_profile(self):
+        self.profile_queries()
+        self.area.name = "Qurtuba"
+        self.area.save()
+        get_response, _ = self.profile_queries()
+        self.assertContains(get_response, "Qurtuba")
+
+    def test_renaming_an_agency_invalidates_area_feeds(self):
+        self.assertContains(self.client.get(reverse("area_feed", args=[self.area.pk])), "Test Agency")
+        agency = Agency.objects.get(pk=self.agency.pk)
+        agency.name = "Renamed Agency Co"
+        agency.save()
+        self.assertContains(self.client.get(reverse("area_feed", args=[self.area.pk])), "Renamed Agency Co")
+
+    def test_moving_a_post_invalidates_both_area_feeds(self):
+        other_area = Area.objects.new(name="Salmiya")
+        self.client.get(reverse("area_feed", args=[self.area.pk]))
+        self.client.get(reverse("area_feed", args=[other_area.pk]))
+        post = Post.objects.get(pk=self.post.pk)
+        post.area = other_area
+        post.save()
+        self.assertNotContains(self.client.get(reverse("area_feed", args=[self.area.pk])), "First Sale")
+        self.assertContains(self.client.get(reverse("area_feed", args=[other_area.pk])), "First Sale")
+
+    def test_production_profile_shares_the_cache_between_workers(self):
+        import runpy
+        from unittest import mock
+        with mock.patch.dict(os.environ, {"AQAR_PROFILE": "production"}):
+            production = runpy.run_module("aqarwebsite.settings")
+        self.assertEqual(production["CACHES"]["default"]["BACKEND"],
+                         "django.core.cache.backends.filebased.FileBasedCache")
+
+    def test_cache_stats(self):
+        from .cache import stats
+        self.profile_queries()
+        self.profile_queries()
+        self.profile_queries()
+        self.assertEqual(stats()["agency_profile"], (2, 1))
+
+
+class ActiveAgencyTest(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        self.member = User.objects.create(username="alkhulaifi")
+        self.agency = Agency.objects.new(self.member, name="First Agency")
+        self.client.force_login(self.member)
+
+    def test_memberships_are_kept_in_the_session(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        self.client.get(reverse("agency_choice"))
+        with CaptureQueriesContext(connection) as queries:
+            get_response = self.client.get(reverse("agency_choice"))
+        self.assertRedirects(get_response, reverse("agency_profile"), fetch_redirect_response=False)
+        self.assertFalse(any("aqar_agencies_agencymember" in query["sql"] for query in queries))
+
+    def test_single_agency_is_active_without_choosing(self):
+        get_response = self.client.get(reverse("agency_profile"))
+        self.assertContains(get_response, "First Agency")
+
+    def test_member_of_several_agencies_must_choose(self):
+        second = Agency.objects.new(self.member, name="Second Agency")
+        get_response = self.client.get(reverse("agency_profile"))
+        self.assertRedirects(get_response, reverse("agency_choice"))
+
+        post_response = self.client.post(reverse("agency_profile"), {"agency": second.pk})
+        self.assertRedirects(post_response, reverse("agency_profile"), fetch_redirect_response=False)
+        get_response = self.client.get(reverse("agency_profile"))
+        self.assertContains(get_response, "Second Agency")
+        self.assertNotContains(get_response, "First Agency")
+
+    def test_cannot_choose_an_agency_of_someone_else(self):
+        other = Agency.objects.new(User.objects.create(username="other"), name="Other Agency")
+        Agency.objects.new(self.member, name="Second Agency")
+        self.client.post(reverse("agency_profile"), {"agency": other.pk})
+        get_response = self.client.get(reverse("agency_profile"))
+        self.assertRedirects(get_response, reverse("agency_choice"))
+
+    def test_joining_an_agency_refreshes_the_memberships(self):
+        self.client.get(reverse("agency_profile"))
+        owner = User.objects.create(username="owner")
+        second = Agency.objects.new(owner, name="Second Agency")
+        second.add_member(self.member, is_admin=False)
+        get_response = self.client.get(reverse("agency_choice"))
+        self.assertEqual(get_response.status_code, 200)
+        self.assertContains(get_response, "Second Agency")
+
+
+class ProductionSQLiteBackendTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "db.sqlite3")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def wrapper(self, **options):
+        from django.db import connection
+        from aqarwebsite.sqlite3.base import DatabaseWrapper
+        settings_dict = {**connection.settings_dict, "NAME": self.path, "OPTIONS": options}
+        wrapper = DatabaseWrapper(settings_dict, "production")
+        self.addCleanup(wrapper.close)
+        return wrapper
+
+    def other_connection(self):
+        import sqlite3
+        other = sqlite3.connect(self.path, timeout=0, isolation_level=None, check_same_thread=False)
+        self.addCleanup(other.close)
+        return other
+
+    def test_connections_use_wal_and_tuned_pragmas(self):
+        cursor = self.wrapper(pragmas={"cache_size": -1024}).cursor()
+        cursor.execute("PRAGMA journal_mode")
+        self.assertEqual(cursor.fetchone()[0], "wal")
+        cursor.execute("PRAGMA synchronous")
+        self.assertEqual(cursor.fetchone()[0], 1)
+        cursor.execute("PRAGMA cache_size")
+        self.assertEqual(cursor.fetchone()[0], -1024)
+
+    def test_transactions_take_the_write_lock_when_they_begin(self):
+        import sqlite3
+        wrapper = self.wrapper()
+        wrapper.cursor().execute("CREATE TABLE listing (title TEXT)")
+        wrapper.set_autocommit(False, force_begin_transaction_with_broken_autocommit=True)
+        with self.assertRaisesMessage(sqlite3.OperationalError, "database is locked"):
+            self.other_connection().execute("INSERT INTO listing VALUES ('Sale')")
+        wrapper.set_autocommit(True)
+
+    def test_locked_statements_outside_transactions_are_retried(self):
+        import threading
+        wrapper = self.wrapper(timeout=0, busy_retries=8)
+        wrapper.cursor().execute("CREATE TABLE listing (title TEXT)")
+        other = self.other_connection()
+        other.execute("BEGIN IMMEDIATE")
+        threading.Timer(0.05, other.rollback).start()
+        wrapper.cursor().execute("INSERT INTO listing VALUES (%s)", ["Sale"])
+        cursor = wrapper.cursor()
+        cursor.execute("SELECT count(*) FROM listing")
+        self.assertEqual(cursor.fetchone()[0], 1)
+
+    def test_serialized_writes_hold_the_lock_file_until_commit(self):
+        import fcntl
+        wrapper = self.wrapper(serialize_writes=True)
+        wrapper.cursor().execute("CREATE TABLE listing (title TEXT)")
+        wrapper.set_autocommit(False, force_begin_transaction_with_broken_autocommit=True)
+        lock_file = os.open(f"{self.path}-writelock", os.O_RDWR)
+        self.addCleanup(os.close, lock_file)
+        with self.assertRaises(BlockingIOError):
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        wrapper.commit()
+        wrapper.set_autocommit(True)
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+@override_settings(AQAR_READ_REPLICAS=["replica"])
+class PrimaryReplicaRouterTest(SimpleTestCase):
+    def setUp(self):
+        from . import routers
+        token = routers.pin_to_primary(False)
+        self.addCleanup(routers.reset_pinning, token)
+        self.router = routers.PrimaryReplicaRouter()
+
+    def test_reads_go_to_replicas_and_writes_to_primary(self):
+        self.assertEqual(self.router.db_for_read(Post), "replica")
+        self.assertEqual(self.router.db_for_write(Post), "default")
+
+    def test_other_apps_are_left_to_the_default_routing(self):
+        self.assertIsNone(self.router.db_for_read(User))
+        self.assertIsNone(self.router.db_for_write(User))
+        self.assertEqual(self.router.db_for_read(Post), "replica")
+
+    def test_reads_stay_on_the_primary_after_a_write(self):
+        self.router.db_for_write(Post)
+        self.assertEqual(self.router.db_for_read(Area), "default")
+
+    def test_pinned_requests_read_from_the_primary(self):
+        from . import routers
+        token = routers.pin_to_primary()
+        self.addCleanup(routers.reset_pinning, token)
+        self.assertEqual(self.router.db_for_read(Post), "default")
+
+    def test_replicas_are_not_migrated(self):
+        self.assertFalse(self.router.allow_migrate("replica", "aqar_agencies"))
+        self.assertIsNone(self.router.allow_migrate("default", "aqar_agencies"))
+
+    @override_settings(AQAR_READ_REPLICAS=[])
+    def test_everything_reads_from_the_primary_without_replicas(self):
+        self.assertEqual(self.router.db_for_read(Post), "default")
+
+
+class ReadReplicaTest(TransactionTestCase):
+    """Reads from a second SQLite file, a snapshot of the primary taken with VACUUM INTO"""
+
+    def setUp(self):
+        from django.db import connection, connections
+        from . import routers
+        Area.objects.new(name="Qortuba")
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "replica.sqlite3")
+        with connection.cursor() as cursor:
+            cursor.execute("VACUUM INTO %s", [path])
+        connections.databases["replica"] = {"ENGINE": "django.db.backends.sqlite3", "NAME": f"file:{path}?mode=ro"}
+        self.addCleanup(connections.databases.pop, "replica")
+        self.addCleanup(lambda: (connections["replica"].close(), connections.__delitem__("replica")))
+        Area.objects.new(name="Salwa")
+
+        token = routers.pin_to_primary(False)
+        self.addCleanup(routers.reset_pinning, token)
+        replicas = override_settings(AQAR_READ_REPLICAS=["replica"])
+        replicas.enable()
+        self.addCleanup(replicas.disable)
+
+    def area_names(self):
+        return set(Area.objects.values_list("name", flat=True))
+
+    def test_reads_come_from_the_replica(self):
+        self.assertEqual(self.area_names(), {"Qortuba"})
+
+    def test_writer_reads_its_own_writes(self):
+        from django.test import RequestFactory
+        from .middleware import PIN_PRIMARY_COOKIE, PrimaryPinningMiddleware
+
+        def create_area(request):
+            Area.objects.new(name="Hawally")
+            return HttpResponse(", ".join(sorted(self.area_names())))
+
+        def list_areas(request):
+            return HttpResponse(", ".join(sorted(self.area_names())))
+
+        response = PrimaryPinningMiddleware(create_area)(RequestFactory().post("/"))
+        self.assertEqual(response.content.decode(), "Hawally, Qortuba, Salwa")
+        self.assertIn(PIN_PRIMARY_COOKIE, response.cookies)
+
+        request = RequestFactory().get("/")
+        self.assertEqual(PrimaryPinningMiddleware(list_areas)(request).content.decode(), "Qortuba")
+        request.COOKIES[PIN_PRIMARY_COOKIE] = "1"
+        self.assertEqual(PrimaryPinningMiddleware(list_areas)(request).content.decode(), "Hawally, Qortuba, Salwa")
+
+    def test_verification_reads_the_primary(self):
+        from . import routers
+        admin = User.objects.create(username="admin")
+        agency = Agency.objects.new(admin, name="Test Agency")
+        token = routers.pin_to_primary(False)
+        self.addCleanup(routers.reset_pinning, token)
+        self.assertEqual(Agency.objects.filter(pk=agency.pk).verify(admin), [agency.pk])
+
+
+class JsonApiTest(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.member = User.objects.create(username="alkhulaifi")
+        cls.agency = Agency.objects.new(cls.member, name="Test Agency", address="Block 3, Street 12, Qortuba, Kuwait City")
+        cls.area = Area.objects.new(name="Qortuba")
+        cls.posts = make_posts(cls.agency, cls.area, 5)
+
+    def get_json(self, url, data=None, **headers):
+        get_response = self.client.get(url, data, **headers)
+        self.assertEqual(get_response.status_code, 200)
+        return get_response, get_response.json()
+
+    def test_post_list_skips_body_and_paginates_with_cursor(self):
+        _, page = self.get_json(reverse("api_posts"), {"limit": 3})
+        self.assertEqual([post["title"] for post in page["results"]], ["Sale 4", "Sale 3", "Sale 2"])
+        self.assertNotIn("body", page["results"][0])
+        _, next_page = self.get_json(page["next"])
+        self.assertEqual([post["title"] for post in next_page["results"]], ["Sale 1", "Sale 0"])
+        self.assertIsNone(next_page["next"])
+
+    def test_field_selection(self):
+        _, page = self.get_json(reverse("api_posts"), {"fields": "id,body", "area": self.area.pk})
+        self.assertEqual(page["results"][0], {"id": self.posts[-1].pk, "body": "Great sale"})
+        get_response = self.client.get(reverse("api_posts"), {"fields": "id,password"})
+        self.assertEqual(get_response.status_code, 400)
+
+    def test_post_detail(self):
+        _, post = self.get_json(reverse("api_post", args=[self.posts[0].pk]))
+        self.assertEqual(post["body"], "Great sale")
+        self.assertEqual(post["agency"], self.agency.pk)
+        self.assertEqual(self.client.get(reverse("api_post", args=[0])).status_code, 404)
+
+    def test_agencies_and_areas(self):
+        _, agencies = self.get_json(reverse("api_agencies"))
+        self.assertEqual(agencies["results"][0]["name"], "Test Agency")
+        self.assertFalse(agencies["results"][0]["verified"])
+        self.assertNotIn("address", agencies["results"][0])
+        _, agency = self.get_json(reverse("api_agency", args=[self.agency.pk]))
+        self.assertEqual(agency["address"], "Block 3, Street 12, Qortuba, Kuwait City")
+        _, areas = self.get_json(reverse("api_areas"))
+        self.assertEqual(areas["results"], [{"id": self.area.pk, "name": "Qortuba", "kind": "area", "parent": None}])
+
+    def test_comments(self):
+        commenter = User.objects.create(username="commenter")
+        Comment.objects.new(post=self.posts[0], user=commenter, message="Still available?")
+        _, comments = self.get_json(reverse("api_comments", args=[self.posts[0].pk]))
+        self.assertEqual(comments["results"][0]["user"], "commenter")
+        self.assertEqual(self.client.get(reverse("api_comments", args=[0])).status_code, 404)
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get(reverse("api_posts"), {"cursor": "nope"}).status_code, 400)
+
+    def test_out_of_range_numbers(self):
+        import base64
+        cursor = base64.urlsafe_b64encode(b"2020-01-01T00:00:00+00:00|99999999999999999999999").decode()
+        huge = "9" * 23
+        for params in ({"cursor": cursor}, {"area": huge}, {"agency": huge}):
+            self.assertEqual(self.client.get(reverse("api_posts"), params).status_code, 400)
+        for path in (f"/api/agencies/{huge}", f"/api/posts/{huge}", f"/api/posts/{huge}/comments", f"/areas/{huge}"):
+            self.assertEqual(self.client.get(path).status_code, 404)
+
+    def test_unchanged_page_is_not_modified_without_serializing(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        get_response, _ = self.get_json(reverse("api_posts"))
+        etag = get_response["ETag"]
+        self.assertFalse(etag.startswith("W/"))
+        with CaptureQueriesContext(connection) as queries:
+            not_modified = self.client.get(reverse("api_posts"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(len(queries), 1)
+
+    def test_etag_changes_with_the_rows(self):
+        get_response, _ = self.get_json(reverse("api_posts"))
+        etag = get_response["ETag"]
+        Post.objects.filter(pk=self.posts[2].pk).update(title="Sold", updated_at=timezone.now())
+        self.assertEqual(self.client.get(reverse("api_posts"), HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        get_response, _ = self.get_json(reverse("api_posts"))
+        self.posts[0].delete()
+        self.assertEqual(self.client.get(reverse("api_posts"), HTTP_IF_NONE_MATCH=get_response["ETag"]).status_code, 200)
+
+
+# The site's URLs with the async views that aqarwebsite/asgi.py switches on.
+urlpatterns = [
+    path('agency_profile', views.agency_profile_async, name='agency_profile'),
+    path('areas/<int:area_id>', views.area_feed_async, name='area_feed'),
+    path('search', views.search_async, name='search'),
+    path('images/<int:width>/<str:fmt>/<path:name>', views.image_variant_async, name='image_variant'),
+    path('', include('aqarwebsite.urls')),
+]
+
+
+@override_settings(ROOT_URLCONF="aqar_agencies.tests")
+class AsyncViewsTest(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root, AQAR_IMAGE_WORKERS=0)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        images.source_digest.cache_clear()
+
+        self.member = User.objects.create(username="alkhulaifi")
+        self.agency = Agency.objects.new(self.member, name="Test Agency")
+        self.area = Area.objects.new(name="Qortuba")
+        self.post = Post.objects.new(agency=self.agency, area=self.area, title="Best Sale", body="Great sale",
+            picture=SimpleUploadedFile(name="photo.jpg", content=make_jpeg(), content_type="image/jpeg"))
+
+    async def test_area_feed(self):
+        get_response = await self.async_client.get(reverse("area_feed", args=[self.area.pk]))
+        self.assertContains(get_response, "Best Sale")
+
+    async def test_area_feed_unknown_area(self):
+        get_response = await self.async_client.get(reverse("area_feed", args=[self.area.pk + 1]))
+        self.assertEqual(get_response.status_code, 404)
+
+    async def test_area_feed_invalid_cursor(self):
+        get_response = await self.async_client.get(reverse("area_feed", args=[self.area.pk]) + "?cursor=nope")
+        self.assertEqual(get_response.status_code, 400)
+
+    async def test_agency_profile(self):
+        from asgiref.sync import sync_to_async
+        await sync_to_async(self.async_client.force_login)(self.member)
+        get_response = await self.async_client.get(reverse("agency_profile"))
+        self.assertContains(get_response, "Test Agency")
+        self.assertContains(get_response, "Best Sale")
+
+    async def test_agency_profile_logged_out(self):
+        get_response = await self.async_client.get(reverse("agency_profile"))
+        self.assertContains(get_response, "You are not logged in")
+
+    async def test_search(self):
+        get_response = await self.async_client.get(reverse("search") + "?q=sale")
+        self.assertContains(get_response, "Best Sale")
+
+    async def test_image_variant(self):
+        get_response = await self.async_client.get(
+            reverse("image_variant", args=[320, "jpeg", self.post.picture.name]))
+        self.assertEqual(get_response["Content-Type"], "image/jpeg")
+        self.assertEqual(get_response["Cache-Control"], views.IMMUTABLE)
+        self.assertEqual(Image.open(BytesIO(get_response.content)).width, 320)
+
+    async def test_image_variant_unknown_format(self):
+        get_response = await self.async_client.get(
+            reverse("image_variant", args=[320, "gif", self.post.picture.name]))
+        self.assertEqual(get_response.status_code, 404)
+
+
+class SyntheticDataTest(TestCase):
+    def setUp(self):
+        from django.core.management import call_command
+        call_command("seed_synthetic", "--users", "20", "--agencies", "3", "--posts", "50", "--comments", "40",
+                     "--pictures", "0", stdout=StringIO())
+
+    def test_seed(self):
+        from django.core.management import call_command
+        self.assertEqual(User.objects.filter(username__startswith="synthetic-user-").count(), 20)
+        self.assertEqual(Agency.objects.count(), 3)
+        self.assertEqual(Post.objects.count(), 50)
+        self.assertEqual(Comment.objects.count(), 40)
+        self.assertFalse(Comment.objects.filter(path="").exists())
+        self.assertEqual(sum(Post.objects.values_list("comments_count", flat=True)), 40)
+        for reply in Comment.objects.exclude(parent=None).select_related("parent"):
+            self.assertTrue(reply.path.startswith(reply.parent.path))
+            self.assertEqual(reply.post_id, reply.parent.post_id)
+        call_command("recompute_agency_stats", "--check", stdout=StringIO())
+
+    @override_settings(ALLOWED_HOSTS=["localhost"])
+    def test_bench(self):
+        import json
+        from django.core.management import call_command
+        output = os.path.join(tempfile.mkdtemp(), "bench.json")
+        self.addCleanup(shutil.rmtree, os.path.dirname(output))
+        call_command("bench", "--only", "api_agency", "area_feed", "--requests", "3", "--warmup", "0",
+                     "--json", output, stdout=StringIO())
+        with open(output) as results:
+            endpoints = json.load(results)["endpoints"]
+        self.assertEqual(set(endpoints), {"api_agency", "area_feed"})
+        self.assertGreater(endpoints["area_feed"]["queries"], 0)
+        self.assertGreater(endpoints["api_agency"]["bytes"], 0)
+
+
+class InstrumentationTest(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        self.member = User.objects.create(username="alkhulaifi")
+        self.agency = Agency.objects.new(self.member, name="Test Agency")
+        self.area = Area.objects.new(name="Qortuba")
+        Post.objects.new(agency=self.agency, area=self.area, title="Best Sale", body="Great sale")
+
+    def test_every_view_declares_a_query_budget(self):
+        self.assertEqual(views_without_budget(), [])
+        with override_settings(ROOT_URLCONF="aqar_agencies.tests"):
+            self.assertEqual(views_without_budget(), [])
+
+    def test_recorder_counts_duplicates_and_repeats(self):
+        from .instrumentation import QueryRecorder
+        with QueryRecorder() as outer:
+            list(Post.objects.filter(pk=1))
+            with QueryRecorder() as inner:
+                list(Post.objects.filter(pk=1))
+                list(Post.objects.filter(pk=2))
+        self.assertEqual((outer.count, inner.count), (3, 2))
+        self.assertEqual((outer.duplicates, inner.duplicates), (1, 0))
+        self.assertEqual(len(outer.repeated()), 1)
+        self.assertEqual(outer.repeated()[0][1], 3)
+        self.assertGreater(outer.sql_ms, 0)
+
+    def test_server_timing_and_stats(self):
+        get_response = self.client.get(reverse("area_feed", args=[self.area.pk]))
+        stats = get_response.wsgi_request.query_stats
+        self.assertEqual(stats.view, "area_feed")
+        self.assertEqual(stats.budget, views.area_feed.query_budget)
+        self.assertGreater(stats.queries, 0)
+        self.assertIn(f'desc="{stats.queries} queries"', get_response["Server-Timing"])
+        self.assertGreater(stats.template_ms, 0)
+        self.assertIn(f"tpl;dur={stats.template_ms}", get_response["Server-Timing"])
+
+    def test_template_timer_nests_and_sees_inner_templates(self):
+        from django.template.loader import render_to_string
+        from .instrumentation import TemplateTimer, time_templates
+        time_templates()
+        with TemplateTimer() as outer:
+            with TemplateTimer() as inner:
+                render_to_string("aqar_agencies/area_feed.html", {"area_name": "Qortuba", "feed": ""})
+        self.assertEqual([(name, depth) for name, _, depth in inner.timings],
+                         [("base.html", 1), ("aqar_agencies/area_feed.html", 0)])
+        self.assertEqual(outer.timings, inner.timings)
+        self.assertEqual(inner.total_ms, inner.timings[-1][1])
+        self.assertEqual(inner.slowest(1)[0][0], "aqar_agencies/area_feed.html")
+
+    @override_settings(AQAR_SERVER_TIMING=False)
+    def test_server_timing_off(self):
+        self.assertFalse(self.client.get(reverse("index")).has_header("Server-Timing"))
+
+    @override_settings(AQAR_SLOW_REQUEST_MS=0)
+    def test_slow_requests_are_logged_as_warnings(self):
+        with self.assertLogs("aqar_agencies.requests", "WARNING") as logs:
+            self.client.get(reverse("index"))
+        self.assertIn("slow", logs.output[0])
+        self.assertIn("templates: aqar_agencies/index.html", logs.output[0])
+        self.assertEqual(logs.records[0].request_stats["view"], "index")
+
+    def test_over_budget_fails_the_test(self):
+        from unittest import mock
+        with mock.patch.object(views.area_feed, "query_budget", 0):
+            with self.assertLogs("aqar_agencies.requests", "WARNING") as logs:
+                with self.assertRaisesMessage(AssertionError, "has a query_budget of 0"):
+                    self.client.get(reverse("area_feed", args=[self.area.pk]))
+        self.assertIn("over_budget=0", logs.output[0])
+
+    @override_settings(ROOT_URLCONF="aqar_agencies.tests")
+    async def test_async_views_count_queries_of_their_threads(self):
+        get_response = await self.async_client.get(reverse("search") + "?q=sale")
+        self.assertContains(get_response, "Best Sale")
+        self.assertGreater(get_response.asgi_request.query_stats.queries, 0)
+
+
+class SamplingProfilerTest(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        self.profiles = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.profiles)
+        settings_override = override_settings(
+            MIDDLEWARE=["aqar_agencies.profiling.SamplingProfilerMiddleware", *settings.MIDDLEWARE],
+            AQAR_PROFILER_DIR=self.profiles, AQAR_PROFILER_SAMPLE_RATE=0, AQAR_PROFILER_SLOW_MS=20,
+            AQAR_PROFILER_INTERVAL_MS=1)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        cache.clear()
+
+        self.member = User.objects.create(username="alkhulaifi")
+        self.agency = Agency.objects.new(self.member, name="Test Agency")
+        self.area = Area.objects.new(name="Qortuba")
+        Post.objects.new(agency=self.agency, area=self.area, title="Best Sale", body="Great sale")
+
+    def slow_feed(self):
+        import time
+        from unittest import mock
+        render_area_feed = views.render_area_feed
+
+        def slowly(*args):
+            time.sleep(0.05)
+            return render_area_feed(*args)
+
+        with mock.patch.object(views, "render_area_feed", slowly):
+            return self.client.get(reverse("area_feed", args=[self.area.pk]))
+
+    def samples(self):
+        from .profiling import sample_store
+        return list(sample_store().read())
+
+    def test_slow_requests_are_saved_with_stacks_sql_and_templates(self):
+        self.client.get(reverse("index"))
+        self.assertEqual(self.samples(), [])
+        self.slow_feed()
+        sample, = self.samples()
+        self.assertEqual((sample["url_name"], sample["reason"]), ("area_feed", "slow"))
+        self.assertTrue(any("aqar_agencies.views.area_feed" in stack for stack in sample["stacks"]))
+        self.assertTrue(any('"aqar_agencies_post"' in sql for sql, _ in sample["sql"]))
+        self.assertIn("aqar_agencies/area_feed_posts.html", [name for name, _, _ in sample["templates"]])
+
+    @override_settings(AQAR_PROFILER_SAMPLE_RATE=1)
+    def test_sampled_requests_are_saved(self):
+        self.client.get(reverse("index"))
+        sample, = self.samples()
+        self.assertEqual((sample["url_name"], sample["reason"]), ("index", "sampled"))
+
+    def test_store_rotates(self):
+        from .profiling import SampleStore
+        store = SampleStore(self.profiles, max_bytes=100, backups=2)
+        for number in range(5):
+            store.append({"number": number, "padding": "x" * 100})
+        self.assertEqual(len(store.files()), 2)
+        self.assertEqual([sample["number"] for sample in store.read()], [3, 4])
+
+    def test_profile_report_writes_folded_stacks(self):
+        from django.core.management import call_command
+        self.slow_feed()
+        output = os.path.join(self.profiles, "report")
+        stdout = StringIO()
+        call_command("profile_report", "--output", output, stdout=stdout)
+        self.assertIn("area_feed: 1 requests (1 slow)", stdout.getvalue())
+        with open(os.path.join(output, "area_feed.folded")) as folded:
+            stack, count = folded.readline().rsplit(" ", 1)
+        self.assertGreater(int(count), 0)
+        self.assertTrue(stack.startswith("django."))
+
+
+class TestHarnessTest(TestCase):
+    def test_in_memory_storage(self):
+        from django.core.files.base import ContentFile
+        from .storage import InMemoryStorage
+        storage = InMemoryStorage()
+        name = storage.save("posts/a.txt", ContentFile(b"hello"))
+        storage.save("posts/deeper/b.txt", ContentFile(b"!"))
+        self.assertEqual(storage.open(name).read(), b"hello")
+        self.assertEqual(storage.size(name), 5)
+        self.assertEqual(storage.listdir("posts"), (["deeper"], ["a.txt"]))
+        self.assertEqual(storage.url(name), "/media/posts/a.txt")
+        self.assertNotEqual(storage.save("posts/a.txt", ContentFile(b"again")), name)
+        storage.delete(name)
+        self.assertFalse(storage.exists(name))
+
+    def test_media_file_is_conditional(self):
+        member = User.objects.create(username="alkhulaifi")
+        agency = Agency.objects.new(member, name="Test Agency", profile_picture=SimpleUploadedFile(
+            name="photo.jpg", content=make_jpeg(64, 48), content_type="image/jpeg"))
+        get_response = self.client.get(agency.profile_picture.url)
+        self.assertEqual(b"".join(get_response.streaming_content), make_jpeg(64, 48))
+        not_modified = self.client.get(agency.profile_picture.url,
+                                       HTTP_IF_MODIFIED_SINCE=get_response["Last-Modified"])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(self.client.get("/media/blobs/missing.jpg").status_code, 404)
+
+    def test_factories_keep_counters_and_search_in_step(self):
+        from django.core.management import call_command
+        from .search import search_posts
+        users = make_users(3)
+        self.assertEqual([user.username for user in users], ["user0", "user1", "user2"])
+        agency = Agency.objects.new(users[0], name="Test Agency")
+        posts = make_posts(agency, Area.objects.new(name="Qortuba"), 3, title="Flat {number}")
+        self.assertEqual([post.title for post in posts], ["Flat 0", "Flat 1", "Flat 2"])
+        self.assertEqual(search_posts("Flat 2"), [posts[2]])
+        call_command("recompute_agency_stats", "--check", stdout=StringIO())
+
+    def test_bench_tests(self):
+        from django.core.management import call_command
+        stdout = StringIO()
+        call_command("bench_tests", "aqar_agencies.tests.AreaModelTests", "--parallel", "1", "--repeat", "1",
+                     stdout=stdout)
+        self.assertRegex(stdout.getvalue(), r"\n\s+1\s+\d+\s+[\d.]+")
+
+
+class StaticFilesTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # collectstatic also hashes and compresses the admin's files, once is enough.
+        super().setUpClass()
+        from django.core.management import call_command
+        source, cls.static_root = tempfile.mkdtemp(), tempfile.mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, source)
+        cls.addClassCleanup(shutil.rmtree, cls.static_root)
+        cls.css = ("body { color: #222; }\n" * 40).encode()
+        with open(os.path.join(source, "app.css"), "wb") as css:
+            css.write(cls.css)
+        with open(os.path.join(source, "photo.jpg"), "wb") as photo:
+            photo.write(make_jpeg(64, 48))
+        with open(os.path.join(source, "tiny.css"), "wb") as tiny:
+            tiny.write(b"p { margin: 0 }\n")
+        # Too small for a precompressed copy, large enough to compress on the way out.
+        with open(os.path.join(source, "small.css"), "wb") as small:
+            small.write(b"h1 { margin: 0 }\n" * 13)
+        settings_override = override_settings(
+            STATICFILES_DIRS=[source], STATIC_ROOT=cls.static_root,
+            STATICFILES_STORAGE="aqar_agencies.staticfiles.CompressedManifestStaticFilesStorage")
+        settings_override.enable()
+        cls.addClassCleanup(settings_override.disable)
+        call_command("collectstatic", interactive=False, verbosity=0)
+
+        from django.contrib.staticfiles.storage import staticfiles_storage
+        cls.css_url = staticfiles_storage.url("app.css")
+
+    def test_collectstatic_fingerprints_and_precompresses_text(self):
+        import gzip
+        from django.contrib.staticfiles.storage import staticfiles_storage
+        hashed = staticfiles_storage.stored_name("app.css")
+        self.assertRegex(hashed, r"^app\.[0-9a-f]{12}\.css$")
+        with open(os.path.join(self.static_root, hashed + ".gz"), "rb") as compressed:
+            self.assertEqual(gzip.decompress(compressed.read()), self.css)
+        self.assertFalse(os.path.exists(os.path.join(self.static_root, staticfiles_storage.stored_name("photo.jpg") + ".gz")))
+
+    def test_serves_best_encoding_with_immutable_caching(self):
+        import gzip
+        get_response = self.client.get(self.css_url, HTTP_ACCEPT_ENCODING="gzip, deflate")
+        self.assertEqual(get_response["Content-Encoding"], "gzip")
+        self.assertEqual(get_response["Content-Type"], "text/css; charset=utf-8")
+        self.assertEqual(get_response["Vary"], "Accept-Encoding")
+        self.assertEqual(get_response["Cache-Control"], "public, max-age=31536000, immutable")
+        self.assertEqual(gzip.decompress(b"".join(get_response.streaming_content)), self.css)
+
+        identity = self.client.get(self.css_url, HTTP_ACCEPT_ENCODING="gzip;q=0")
+        self.assertFalse(identity.has_header("Content-Encoding"))
+        self.assertEqual(b"".join(identity.streaming_content), self.css)
+        self.assertNotEqual(identity["ETag"], get_response["ETag"])
+
+        unhashed = self.client.get("/static/app.css")
+        self.assertEqual(unhashed["Cache-Control"], "public, max-age=300")
+
+    def test_conditional_requests(self):
+        get_response = self.client.get(self.css_url)
+        self.assertEqual(self.client.get(self.css_url, HTTP_IF_NONE_MATCH=get_response["ETag"]).status_code, 304)
+        self.assertEqual(self.client.get(self.css_url, HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+        self.assertEqual(
+            self.client.get(self.css_url, HTTP_IF_MODIFIED_SINCE=get_response["Last-Modified"]).status_code, 304)
+
+    def test_conditional_requests_use_weak_comparison(self):
+        etag = self.client.get(self.css_url)["ETag"]
+        self.assertEqual(self.client.get(self.css_url, HTTP_IF_NONE_MATCH=f"W/{etag}").status_code, 304)
+
+        tiny = self.client.get("/static/tiny.css", HTTP_ACCEPT_ENCODING="gzip")
+        self.assertFalse(tiny.has_header("Content-Encoding"))
+        self.assertEqual(self.client.get("/static/tiny.css", HTTP_ACCEPT_ENCODING="gzip",
+                                         HTTP_IF_NONE_MATCH=tiny["ETag"]).status_code, 304)
+
+        small = self.client.get("/static/small.css", HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(small["Content-Encoding"], "gzip")
+        self.assertTrue(small["ETag"].startswith('W/"'))
+        self.assertEqual(self.client.get("/static/small.css", HTTP_ACCEPT_ENCODING="gzip",
+                                         HTTP_IF_NONE_MATCH=small["ETag"]).status_code, 304)
+
+    def test_ranges(self):
+        partial = self.client.get(self.css_url, HTTP_RANGE="bytes=5-14", HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(partial.status_code, 206)
+        self.assertEqual(partial["Content-Range"], f"bytes 5-14/{len(self.css)}")
+        self.assertEqual(b"".join(partial.streaming_content), self.css[5:15])
+        suffix = self.client.get(self.css_url, HTTP_RANGE="bytes=-4")
+        self.assertEqual(b"".join(suffix.streaming_content), self.css[-4:])
+        self.assertEqual(self.client.get(self.css_url, HTTP_RANGE=f"bytes={len(self.css)}-").status_code, 416)
+        stale = self.client.get(self.css_url, HTTP_RANGE="bytes=5-14", HTTP_IF_RANGE='"old"')
+        self.assertEqual(stale.status_code, 200)
+
+    def test_head_and_unknown_files(self):
+        head_response = self.client.head(self.css_url)
+        self.assertEqual(head_response["Content-Length"], str(len(self.css)))
+        self.assertEqual(head_response.content, b"")
+        self.assertEqual(self.client.get("/static/missing.css").status_code, 404)
+        self.assertEqual(self.client.get("/static/../manage.py").status_code, 404)
+
+    def test_pages_link_the_fingerprinted_stylesheet(self):
+        self.assertContains(self.client.get(reverse("index")), self.css_url)
+
+    def test_production_profile_links_the_fingerprinted_stylesheet(self):
+        import runpy
+        from unittest import mock
+        with mock.patch.dict(os.environ, {"AQAR_PROFILE": "production"}):
+            production = runpy.run_module("aqarwebsite.settings")
+        self.assertFalse(production["DEBUG"])
+        self.assertTrue(production["ALLOWED_HOSTS"])
+        with override_settings(DEBUG=production["DEBUG"]):
+            self.assertContains(self.client.get(reverse("index")), self.css_url)
+
+
+class CompressionTest(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.member = User.objects.create(username="alkhulaifi")
+        cls.agency = Agency.objects.new(cls.member, name="Test Agency", address="Block 3, Street 12, Qortuba, Kuwait City")
+        cls.area = Area.objects.new(name="Qortuba")
+        cls.posts = make_posts(cls.agency, cls.area, 5)
+
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+
+    def test_pages_are_gzipped_for_clients_that_accept_it(self):
+        import gzip
+        plain = self.client.get(reverse("index"))
+        self.assertNotIn("Content-Encoding", plain)
+        self.assertIn("Accept-Encoding", plain["Vary"])
+        compressed = self.client.get(reverse("index"), HTTP_ACCEPT_ENCODING="gzip, deflate")
+        self.assertEqual(compressed["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", compressed["Vary"])
+        self.assertEqual(compressed["Content-Length"], str(len(compressed.content)))
+        self.assertLess(len(compressed.content), len(plain.content))
+        self.assertEqual(gzip.decompress(compressed.content), plain.content)
+        self.assertNotIn("Content-Encoding", self.client.get(reverse("index"), HTTP_ACCEPT_ENCODING="gzip;q=0"))
+
+    def test_etag_becomes_weak_and_still_matches(self):
+        url = reverse("api_posts")
+        compressed = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(compressed["Content-Encoding"], "gzip")
+        self.assertTrue(compressed["ETag"].startswith('W/"'))
+        self.assertEqual(
+            self.client.get(url, HTTP_ACCEPT_ENCODING="gzip", HTTP_IF_NONE_MATCH=compressed["ETag"]).status_code, 304)
+
+    def test_streams_and_skips_media(self):
+        import gzip
+        from django.http import StreamingHttpResponse
+        from django.test import RequestFactory
+        from .compression import CompressionMiddleware
+        request = RequestFactory().get("/", HTTP_ACCEPT_ENCODING="gzip")
+        chunks = [("سطر %d\n" % number).encode() * 50 for number in range(20)]
+
+        streamed = CompressionMiddleware(lambda request: StreamingHttpResponse(iter(chunks)))(request)
+        self.assertEqual(streamed["Content-Encoding"], "gzip")
+        self.assertFalse(streamed.has_header("Content-Length"))
+        self.assertEqual(gzip.decompress(b"".join(streamed.streaming_content)), b"".join(chunks))
+
+        photo = CompressionMiddleware(lambda request: HttpResponse(b"x" * 5000, content_type="image/jpeg"))(request)
+        self.assertFalse(photo.has_header("Content-Encoding"))
+        self.assertFalse(photo.has_header("Vary"))
+        tiny = CompressionMiddleware(lambda request: HttpResponse(b"ok"))(request)
+        self.assertFalse(tiny.has_header("Content-Encoding"))
+
+    def test_levels_follow_the_body_size(self):
+        from . import compression
+        self.assertEqual(compression.levels_for(4000), (9, 6))
+        self.assertEqual(compression.levels_for(10 ** 6), (4, 4))
+
+
+class TemplateModeTest(TestCase):
+    production_templates = [{
+        **settings.TEMPLATES[0],
+        "APP_DIRS": False,
+        "OPTIONS": {**settings.TEMPLATES[0]["OPTIONS"], "loaders": [
+            ("django.template.loaders.cached.Loader", [
+                "django.template.loaders.filesystem.Loader",
+                "django.template.loaders.app_directories.Loader",
+            ]),
+        ]},
+    }]
+
+    def setUp(self):
+        self.member = User.objects.create(username="alkhulaifi")
+        self.agency = Agency.objects.new(self.member, name="Test Agency")
+        self.area = Area.objects.new(name="Qortuba")
+        self.posts = make_posts(self.agency, self.area, 3)
+
+    def test_precompile_fills_the_cached_loader_with_project_templates(self):
+        from django.template import engines
+        from .templating import precompile_templates
+        with override_settings(TEMPLATES=self.production_templates):
+            compiled = precompile_templates()
+            cached = engines["django"].engine.template_loaders[0].get_template_cache
+            self.assertIn("base.html", compiled)
+            self.assertIn("aqar_agencies/area_feed_posts.html", compiled)
+            self.assertFalse([name for name in compiled if name.startswith("admin/")])
+            self.assertTrue(set(compiled) <= set(cached))
+            self.assertContains(self.client.get(reverse("area_feed", args=[self.area.pk])), "Sale 2")
+
+    def test_listings_fall_back_to_the_django_templates(self):
+        from django.template.loader import render_to_string
+        from .templating import render_listing
+        with override_settings(TEMPLATES=settings.TEMPLATES[:1]):
+            context = {"area_id": self.area.pk, "posts": self.posts, "next_cursor": "abc"}
+            self.assertEqual(render_listing("aqar_agencies/area_feed_posts.html", context),
+                             render_to_string("aqar_agencies/area_feed_posts.html", context))
+
+    def test_jinja2_listings_match_the_django_ones(self):
+        import importlib.util
+        import unittest
+        from django.template.loader import render_to_string
+        from .instrumentation import TemplateTimer
+        from .templating import render_listing
+        if importlib.util.find_spec("jinja2") is None:
+            raise unittest.SkipTest("jinja2 is not installed")
+        jinja_templates = settings.TEMPLATES[:1] + [{
+            "NAME": "jinja2",
+            "BACKEND": "django.template.backends.jinja2.Jinja2",
+            "APP_DIRS": True,
+            "OPTIONS": {"environment": "aqar_agencies.jinja_env.environment"},
+        }]
+        agency = Agency.objects.get(pk=self.agency.pk)
+        contexts = {
+            "aqar_agencies/area_feed_posts.html": {
+                "area_id": self.area.pk, "posts": Post.objects.area_feed(self.area.pk), "next_cursor": "a b"},
+            "aqar_agencies/agency_profile_posts.html": {
+                "agency": agency, "members": agency.agencymember_set.select_related("member"),
+                "posts": Post.objects.for_agency_profile(agency)},
+        }
+        with override_settings(TEMPLATES=jinja_templates):
+            for name, context in contexts.items():
+                with TemplateTimer() as timer:
+                    rendered = render_listing(name, context)
+                self.assertEqual(timer.timings[0][0], f"jinja2:{name}")
+                self.assertEqual(rendered.split(), render_to_string(name, context).split())
+
+
+class ListingFacetsTest(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        self.member = User.objects.create(username="alkhulaifi")
+        self.agency = Agency.objects.new(self.member, name="Test Agency")
+        self.hawalli = Area.objects.new(name="حولي", kind=Area.GOVERNORATE)
+        self.salmiya = Area.objects.new(name="السالمية", parent=self.hawalli)
+        self.jabriya = Area.objects.new(name="الجابرية", parent=self.hawalli)
+        self.capital = Area.objects.new(name="العاصمة", kind=Area.GOVERNORATE)
+        self.flat = Post.objects.new(agency=self.agency, area=self.salmiya, title="شقة للإيجار", body="شقة",
+                                     listing_type=Post.RENT, property_type="apartment", price=450, size_sqm=120)
+        self.villa = Post.objects.new(agency=self.agency, area=self.jabriya, title="فيلا للبيع", body="فيلا",
+                                      listing_type=Post.SALE, property_type="villa", price=650_000, size_sqm=750)
+        self.land = Post.objects.new(agency=self.agency, area=self.capital, title="أرض للبيع", body="أرض",
+                                     listing_type=Post.SALE, property_type="land", price=900_000, size_sqm=1000)
+        make_posts(self.agency, self.salmiya, 2, listing_type=Post.RENT, property_type="apartment", price=300)
+
+    def assertNoDrift(self):
+        from . import facets
+        self.assertEqual(list(facets.drift()), [])
+
+    def test_price_bands(self):
+        self.assertEqual([Post.price_band(price) for price in (None, 0, 499, 500, 50_000, 10 ** 7)], [0, 1, 1, 2, 5, 9])
+        self.assertEqual(Post.band_range(2), (500, 1_000))
+        self.assertEqual(Post.band_range(9), (800_000, None))
+        self.assertEqual(Post.band_label(1), "Under 500 KD")
+        with self.assertRaises(ValidationError):
+            Post.objects.validate(title="Sale", body="Sale", listing_type="swap")
+
+    def test_signals_keep_the_counts(self):
+        from .models import FacetCount
+        self.assertNoDrift()
+        flat = Post.objects.get(pk=self.flat.pk)
+        flat.price = 700
+        flat.save()
+        flat.area = self.capital
+        flat.save()
+        self.assertNoDrift()
+        self.assertEqual(FacetCount.objects.get(area=self.capital, property_type="apartment").count, 1)
+        self.villa.price = None
+        self.villa.save()
+        self.assertNoDrift()
+        Post.objects.get(pk=self.land.pk).delete()
+        self.assertNoDrift()
+
+    def test_each_facet_counts_with_the_other_filters(self):
+        from .facets import facet_counts
+        counts = facet_counts()
+        self.assertEqual(counts.total, 5)
+        self.assertEqual([(value.value, value.count) for value in counts.area],
+                         [(self.capital.pk, 1), (self.hawalli.pk, 4)])
+        rentals = facet_counts(area_id=self.hawalli.pk, listing_type=Post.RENT)
+        self.assertEqual(rentals.total, 3)
+        self.assertEqual([(value.value, value.count) for value in rentals.area], [(self.salmiya.pk, 3)])
+        self.assertEqual([(value.value, value.count) for value in rentals.listing_type],
+                         [(Post.SALE, 1), (Post.RENT, 3)])
+        self.assertEqual([(value.value, value.count) for value in rentals.price_band], [(1, 3)])
+
+    def test_listings_view_filters_and_counts(self):
+        listings_url = reverse("listings")
+        get_response = self.client.get(listings_url, {"listing_type": Post.SALE, "sort": "-price"})
+        self.assertEqual(list(get_response.context["posts"]), [self.land, self.villa])
+        self.assertEqual(get_response.context["total"], 2)
+        get_response = self.client.get(listings_url, {"area": self.hawalli.pk, "price_band": 1, "min_size": 100})
+        self.assertEqual(list(get_response.context["posts"]), [self.flat])
+        self.assertContains(get_response, f"?area={self.hawalli.pk}&amp;price_band=1&amp;min_size=100&amp;"
+                                          f"listing_type={Post.RENT}")
+        self.assertContains(get_response, "before the size filter")
+        self.assertEqual(self.client.get(listings_url, {"min_size": 900, "max_size": 800}).context["posts"].count(), 0)
+        self.assertIsNone(self.client.get(listings_url, {"price_band": 99}).context["posts"])
+
+    def test_rebuild_facets_finds_and_fixes_drift(self):
+        from django.core.management import CommandError, call_command
+        Post.objects.filter(pk=self.villa.pk).update(price=100)
+        with self.assertRaisesMessage(CommandError, "1 areas have drifted"):
+            call_command("rebuild_facets", "--check", stdout=StringIO())
+        call_command("rebuild_facets", stdout=StringIO())
+        self.assertNoDrift()
+        output = StringIO()
+        call_command("rebuild_facets", "--all", stdout=output)
+        self.assertIn("Rebuilt", output.getvalue())
+        self.assertNoDrift()
+
+    def test_imported_posts_are_counted(self):
+        from .importer import ListingImporter
+        importer = ListingImporter("posts")
+        importer.run([(1, {"agency": self.agency.pk, "area": self.capital.pk, "title": "Shop", "body": "Shop",
+                           "listing_type": Post.RENT, "property_type": "shop", "price": "1200", "size_sqm": ""})])
+        self.assertEqual(importer.imported, 1)
+        self.assertEqual(Post.objects.filter(property_type="shop", price=1200, size_sqm=None).count(), 1)
+        self.assertNoDrift()
@@ -1,9 +1,36 @@
-from django.urls import path
-from . import views
+from django.conf import settings
+from django.urls import converters, path, register_converter
+from . import api, views
+from .pagination import MAX_ID
+
+
+class IdConverter(converters.IntConverter):
+    """A primary key: a number too large for the database is a 404, not an overflow"""
+
+    def to_python(self, value):
+        if int(value) > MAX_ID:
+            raise ValueError(f"{value} is not a valid id")
+        return int(value)
+
+
+register_converter(IdConverter, "id")
+
+# Under ASGI the read-mostly pages are served by their async versions.
+async_views = settings.AQAR_ASYNC_VIEWS
 
 urlpatterns = [
     path('', views.index, name='index'),
     path('agency_create', views.agency_create, name='agency_create'),
     path('agency_choice', views.agency_choice, name='agency_choice'),
-    path('agency_profile', views.agency_profile, name='agency_profile'),
+    path('agency_profile', views.agency_profile_async if async_views else views.agency_profile, name='agency_profile'),
+    path('areas/<id:area_id>', views.area_feed_async if async_views else views.area_feed, name='area_feed'),
+    path('search', views.search_async if async_views else views.search, name='search'),
+    path('listings', views.listings_async if async_views else views.listings, name='listings'),
+    path('images/<int:width>/<str:fmt>/<path:name>', views.image_variant_async if async_views else views.image_variant, name='image_variant'),
+    path('api/areas', api.areas, name='api_areas'),
+    path('api/agencies', api.agencies, name='api_agencies'),
+    path('api/agencies/<id:agency_id>', api.agency, name='api_agency'),
+    path('api/posts', api.posts, name='api_posts'),
+    path('api/posts/<id:post_id>', api.post, name='api_post'),
+    path('api/posts/<id:post_id>/comments', api.comments, name='api_comments'),
 ]
@@ -1,13 +1,36 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseBadRequest, HttpResponseNotModified
 from django.shortcuts import render, redirect
+from django.template.loader import render_to_string
 from django.contrib.auth.forms import UserCreationForm
+from django.utils.http import http_date
+from django.views.static import was_modified_since
 from django.contrib.auth import authenticate, login
-from .forms import AgencyCreateForm, AgencyChoiceForm
-from django.contrib.auth.models import User
-from .models import Agency, AgencyMember
+from .forms import AgencyCreateForm, AgencyChoiceForm, ListingSearchForm, PostSearchForm
+from PIL import UnidentifiedImageError
 
+from . import facets as post_facets, images, search as post_search
+from .areas import area_registry
+from .cache import acached_fragment, cached_fragment
+from .instrumentation import query_budget
+from .middleware import set_active_agency
+from .models import Agency, Post
+from .pagination import decode_cursor, keyset_page
+from .storage import blob_digest
+from .templating import render_listing
+
+FEED_PAGE_SIZE = 20
+SEARCH_RESULTS = 20
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+@query_budget(3)
 def index(request):
-    return render(request, 'aqar_agencies/index.html')
+    areas = cached_fragment("index_areas", [("areas", "all")], lambda: render_to_string(
+        "aqar_agencies/index_areas.html", {"areas": area_registry.choices()}))
+    return render(request, 'aqar_agencies/index.html', {"areas": areas})
 
+@query_budget(11)
 def register(request):
     if request.method == 'POST':
         form = UserCreationForm(request.POST)
@@ -24,13 +47,13 @@ def register(request):
     context = {'form': form}
     return render(request, "registration/register.html", context)
 
+@query_budget(16)
 def agency_create(request):
     if request.method == 'POST':
         agency_form = AgencyCreateForm(request.POST, request.FILES)
         if agency_form.is_valid():
             agency_fields = agency_form.cleaned_data
-            member = User.objects.get(username=request.user)
-            Agency.objects.new(member,
+            Agency.objects.new(request.user,
                 name=agency_fields['name'],
                 phone_number=agency_fields['phone_number'],
                 profile_picture=agency_fields['profile_picture'],
@@ -44,10 +67,10 @@ def agency_create(request):
     context = {'agency_form': agency_form}
     return render(request, "aqar_agencies/agency_create.html", context)
 
+@query_budget(6)
 def agency_choice(request):
     if request.user.is_authenticated:
-        user = User.objects.get(username=request.user)
-        agency_memberships = AgencyMember.objects.filter(member=user)
+        agency_memberships = request.agency_memberships
         if len(agency_memberships) == 1 :
             return redirect("agency_profile")
         
@@ -61,22 +84,217 @@ def agency_choice(request):
     else:
         return render(request, 'aqar_agencies/agency_choice.html')
 
+@query_budget(10)
 def agency_profile(request):
     if request.user.is_authenticated:
-        # user = User.objects.get(username=request.user)
         if request.method == "POST":
-            print(request.POST["agency"], "HEEEEEERE")
-            agency_form = AgencyChoiceForm(request.POST)
+            agency_form = AgencyChoiceForm(request.POST, agency_memberships=request.agency_memberships)
             if agency_form.is_valid():
-                agency = agency_form.cleaned_data['agency']
-                print(agency)
+                set_active_agency(request, agency_form.cleaned_data['agency'])
+            return redirect("agency_profile")
+        if not request.active_agency:
+            return redirect("agency_choice")
+        agency_id = request.active_agency.id
         context = {
-            'name': agency.name
+            'name': request.active_agency.agency_name,
+            'profile': cached_fragment("agency_profile", agency_profile_scopes(agency_id),
+                                       lambda: render_agency_profile(agency_id)),
         }
         return render(request, 'aqar_agencies/agency_profile.html', context)
     else:
         return render(request, 'aqar_agencies/agency_profile.html')
 
+@query_budget(10)
+async def agency_profile_async(request):
+    """agency_profile for ASGI, a cached profile is served without a database query in the view"""
+    # Loads the session, user and memberships in a thread, the template
+    # below only reads them.
+    active_agency = await sync_to_async(
+        lambda: request.active_agency if request.user.is_authenticated and request.active_agency else None)()
+    if request.method == "POST" or not active_agency:
+        return await sync_to_async(agency_profile)(request)
+    context = {
+        'name': active_agency.agency_name,
+        'profile': await acached_fragment("agency_profile", agency_profile_scopes(active_agency.id),
+                                          lambda: render_agency_profile(active_agency.id)),
+    }
+    return render(request, 'aqar_agencies/agency_profile.html', context)
+
+def agency_profile_scopes(agency_id):
+    # The posts show the names of their areas, which a rename changes.
+    return [("agency", agency_id), ("areas", "all")]
+
+def render_agency_profile(agency_id):
+    agency = Agency.objects.get(pk=agency_id)
+    return render_listing("aqar_agencies/agency_profile_posts.html", {
+        'agency': agency,
+        'members': agency.agencymember_set.select_related("member"),
+        'posts': Post.objects.for_agency_profile(agency),
+    })
+
+@query_budget(5)
+def area_feed(request, area_id):
+    area_name = area_registry.name(area_id)
+    if area_name is None:
+        raise Http404("Area does not exist")
+    cursor = request.GET.get("cursor")
+    if not valid_cursor(cursor):
+        return HttpResponseBadRequest("Invalid cursor")
+    context = {
+        "area_id": area_id,
+        "area_name": area_name,
+        "feed": cached_fragment("area_feed", [("area", area_id)],
+                                lambda: render_area_feed(area_id, cursor), vary=[cursor or ""]),
+    }
+    return render(request, "aqar_agencies/area_feed.html", context)
+
+@query_budget(5)
+async def area_feed_async(request, area_id):
+    """area_feed for ASGI, a cached page only leaves the event loop to load the session"""
+    snapshot = area_registry.cached_snapshot() or await sync_to_async(area_registry.snapshot)()
+    area_name = snapshot.names.get(area_id)
+    if area_name is None:
+        raise Http404("Area does not exist")
+    cursor = request.GET.get("cursor")
+    if not valid_cursor(cursor):
+        return HttpResponseBadRequest("Invalid cursor")
+    await load_user(request)
+    context = {
+        "area_id": area_id,
+        "area_name": area_name,
+        "feed": await acached_fragment("area_feed", [("area", area_id)],
+                                       lambda: render_area_feed(area_id, cursor), vary=[cursor or ""]),
+    }
+    return render(request, "aqar_agencies/area_feed.html", context)
+
+async def load_user(request):
+    """Resolves request.user so that templates rendered on the event loop can use it"""
+    # Only a session cookie makes it query the database.
+    if settings.SESSION_COOKIE_NAME in request.COOKIES:
+        await sync_to_async(lambda: request.user.is_authenticated)()
+    else:
+        request.user.is_authenticated
+
+def valid_cursor(cursor):
+    if cursor:
+        try:
+            decode_cursor(cursor)
+        except ValueError:
+            return False
+    return True
+
+def render_area_feed(area_id, cursor):
+    page = keyset_page(Post.objects.area_feed(area_id), cursor, FEED_PAGE_SIZE)
+    return render_listing("aqar_agencies/area_feed_posts.html", {
+        "area_id": area_id,
+        "posts": page.rows,
+        "next_cursor": page.next_cursor,
+    })
+
+@query_budget(7)
+def search(request):
+    form = PostSearchForm(request.GET or None)
+    posts = None
+    if form.is_valid():
+        posts = post_search.search_posts(form.cleaned_data["q"], form.cleaned_data["area"], SEARCH_RESULTS)
+    context = {"form": form, "posts": posts}
+    return render(request, "aqar_agencies/search.html", context)
+
+@query_budget(7)
+async def search_async(request):
+    """search for ASGI, the query and the form's area choices run in a thread"""
+    return await sync_to_async(search)(request)
+
+@query_budget(10)
+def listings(request):
+    """Posts filtered by area, type, price and size, with the counts of each facet value"""
+    form = ListingSearchForm(request.GET)
+    posts = None
+    filters = {}
+    if form.is_valid():
+        data = form.cleaned_data
+        filters = {"area_id": data["area"], "listing_type": data["listing_type"],
+                   "property_type": data["property_type"], "price_band": data["price_band"]}
+        posts = Post.objects.listings(min_size=data["min_size"], max_size=data["max_size"], sort=data["sort"],
+                                      **filters)[:SEARCH_RESULTS]
+    counts = post_facets.facet_counts(**filters)
+    context = {
+        "form": form,
+        "posts": posts,
+        "total": counts.total,
+        "facets": [(title, facet_links(request, facet, getattr(counts, facet))) for facet, title in (
+            ("area", "Area"), ("listing_type", "Sale or rent"), ("property_type", "Property"),
+            ("price_band", "Price"))],
+    }
+    return render(request, "aqar_agencies/listings.html", context)
+
+@query_budget(10)
+async def listings_async(request):
+    """listings for ASGI, the queries run in a thread"""
+    return await sync_to_async(listings)(request)
+
+def facet_links(request, facet, values):
+    """(label, url, count) of each value of a facet, the url narrowing the current search to it"""
+    links = []
+    for value in values:
+        params = request.GET.copy()
+        params[facet] = value.value
+        links.append((value.label, f"?{params.urlencode()}", value.count))
+    return links
+
+@query_budget(0)
+def image_variant(request, width, fmt, name):
+    variant = find_variant(width, fmt, name)
+    response = FileResponse(images.variant_storage().open(variant), content_type=f"image/{fmt}")
+    response["Cache-Control"] = variant_cache_control(name)
+    return response
+
+@query_budget(0)
+async def image_variant_async(request, width, fmt, name):
+    """image_variant for ASGI, the variant is resized if needed and read off the event loop"""
+    def read_variant():
+        with images.variant_storage().open(find_variant(width, fmt, name)) as variant:
+            return variant.read()
+
+    # Variants are small, so they are read whole rather than streamed: ASGI
+    # handlers of this Django version iterate file responses on the loop.
+    response = HttpResponse(await sync_to_async(read_variant, thread_sensitive=False)(),
+                            content_type=f"image/{fmt}")
+    response["Cache-Control"] = variant_cache_control(name)
+    return response
+
+def find_variant(width, fmt, name):
+    """Name of the stored variant of an uploaded image, generated if needed"""
+    if (width not in images.VARIANT_WIDTHS or fmt not in images.VARIANT_FORMATS
+            or not name.startswith(images.UPLOAD_DIRS)):
+        raise Http404("Unknown image variant")
+    storage = images.upload_storage()
+    if not storage.exists(name):
+        raise Http404("Image does not exist")
+    try:
+        return images.ensure_variant(name, width, fmt)
+    except (UnidentifiedImageError, OSError):
+        raise Http404("Image cannot be resized")
+
+def variant_cache_control(name):
+    # Blob names are content hashes, so their variants never change.
+    return IMMUTABLE if blob_digest(name) else "public, max-age=86400"
+
+@query_budget(0)
+def media_file(request, path):
+    """Serves uploads and their variants from whichever storage holds them"""
+    storage = images.upload_storage() if path.startswith(images.UPLOAD_DIRS) else images.variant_storage()
+    if not storage.exists(path):
+        raise Http404("File does not exist")
+    modified = int(storage.get_modified_time(path).timestamp())
+    if not was_modified_since(request.META.get("HTTP_IF_MODIFIED_SINCE"), modified):
+        return HttpResponseNotModified()
+    response = FileResponse(storage.open(path))
+    response["Last-Modified"] = http_date(modified)
+    if blob_digest(path):
+        response["Cache-Control"] = IMMUTABLE
+    return response
+
 # --------------------------------------------------------------------------------------
 
 def learning_view(request):
@@ -9,8 +9,14 @@ https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
 
 import os
 
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'aqarwebsite.settings')
+os.environ.setdefault('AQAR_ASYNC_VIEWS', '1')
 
 application = get_asgi_application()
+
+if settings.AQAR_PRECOMPILE_TEMPLATES:
+    from aqar_agencies.templating import precompile_templates
+    precompile_templates()
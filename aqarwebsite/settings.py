@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -22,10 +23,18 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 # SECURITY WARNING: keep the secret key used in production secret!
 SECRET_KEY = 'django-insecure-w57_d2hhf3l^@95hmjv2h@pq)l(95@k7bq2ase629-geq-jen9'
 
+# "production" switches on the settings tuned for serving real traffic,
+# e.g. AQAR_PROFILE=production gunicorn aqarwebsite.wsgi
+AQAR_PROFILE = os.environ.get("AQAR_PROFILE", "development")
+
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+# It also keeps {% static %} on the unhashed names, which are not cached for long.
+DEBUG = AQAR_PROFILE != "production"
 
-ALLOWED_HOSTS = []
+# Comma separated, e.g. AQAR_ALLOWED_HOSTS=aqar.example.com,www.aqar.example.com
+ALLOWED_HOSTS = [host.strip() for host in os.environ.get("AQAR_ALLOWED_HOSTS", "").split(",") if host.strip()]
+if not DEBUG and not ALLOWED_HOSTS:
+    ALLOWED_HOSTS = ["localhost", "127.0.0.1", "[::1]"]
 
 
 # Application definition
@@ -41,15 +50,39 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'aqar_agencies.instrumentation.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'aqar_agencies.compression.CompressionMiddleware',
+    'aqar_agencies.staticfiles.StaticFilesMiddleware',
+    'aqar_agencies.middleware.PrimaryPinningMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'aqar_agencies.middleware.ActiveAgencyMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Requests slower than this are logged as warnings by RequestMetricsMiddleware,
+# like the ones running more queries than their view's query_budget.
+AQAR_SLOW_REQUEST_MS = 500
+
+# Send the SQL and total time of each request in a Server-Timing header.
+AQAR_SERVER_TIMING = AQAR_PROFILE != "production"
+
+# AQAR_PROFILER=1 profiles this share of the requests, and every request
+# from the moment it has run for AQAR_PROFILER_SLOW_MS, into a rotating
+# store in AQAR_PROFILER_DIR read by `manage.py profile_report`.
+if os.environ.get("AQAR_PROFILER") == "1":
+    MIDDLEWARE.insert(1, 'aqar_agencies.profiling.SamplingProfilerMiddleware')
+AQAR_PROFILER_SAMPLE_RATE = float(os.environ.get("AQAR_PROFILER_SAMPLE_RATE", 0.01))
+AQAR_PROFILER_SLOW_MS = 1000
+AQAR_PROFILER_INTERVAL_MS = 5
+AQAR_PROFILER_DIR = BASE_DIR / "profiles"
+AQAR_PROFILER_MAX_BYTES = 10 * 1024 * 1024
+AQAR_PROFILER_BACKUPS = 5
+
 ROOT_URLCONF = 'aqarwebsite.urls'
 
 TEMPLATES = [
@@ -70,8 +103,45 @@ TEMPLATES = [
     },
 ]
 
+if AQAR_PROFILE == "production":
+    # Parse each template once per process, wsgi.py and asgi.py load them
+    # all at startup, see aqar_agencies/templating.py.
+    TEMPLATES[0]['APP_DIRS'] = False
+    TEMPLATES[0]['OPTIONS']['loaders'] = [
+        ('django.template.loaders.cached.Loader', [
+            'django.template.loaders.filesystem.Loader',
+            'django.template.loaders.app_directories.Loader',
+        ]),
+    ]
+    # Form widgets render through TEMPLATES, and so its cache, rather than
+    # through an engine of their own that parses them on every render.
+    INSTALLED_APPS.append('django.forms')
+    FORM_RENDERER = 'django.forms.renderers.TemplatesSetting'
+AQAR_PRECOMPILE_TEMPLATES = AQAR_PROFILE == "production"
+
+# The listing fragments render through Jinja2 when it is installed, unless
+# AQAR_JINJA_LISTINGS=0. The Jinja2 copies live in aqar_agencies/jinja2.
+try:
+    import jinja2
+except ImportError:
+    jinja2 = None
+if jinja2 is not None and os.environ.get("AQAR_JINJA_LISTINGS", "1") == "1":
+    TEMPLATES.append({
+        'NAME': 'jinja2',
+        'BACKEND': 'django.template.backends.jinja2.Jinja2',
+        'APP_DIRS': True,
+        'OPTIONS': {
+            'environment': 'aqar_agencies.jinja_env.environment',
+            'auto_reload': AQAR_PROFILE != "production",
+        },
+    })
+
 WSGI_APPLICATION = 'aqarwebsite.wsgi.application'
 
+# Serve the feed, profile, search and image pages with their async views,
+# switched on by aqarwebsite/asgi.py.
+AQAR_ASYNC_VIEWS = os.environ.get("AQAR_ASYNC_VIEWS") == "1"
+
 
 # Database
 # https://docs.djangoproject.com/en/3.2/ref/settings/#databases
@@ -83,6 +153,65 @@ DATABASES = {
     }
 }
 
+if AQAR_PROFILE == "production":
+    # WAL, tuned pragmas, BEGIN IMMEDIATE and one queue for the writes of
+    # every worker, see aqarwebsite/sqlite3/base.py.
+    DATABASES['default'].update({
+        'ENGINE': 'aqarwebsite.sqlite3',
+        'CONN_MAX_AGE': 600,
+        'OPTIONS': {
+            'timeout': 10,
+            'serialize_writes': True,
+        },
+    })
+
+# Reads of the site's models go to these aliases and writes to 'default'.
+# AQAR_REPLICA names a replica SQLite file; "primary" reads through a
+# read-only connection to the primary file instead, which on a single box
+# keeps the readers from ever taking a write lock.
+AQAR_READ_REPLICAS = []
+
+if os.environ.get("AQAR_REPLICA"):
+    replica = os.environ["AQAR_REPLICA"]
+    if replica == "primary":
+        replica = DATABASES['default']['NAME']
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'NAME': f"file:{replica}?mode=ro",
+        'TEST': {'MIRROR': 'default'},
+    }
+    AQAR_READ_REPLICAS = ['replica']
+
+DATABASE_ROUTERS = ['aqar_agencies.routers.PrimaryReplicaRouter']
+
+# Seconds a user's reads stay on the primary after they write.
+AQAR_PIN_PRIMARY_SECONDS = 5
+
+
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+if AQAR_PROFILE == "production":
+    # Every worker must see the version counters the others bump, and the
+    # fragments they cache, so the cache lives on disk rather than in each
+    # process.
+    CACHES['default'] = {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    }
+
+# Rendered page fragments are cached under version counters that the
+# model signals bump, so the timeout only bounds memory use.
+AQAR_PAGE_CACHE_TIMEOUT = 60 * 60
+AQAR_PAGE_CACHE_METRICS = True
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
@@ -122,6 +251,19 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 
+STATICFILES_DIRS = [BASE_DIR / "static"]
+
+STATIC_ROOT = BASE_DIR / "staticfiles"
+
+if AQAR_PROFILE == "production":
+    # collectstatic fingerprints and precompresses the files, see
+    # aqar_agencies/staticfiles.py.
+    STATICFILES_STORAGE = 'aqar_agencies.staticfiles.CompressedManifestStaticFilesStorage'
+
+# StaticFilesMiddleware serves what collectstatic put in STATIC_ROOT, with
+# far-future caching for the fingerprinted names.
+AQAR_SERVE_STATIC = True
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
@@ -129,4 +271,10 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 MEDIA_ROOT = BASE_DIR / "uploads"
 
+MEDIA_URL = '/media/'
+
+# Threads that resize uploaded images into responsive variants, 0 resizes
+# them in the request once the upload is committed.
+AQAR_IMAGE_WORKERS = 2
+
 LOGIN_REDIRECT_URL = '/'
\ No newline at end of file
@@ -0,0 +1,18 @@
+"""Settings for the test suite, which manage.py uses for `manage.py test`.
+
+Uploads and image variants are kept in memory, so tests never touch the
+real uploads and `manage.py test --parallel` processes cannot collide, and
+passwords use a fast hasher. The views render every template with Django's
+engine, whose renders the test client records in response.context, the
+Jinja2 listings are tested on their own.
+"""
+from .settings import *  # noqa: F401,F403
+
+PASSWORD_HASHERS = [
+    'django.contrib.auth.hashers.MD5PasswordHasher',
+]
+
+DEFAULT_FILE_STORAGE = 'aqar_agencies.storage.InMemoryStorage'
+AQAR_BLOB_STORAGE = 'aqar_agencies.storage.InMemoryContentAddressedStorage'
+
+TEMPLATES = [engine for engine in TEMPLATES if engine.get('NAME') != 'jinja2']  # noqa: F405
@@ -0,0 +1,168 @@
+"""SQLite backend for serving the site from several worker processes.
+
+Every connection is switched to WAL and gets the pragmas below, so readers
+no longer wait for writers. Transactions start with BEGIN IMMEDIATE: a
+transaction that reads and then writes takes the write lock up front and
+waits for it under the busy timeout, instead of failing with "database is
+locked" when it tries to upgrade. Statements that still find the database
+locked outside a transaction are retried with backoff.
+
+OPTIONS accepts, besides the sqlite3.connect() arguments:
+
+    pragmas           overrides of DEFAULT_PRAGMAS
+    busy_retries      retries of a locked statement outside a transaction
+    serialize_writes  queue the write transactions of every process on a
+                      lock file next to the database rather than polling
+                      SQLite's busy handler
+"""
+import fcntl
+import os
+import random
+import time
+
+from django.db.backends.sqlite3 import base
+
+DEFAULT_PRAGMAS = {
+    "journal_mode": "wal",
+    # Durable at every checkpoint rather than every commit, which is safe
+    # under WAL: a power loss can only drop the last transactions.
+    "synchronous": "normal",
+    "mmap_size": 256 * 1024 * 1024,
+    # Negative sizes are in KiB.
+    "cache_size": -64 * 1024,
+    "temp_store": "memory",
+}
+
+WRITE_STATEMENTS = ("INSERT", "UPDATE", "DELETE", "REPLACE")
+
+
+def is_locked_error(error):
+    return "database is locked" in str(error) or "database table is locked" in str(error)
+
+
+class WriteLock:
+    """An exclusive flock() on a file, one per database connection"""
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def acquire(self):
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        options = self.settings_dict["OPTIONS"]
+        self.pragmas = {**DEFAULT_PRAGMAS, **options.get("pragmas", {})}
+        self.busy_retries = options.get("busy_retries", 5)
+        # Read-only connections, such as a replica opened with ?mode=ro,
+        # cannot change the journal mode and never write.
+        self.read_only = "mode=ro" in str(self.settings_dict["NAME"])
+        self.write_lock = None
+        if options.get("serialize_writes") and not self.is_in_memory_db() and not self.read_only:
+            self.write_lock = WriteLock(f"{self.settings_dict['NAME']}-writelock")
+        self.holds_write_lock = False
+
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        for option in ("pragmas", "busy_retries", "serialize_writes"):
+            params.pop(option, None)
+        return params
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for pragma, value in self.pragmas.items():
+            if pragma == "journal_mode" and (self.is_in_memory_db() or self.read_only):
+                continue
+            conn.execute(f"PRAGMA {pragma} = {value}")
+        return conn
+
+    def create_cursor(self, name=None):
+        cursor = self.connection.cursor(factory=SQLiteCursorWrapper)
+        cursor.database = self
+        return cursor
+
+    def acquire_write_lock(self):
+        if self.write_lock is not None and not self.holds_write_lock:
+            self.write_lock.acquire()
+            self.holds_write_lock = True
+
+    def release_write_lock(self):
+        if self.holds_write_lock:
+            self.write_lock.release()
+            self.holds_write_lock = False
+
+    def retry_locked(self, operation):
+        """Runs `operation`, retrying with jittered backoff while the database is locked"""
+        for attempt in range(self.busy_retries + 1):
+            try:
+                return operation()
+            except base.Database.OperationalError as error:
+                if not is_locked_error(error) or attempt == self.busy_retries:
+                    raise
+            time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+
+    def _start_transaction_under_autocommit(self):
+        self.acquire_write_lock()
+        try:
+            with self.wrap_database_errors:
+                begin = "BEGIN" if self.read_only else "BEGIN IMMEDIATE"
+                self.retry_locked(lambda: self.connection.execute(begin))
+        except Exception:
+            self.release_write_lock()
+            raise
+
+    def _commit(self):
+        try:
+            return super()._commit()
+        finally:
+            self.release_write_lock()
+
+    def _rollback(self):
+        try:
+            return super()._rollback()
+        finally:
+            self.release_write_lock()
+
+    def _close(self):
+        try:
+            return super()._close()
+        finally:
+            self.release_write_lock()
+            if self.write_lock is not None:
+                self.write_lock.close()
+
+
+class SQLiteCursorWrapper(base.SQLiteCursorWrapper):
+    def execute(self, query, params=None):
+        return self.run(query, lambda: super(SQLiteCursorWrapper, self).execute(query, params))
+
+    def executemany(self, query, param_list):
+        return self.run(query, lambda: super(SQLiteCursorWrapper, self).executemany(query, param_list))
+
+    def run(self, query, operation):
+        database = self.database
+        if database.in_atomic_block:
+            # The transaction already holds the write lock, and retrying one
+            # statement of it could not undo the ones before.
+            return operation()
+        if database.write_lock is not None and query.lstrip()[:7].upper().startswith(WRITE_STATEMENTS):
+            database.acquire_write_lock()
+            try:
+                return database.retry_locked(operation)
+            finally:
+                database.release_write_lock()
+        return database.retry_locked(operation)
@@ -46,4 +46,5 @@ urlpatterns = [
     path('accounts/reset/done/',
         auth_views.PasswordResetCompleteView.as_view(),
         name="password_reset_complete"),
+    path("media/<path:path>", views.media_file, name="media_file"),
 ]
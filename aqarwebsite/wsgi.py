@@ -9,8 +9,13 @@ https://docs.djangoproject.com/en/3.2/howto/deployment/wsgi/
 
 import os
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'aqarwebsite.settings')
 
 application = get_wsgi_application()
+
+if settings.AQAR_PRECOMPILE_TEMPLATES:
+    from aqar_agencies.templating import precompile_templates
+    precompile_templates()